@@ -1,7 +1,14 @@
-from typing import List
+from typing import Dict, List, Optional, Tuple
+import random
+import warnings
+import numpy as np
+import pytest
+from intcode_lockstep import execute_in_lockstep
 
 
-def execute_program(input: List[int]) -> List[int]:
+def execute_program(input: List[int], undo_log: Optional[List[Tuple[int, int]]] = None) -> List[int]:
+    # `undo_log`, if given, gets (address, previous value) for every write so that the caller can undo the run:
+    log_write = None if undo_log is None else undo_log.append
     should_continue = True
     index = 0
     while should_continue == True:
@@ -11,6 +18,8 @@ def execute_program(input: List[int]) -> List[int]:
             operand2 = input[index + 2]
             operand3 = input[index + 3]
             result = input[operand1] + input[operand2]
+            if log_write is not None:
+                log_write((operand3, input[operand3]))
             input[operand3] = result
             index += 4
         elif op_code == 2:
@@ -18,6 +27,8 @@ def execute_program(input: List[int]) -> List[int]:
             operand2 = input[index + 2]
             operand3 = input[index + 3]
             result = input[operand1] * input[operand2]
+            if log_write is not None:
+                log_write((operand3, input[operand3]))
             input[operand3] = result
             index += 4
         elif op_code == 99:
@@ -63,31 +74,271 @@ def parse_input(raw_input: str) -> List[int]:
     return input
 
 
+def execute_with_noun_and_verb(memory: List[int], noun: int, verb: int) -> int:
+    """
+    Run the program in `memory` with the noun and the verb patched in and return the value at address 0.
+    `memory` is left as it was: only the cells that the run wrote are put back, so nothing gets copied.
+    """
+    undo_log = [(1, memory[1]), (2, memory[2])]
+    memory[1] = noun
+    memory[2] = verb
+    try:
+        return execute_program(memory, undo_log)[0]
+    finally:
+        for address, value in reversed(undo_log):
+            memory[address] = value
+
+
 def part_one():
     with open("day_02_input.txt") as f:
         raw_input = f.readline()
-        parsed_input = parse_input(raw_input)
-        parsed_input[1] = 12
-        parsed_input[2] = 2
-        return execute_program(parsed_input)
+        return execute_with_noun_and_verb(parse_input(raw_input), 12, 2)
+
+
+def find_noun_and_verb_by_brute_force(parsed_input: List[int], target: int) -> int:
+    for noun in range(100):
+        for verb in range(100):
+            if execute_with_noun_and_verb(parsed_input, noun, verb) == target:
+                return 100 * noun + verb
+    else:
+        raise RuntimeError("No noun and verb combination found")
+
+
+def find_noun_and_verb(parsed_input: List[int], target: int) -> int:
+    """Same as `find_noun_and_verb_by_brute_force` but all 10,000 combinations run together in lockstep."""
+    nouns, verbs = np.divmod(np.arange(100 * 100), 100)
+    memories = np.tile(np.array(parsed_input, dtype=np.int64), (len(nouns), 1))
+    memories[:, 1] = nouns
+    memories[:, 2] = verbs
+    final_memories = execute_in_lockstep(memories)
+    matches = np.flatnonzero(final_memories[:, 0] == target)
+    if len(matches) == 0:
+        raise RuntimeError("No noun and verb combination found")
+    return 100 * int(nouns[matches[0]]) + int(verbs[matches[0]])
+
+
+class Polynomial:
+    """A polynomial in the noun and the verb with integer coefficients."""
+
+    def __init__(self, coefficients: Dict[Tuple[int, int], int]):
+        # (power of the noun, power of the verb) -> coefficient:
+        self.coefficients = {powers: c for powers, c in coefficients.items() if c != 0}
+
+    @staticmethod
+    def constant(value: int) -> "Polynomial":
+        return Polynomial({(0, 0): value})
+
+    def __add__(self, other: "Polynomial") -> "Polynomial":
+        coefficients = dict(self.coefficients)
+        for powers, c in other.coefficients.items():
+            coefficients[powers] = coefficients.get(powers, 0) + c
+        return Polynomial(coefficients)
+
+    def __mul__(self, other: "Polynomial") -> "Polynomial":
+        coefficients: Dict[Tuple[int, int], int] = {}
+        for (noun_1, verb_1), c_1 in self.coefficients.items():
+            for (noun_2, verb_2), c_2 in other.coefficients.items():
+                powers = (noun_1 + noun_2, verb_1 + verb_2)
+                coefficients[powers] = coefficients.get(powers, 0) + c_1 * c_2
+        return Polynomial(coefficients)
 
+    def __eq__(self, other):
+        return isinstance(other, Polynomial) and self.coefficients == other.coefficients
 
+    def __repr__(self):
+        return f"Polynomial({self.coefficients})"
+
+    def get_constant_value(self) -> Optional[int]:
+        """The value of the polynomial if it doesn't depend on the noun or the verb."""
+        if all(powers == (0, 0) for powers in self.coefficients):
+            return self.coefficients.get((0, 0), 0)
+        return None
+
+    def evaluate(self, noun: int, verb: int) -> int:
+        return sum(c * noun ** noun_power * verb ** verb_power
+                   for (noun_power, verb_power), c in self.coefficients.items())
+
+
+noun_polynomial = Polynomial({(1, 0): 1})
+verb_polynomial = Polynomial({(0, 1): 1})
+
+
+def execute_program_symbolically(input: List[int]) -> Polynomial:
+    """
+    Like `execute_program` with the noun and the verb (positions 1 and 2) left as unknowns. Return position 0
+    at the end as a polynomial in the noun and the verb.
+    Cells that are read through an address that depends on the noun or the verb get an unknown value (None). That
+    is fine as long as the value is overwritten before anything uses it. Raises ValueError for programs that can't be
+    executed symbolically, e.g. when the op code or an address depends on the noun or the verb.
+    """
+    memory: List[Optional[Polynomial]] = [Polynomial.constant(x) for x in input]
+    memory[1] = noun_polynomial
+    memory[2] = verb_polynomial
+
+    def read_concrete(address: int, description: str) -> int:
+        if address < 0 or address >= len(memory):
+            raise ValueError(f"{description} at position {address} is out of bounds")
+        value = memory[address]
+        constant_value = value.get_constant_value() if value is not None else None
+        if constant_value is None:
+            raise ValueError(f"{description} at position {address} depends on the noun or the verb")
+        return constant_value
+
+    def read_through(address_position: int) -> Optional[Polynomial]:
+        cell = memory[address_position]
+        address = cell.get_constant_value() if cell is not None else None
+        if address is None or address < 0 or address >= len(memory):
+            return None
+        return memory[address]
+
+    index = 0
+    while True:
+        op_code = read_concrete(index, "Op code")
+        if op_code == 99:
+            break
+        elif op_code in (1, 2):
+            operand1 = read_through(index + 1)
+            operand2 = read_through(index + 2)
+            operand3 = read_concrete(index + 3, "Address")
+            if operand1 is None or operand2 is None:
+                result = None
+            else:
+                result = operand1 + operand2 if op_code == 1 else operand1 * operand2
+            if operand3 < 0 or operand3 >= len(memory):
+                raise ValueError(f"Address {operand3} is out of bounds")
+            memory[operand3] = result
+            index += 4
+        else:
+            raise ValueError(f"Op code {op_code} at position {index} is not supported symbolically")
+    if memory[0] is None:
+        raise ValueError("Position 0 depends on a cell that was read through an address that isn't known")
+    return memory[0]
+
+
+def solve_for_noun_and_verb(polynomial: Polynomial, target: int) -> int:
+    """Find the smallest noun (then verb) in 0-99 for which `polynomial` equals `target`."""
+    for noun in range(100):
+        # Substitute the noun to get a polynomial in the verb, which is linear for the puzzle inputs:
+        verb_coefficients: Dict[int, int] = {}
+        for (noun_power, verb_power), c in polynomial.coefficients.items():
+            verb_coefficients[verb_power] = verb_coefficients.get(verb_power, 0) + c * noun ** noun_power
+        if all(verb_power <= 1 for verb_power in verb_coefficients):
+            slope = verb_coefficients.get(1, 0)
+            difference = target - verb_coefficients.get(0, 0)
+            if slope == 0:
+                if difference == 0:
+                    return 100 * noun
+            elif difference % slope == 0 and 0 <= difference // slope < 100:
+                return 100 * noun + difference // slope
+        else:
+            for verb in range(100):
+                if polynomial.evaluate(noun, verb) == target:
+                    return 100 * noun + verb
+    raise RuntimeError("No noun and verb combination found")
+
+
+def find_noun_and_verb_symbolically(parsed_input: List[int], target: int) -> int:
+    """
+    Solve for the noun and the verb with `execute_program_symbolically`. Programs that it doesn't support
+    are searched with `find_noun_and_verb` instead, with a warning that says why.
+    """
+    try:
+        polynomial = execute_program_symbolically(parsed_input)
+    except ValueError as e:
+        warnings.warn(f"Falling back to searching all nouns and verbs: {e}")
+        return find_noun_and_verb(parsed_input, target)
+    return solve_for_noun_and_verb(polynomial, target)
+
+
+def make_gravity_assist_program(num_instructions: int, seed: int = 2) -> List[int]:
+    """
+    A program shaped like the puzzle input: it multiplies the noun by a constant, then adds or multiplies
+    in more constants, adds the verb and stores the result at position 0.
+    """
+    rng = random.Random(seed)
+    code = [1, 0, 0, 3, 1, 1, 2, 3, 1, 3, 4, 3, 1, 5, 0, 3]
+    num_code_cells = len(code) + 4 * (num_instructions + 3) + 1
+    # The noun is multiplied by at least 100 so that every combination of noun and verb gives a different result:
+    constants = [rng.randint(100, 999)] + [rng.randint(1, 5) for _ in range(9)]
+    constant_addresses = list(range(num_code_cells, num_code_cells + len(constants)))
+    zero_address = constant_addresses[-1] + 1
+    code += [2, 1, constant_addresses[0], len(code) + 3]
+    for _ in range(num_instructions):
+        op_code = 2 if rng.random() < 0.2 else 1
+        code += [op_code, len(code) - 1, rng.choice(constant_addresses[1:]), len(code) + 3]
+    code += [1, len(code) - 1, 2, len(code) + 3]
+    code += [1, len(code) - 1, zero_address, 0]
+    code += [99]
+    return code + constants + [0]
+
+
+def test_make_gravity_assist_program():
+    program = make_gravity_assist_program(30)
+    result = execute_with_noun_and_verb(program, 12, 2)
+    # The result is linear in the noun:
+    assert execute_with_noun_and_verb(program, 13, 2) > result > 0
+    # The runs leave the program as it was:
+    assert program == make_gravity_assist_program(30)
+
+
+def test_find_noun_and_verb():
+    program = make_gravity_assist_program(30)
+    target = execute_with_noun_and_verb(program, 31, 41)
+    assert find_noun_and_verb_by_brute_force(program, target) == 3141
+    assert find_noun_and_verb(program, target) == 3141
+    with pytest.raises(RuntimeError):
+        find_noun_and_verb(program, -1)
+
+
+def test_execute_program_symbolically():
+    # The first instruction reads through the noun and the verb as addresses, but its result is overwritten.
+    # Then position 0 = (noun + verb) * (noun + verb):
+    program = parse_input("1,0,0,3,1,1,2,0,2,0,0,0,99")
+    assert execute_program_symbolically(program) == Polynomial({(2, 0): 1, (1, 1): 2, (0, 2): 1})
+    program = make_gravity_assist_program(30)
+    polynomial = execute_program_symbolically(program)
+    for noun, verb in [(0, 0), (12, 2), (99, 99)]:
+        assert polynomial.evaluate(noun, verb) == execute_with_noun_and_verb(program, noun, verb)
+    # The second op code is the sum of the cells at the noun and the verb:
+    with pytest.raises(ValueError, match="Op code at position 4"):
+        execute_program_symbolically(parse_input("1,1,2,4,0,0,0,0,99"))
+
+
+def test_find_noun_and_verb_symbolically():
+    program = make_gravity_assist_program(30)
+    target = execute_with_noun_and_verb(program, 31, 41)
+    assert find_noun_and_verb_symbolically(program, target) == 3141
+    with pytest.raises(RuntimeError):
+        find_noun_and_verb_symbolically(program, -1)
+    # Not linear in the verb:
+    program = parse_input("1,0,0,3,2,2,2,0,99")
+    assert find_noun_and_verb_symbolically(program, 49) == 7
+
+
+@pytest.mark.parametrize("program,target", [
+    ("1,0,0,3,1,1,13,11,1,0,0,0,99,100", 1),  # the third instruction writes to position noun + 100
+    ("1,1,2,0,99", 100),  # position 0 is read through the noun and the verb
+])
+def test_find_noun_and_verb_symbolically_falls_back(program, target):
+    # Pad with zeros so that every noun and verb is a valid address:
+    parsed_input = parse_input(program + ",0" * 100)
+    with pytest.warns(UserWarning, match="Falling back"):
+        result = find_noun_and_verb_symbolically(parsed_input, target)
+    assert result == find_noun_and_verb_by_brute_force(parsed_input, target)
+
+
+def test_find_noun_and_verb_symbolically_falls_back_on_jumps():
+    # Position 0 = the cell at the noun + the cell at the verb, then jump over a 0 to the 99:
+    parsed_input = parse_input("1,0,0,0,1105,1,9,0,0,99" + ",0" * 100)
+    with pytest.warns(UserWarning, match="Op code 1105"):
+        assert find_noun_and_verb_symbolically(parsed_input, 0) == 303
 
 
 def part_two():
     with open("day_02_input.txt") as f:
         raw_input = f.readline()
         parsed_input = parse_input(raw_input)
-        for noun in range(100):
-            for verb in range(100):
-                input_to_try = parsed_input.copy()
-                input_to_try[1] = noun
-                input_to_try[2] = verb
-                execute_program(input_to_try)
-                if input_to_try[0] == 19690720:
-                    return 100 * noun + verb
-        else:
-            raise RuntimeError("No noun and verb combination found")
+        return find_noun_and_verb_symbolically(parsed_input, 19690720)
 
 
 # Note: These tests are commented out because the input and expected output are
@@ -1,7 +1,22 @@
-from collections import namedtuple
-from typing import Tuple, List, Dict
+from collections import namedtuple, deque, Counter
+from array import array
+from typing import (
+    Callable, Tuple, List, Dict, Deque, FrozenSet, Iterable, Iterator, MutableSequence, Optional, Set, TextIO, Union
+)
 from enum import Enum, unique, auto
 import re
+import itertools
+import sys
+import copy
+import hashlib
+import io
+import json
+import marshal
+import mmap
+import os
+import struct
+import time
+import typing
 from unittest.mock import Mock, call, AsyncMock
 import pytest
 
@@ -92,48 +107,825 @@ def test_parse_instruction():
         Mode.POSITION, Mode.IMMEDIATE, Mode.POSITION])
 
 
+def parse_shared_instruction(input_value: int) -> Instruction:
+    """Same as `parse_instruction` but the modes are a tuple, so that callers can't change a cached instruction."""
+    instruction = parse_instruction(input_value)
+    return instruction._replace(modes=tuple(instruction.modes))
+
+
+def build_decode_table() -> Dict[int, Instruction]:
+    """Pre-decode every well-formed instruction word (each op code combined with every mode per operand)."""
+    table: Dict[int, Instruction] = {}
+    for op_code_value, (_, num_operands) in int_to_op_code_and_num_operands.items():
+        for mode_values in itertools.product(int_to_mode.keys(), repeat=num_operands):
+            # Modes are specified in reverse order, starting from the hundreds digit:
+            word = op_code_value + sum(
+                mode_value * 10 ** (num_digits_in_op_code + position)
+                for position, mode_value in enumerate(mode_values))
+            table[word] = parse_shared_instruction(word)
+    return table
+
+
+decode_table: Dict[int, Instruction] = build_decode_table()
+# Unusual words are remembered until the table has grown by this many, so self-modifying code can't make it huge:
+max_unusual_words = 1024
+max_decode_table_size = len(decode_table) + max_unusual_words
+
+
+def decode_instruction(input_value: int) -> Instruction:
+    """Same as `parse_instruction` but each distinct instruction word is only ever parsed once."""
+    try:
+        return decode_table[input_value]
+    except KeyError:
+        # Unusual words (e.g. redundant leading mode digits) are parsed and remembered on first sight.
+        # Invalid words raise the same errors that `parse_instruction` does and are never remembered.
+        instruction = parse_shared_instruction(input_value)
+        if len(decode_table) < max_decode_table_size:
+            decode_table[input_value] = instruction
+        return instruction
+
+
+@pytest.mark.parametrize("input_value", list(build_decode_table().keys()) + [10099, 1001099])
+def test_decode_instruction_matches_parse_instruction(input_value):
+    instruction = parse_instruction(input_value)
+    assert decode_instruction(input_value) == instruction._replace(modes=tuple(instruction.modes))
+
+
+def test_decode_instruction_invalid_op_code():
+    with pytest.raises(KeyError):
+        decode_instruction(42)
+    with pytest.raises(KeyError):
+        decode_instruction(301)
+    assert 42 not in decode_table and 301 not in decode_table
+
+
+def test_decode_instruction_remembers_a_bounded_number_of_unusual_words(monkeypatch):
+    monkeypatch.setattr(sys.modules[__name__], "max_decode_table_size", len(decode_table) + 1)
+    unusual_words = [99 + 10 ** digits for digits in range(5, 8)]
+    for word in unusual_words:
+        assert decode_instruction(word).op_code == Op_Code.TERMINATE
+    assert [word in decode_table for word in unusual_words].count(True) <= 1
+
+
 class Buffer:
-    """Like a list but also dynamically create missing elements on demand and assign these elements the value of zero."""
+    """
+    Like a list but reading past the end returns zero and writing past the end grows the buffer.
+    Cells live in a contiguous list whose capacity at least doubles whenever it has to grow.
+    Writes far beyond the end of that list (more than `max_dense_gap` cells) go to sparse pages
+    instead so that a program poking at a very high address doesn't allocate everything below it.
+    """
+    page_size = 1024
+    max_dense_gap = 1 << 16
+
+    def __init__(self, initial_values: Iterable[int]):
+        self.__cells: MutableSequence[int] = self.make_cells(initial_values)
+        # One past the highest address that has been written to:
+        self.__length = len(self.__cells)
+        # Same as `__length` but capped to the list. The list past this point is spare capacity filled with zeros:
+        self.__dense_length = self.__length
+        self.__pages: Dict[int, List[int]] = {}
+
+    @staticmethod
+    def make_cells(values: Iterable[int]) -> MutableSequence[int]:
+        return list(values)
+
+    def is_compact(self) -> bool:
+        """True if the cells are stored as 64-bit integers (see `Int64Buffer`)."""
+        return isinstance(self.__cells, array)
 
-    def __init__(self, initial_values: List[int]):
-        self.__buffer = {index: value for index,
-                         value in enumerate(initial_values)}
+    def __promote(self):
+        self.__cells = list(self.__cells)
 
-    def __retrieve(self, key):
-        return self.__buffer[key]
+    def __check_key(self, key):
+        if not isinstance(key, int):
+            raise TypeError(f"Key {key} is not an integer.")
+        if key < 0:
+            raise IndexError(f"Key {key} is a negative address.")
+
+    def __read_slow(self, key) -> int:
+        self.__check_key(key)
+        page = self.__pages.get(key // self.page_size)
+        return 0 if page is None else page[key % self.page_size]
+
+    def __write_slow(self, key, value):
+        self.__check_key(key)
+        if self.is_compact() and not int64_min <= value <= int64_max:
+            self.__promote()
+        cells = self.__cells
+        capacity = len(cells)
+        if key < capacity:
+            cells[key] = value
+        elif key - capacity <= self.max_dense_gap:
+            new_capacity = max(key + 1, 2 * capacity)
+            cells.extend([0] * (new_capacity - capacity))
+            self.__move_pages_to_cells(new_capacity)
+            cells[key] = value
+        else:
+            page = self.__pages.setdefault(key // self.page_size, [0] * self.page_size)
+            page[key % self.page_size] = value
+        self.__length = max(self.__length, key + 1)
+        self.__dense_length = min(self.__length, len(cells))
+
+    def __move_pages_to_cells(self, capacity: int):
+        page_size = self.page_size
+        for page_number in [x for x in self.__pages.keys() if x * page_size < capacity]:
+            page = self.__pages.pop(page_number)
+            start = page_number * page_size
+            if start + page_size > capacity:
+                self.__cells.extend([0] * (start + page_size - capacity))
+            self.__cells[start:start + page_size] = self.make_cells(page)
 
     def __getitem__(self, key):
-        default_value = 0
-        if isinstance(key, int):
-            if key in self.__buffer:
-                return self.__buffer[key]
-            else:
-                self.__buffer[key] = default_value
-                return default_value
+        try:
+            if key >= 0:
+                return self.__cells[key]
+        except IndexError:
+            pass
+        return self.__read_slow(key)
+
+    def __setitem__(self, key, value):
+        if 0 <= key < self.__dense_length:
+            try:
+                self.__cells[key] = value
+            except OverflowError:
+                # Only compact cells overflow:
+                self.__promote()
+                self.__cells[key] = value
+        else:
+            self.__write_slow(key, value)
+
+    def __len__(self):
+        """One past the highest address that has been written to."""
+        return self.__length
+
+    def get_length(self) -> int:
+        """Same as `len` but also works past `sys.maxsize`, which addresses can go beyond."""
+        return self.__length
+
+    def to_list(self) -> List[int]:
+        return [self[index] for index in range(self.__length)]
+
+    def get_num_bytes(self) -> int:
+        """Number of bytes held by the containers that store the cells (excluding the int objects themselves)."""
+        return sys.getsizeof(self.__cells) + sum(sys.getsizeof(page) for page in self.__pages.values())
+
+    def get_segments(self) -> List[Tuple[int, List[int]]]:
+        """(start address, cells) for every stretch of stored cells, in order of address and cut off at `len(self)`."""
+        segments = [(0, list(self.__cells[:self.__dense_length]))]
+        for page_number in sorted(self.__pages.keys()):
+            start = page_number * self.page_size
+            segments.append((start, self.__pages[page_number][:self.__length - start]))
+        return segments
+
+    def fork(self) -> "Buffer":
+        """Independent copy of this buffer. Copies every cell, use a `PagedBuffer` for cheap forks."""
+        forked = type(self)(self.__cells[:self.__dense_length])
+        for page_number, page in self.__pages.items():
+            forked.__pages[page_number] = page.copy()
+        forked.__length = self.__length
+        return forked
+
+    def __eq__(self, other):
+        """Compare against a list (which only needs to match the start of the buffer) or another buffer."""
+        if isinstance(other, list):
+            return len(other) <= self.__length and all(
+                self[index] == other_value for index, other_value in enumerate(other))
+        elif isinstance(other, (Buffer, PagedBuffer)):
+            return self.__length == len(other) and self.to_list() == other.to_list()
         else:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"{type(self).__name__}(length={self.__length}, pages={sorted(self.__pages.keys())})"
+
+
+def test_buffer_reads_past_end_do_not_allocate():
+    buffer = Buffer([1, 2, 3])
+    assert buffer[100] == 0
+    assert buffer[10 ** 12] == 0
+    assert len(buffer) == 3
+    assert buffer == [1, 2, 3]
+
+
+def test_buffer_grows_on_write():
+    buffer = Buffer([1, 2, 3])
+    buffer[5] = 6
+    assert len(buffer) == 6
+    assert buffer == [1, 2, 3, 0, 0, 6]
+    assert buffer[4] == 0
+
+
+def test_buffer_uses_pages_for_very_high_addresses():
+    buffer = Buffer([1, 2, 3])
+    high_address = 10 ** 12
+    buffer[high_address] = 7
+    assert buffer[high_address] == 7
+    assert buffer[high_address + 1] == 0
+    assert len(buffer) == high_address + 1
+    # Only a single page should have been allocated:
+    assert buffer.get_num_bytes() < Buffer([0] * (2 * Buffer.page_size)).get_num_bytes()
+
+
+def test_buffer_absorbs_pages_when_growing():
+    buffer = Buffer([1])
+    buffer[Buffer.max_dense_gap + 10] = 5
+    buffer[Buffer.max_dense_gap] = 4
+    buffer[Buffer.max_dense_gap // 2] = 3
+    buffer[Buffer.max_dense_gap + 20] = 6
+    assert buffer[Buffer.max_dense_gap] == 4
+    assert buffer[Buffer.max_dense_gap + 10] == 5
+    assert buffer[Buffer.max_dense_gap + 20] == 6
+    assert buffer[Buffer.max_dense_gap // 2] == 3
+
+
+def test_buffer_invalid_keys():
+    buffer = Buffer([1, 2, 3])
+    with pytest.raises(TypeError):
+        buffer["a"] = 1
+    with pytest.raises(IndexError):
+        buffer[-1] = 1
+    with pytest.raises(IndexError):
+        buffer[-1]
+
+
+def test_buffer_equality():
+    assert Buffer([1, 2, 3]) == [1, 2]
+    assert Buffer([1, 2, 3]) != [1, 2, 3, 4]
+    assert Buffer([1, 2, 3]) != [1, 2, 4]
+    assert Buffer([1, 2, 3]) == Buffer([1, 2, 3])
+    assert Buffer([1, 2, 3]) != Buffer([1, 2])
+
+
+int64_min = -(1 << 63)
+int64_max = (1 << 63) - 1
+
+
+class Int64Buffer(Buffer):
+    """
+    Same as `Buffer` but the cells are stored as 64-bit integers in an `array`, which takes 8 bytes per cell instead
+    of a pointer plus an int object. The first value that doesn't fit in 64 bits promotes the whole buffer to a
+    list of Python ints, so results are exactly the same as with `Buffer`.
+    """
+
+    @staticmethod
+    def make_cells(values: Iterable[int]) -> MutableSequence[int]:
+        values = list(values)
+        try:
+            return array('q', values)
+        except OverflowError:
+            return values
+
+
+def test_int64_buffer_promotes_on_overflow():
+    buffer = Int64Buffer([1, 2, 3])
+    assert buffer.is_compact()
+    buffer[1] = int64_max
+    buffer[2] = int64_min
+    assert buffer.is_compact()
+    buffer[0] = int64_max + 1
+    assert not buffer.is_compact()
+    assert buffer == [int64_max + 1, int64_max, int64_min]
+    assert not Int64Buffer([2 ** 70]).is_compact()
+    assert not Buffer([1]).is_compact()
+
+
+@pytest.mark.parametrize("address", [10, 5000, 10 ** 12])
+def test_int64_buffer_promotes_on_overflow_past_the_end(address):
+    buffer = Int64Buffer([1, 2, 3])
+    buffer[address] = -2 ** 64
+    assert not buffer.is_compact()
+    assert buffer[address] == -2 ** 64
+    assert buffer[address + 1] == 0
+
+
+def test_int64_buffer_absorbs_pages_when_growing():
+    buffer = Int64Buffer([1, 2, 3])
+    far_address = 3 * Buffer.max_dense_gap
+    buffer[far_address] = -1
+    buffer[2 * Buffer.max_dense_gap] = -2
+    buffer[far_address - 1] = -3
+    assert buffer.is_compact()
+    assert buffer[far_address] == -1
+    assert buffer == Buffer(buffer.to_list())
+
+
+def test_int64_buffer_behaves_like_buffer():
+    int64_buffer = Int64Buffer(list(range(1000)))
+    buffer = Buffer(list(range(1000)))
+    for address, value in [(3, -3), (999, 1), (1000, 2), (70_000, 3), (200_000, 4)]:
+        int64_buffer[address] = value
+        buffer[address] = value
+    assert int64_buffer.is_compact()
+    assert int64_buffer == buffer
+    forked = int64_buffer.fork()
+    assert isinstance(forked, Int64Buffer) and forked.is_compact()
+    assert forked == buffer
+
+
+class PagedBuffer:
+    """
+    Same interface as `Buffer` but the cells are stored in fixed-size pages that forks of the buffer share.
+    Forking only copies the table of pages. A page is copied the first time a fork (or the original) writes to it,
+    so the cost of forking is paid in proportion to the pages that are actually touched afterwards.
+    `mapped_cells` are read-only 64-bit cells below the initial values (e.g. a memory-mapped image, see
+    `map_int64_values`). Their pages are only copied into the table the first time they're read or written.
+    """
+    page_bits = 8
+    page_size = 1 << page_bits
+    page_mask = page_size - 1
+
+    def __init__(self, initial_values: Iterable[int], mapped_cells: Optional[memoryview] = None):
+        self.__pages: Dict[int, List[int]] = {}
+        # Pages that belong to this buffer alone and can therefore be written in place:
+        self.__owned_pages: Set[int] = set()
+        self.__mapped_cells = mapped_cells
+        # Cut the values into pages as they come so that a stream of values is never held in full:
+        values = iter(initial_values)
+        self.__length = 0
+        while True:
+            page = list(itertools.islice(values, self.page_size))
+            if not page:
+                break
+            page_number = self.__length >> self.page_bits
+            self.__length += len(page)
+            page.extend([0] * (self.page_size - len(page)))
+            self.__pages[page_number] = page
+            self.__owned_pages.add(page_number)
+        if mapped_cells is not None:
+            self.__length = max(self.__length, len(mapped_cells))
+
+    def __check_key(self, key):
+        if not isinstance(key, int):
             raise TypeError(f"Key {key} is not an integer.")
+        if key < 0:
+            raise IndexError(f"Key {key} is a negative address.")
+
+    def __getitem__(self, key):
+        try:
+            return self.__pages[key >> self.page_bits][key & self.page_mask]
+        except KeyError:
+            self.__check_key(key)
+            page = self.__load_mapped_page(key >> self.page_bits)
+            return 0 if page is None else page[key & self.page_mask]
 
     def __setitem__(self, key, value):
-        if isinstance(key, int):
-            self.__buffer[key] = value
+        page_number = key >> self.page_bits
+        if page_number in self.__owned_pages:
+            self.__pages[page_number][key & self.page_mask] = value
+            if key >= self.__length:
+                self.__length = key + 1
         else:
-            raise TypeError(f"Key {key} is not an integer.")
+            self.__write_to_shared_or_missing_page(key, value)
+
+    def __write_to_shared_or_missing_page(self, key, value):
+        self.__check_key(key)
+        page_number = key >> self.page_bits
+        shared_page = self.__pages.get(page_number)
+        if shared_page is not None:
+            page = shared_page.copy()
+        else:
+            page = self.__load_mapped_page(page_number) or [0] * self.page_size
+        page[key & self.page_mask] = value
+        self.__pages[page_number] = page
+        self.__owned_pages.add(page_number)
+        self.__length = max(self.__length, key + 1)
+
+    def __read_mapped_page(self, page_number: int) -> Optional[List[int]]:
+        mapped_cells = self.__mapped_cells
+        start = page_number << self.page_bits
+        if mapped_cells is None or start >= len(mapped_cells):
+            return None
+        page = mapped_cells[start:start + self.page_size].tolist()
+        page.extend([0] * (self.page_size - len(page)))
+        return page
+
+    def __load_mapped_page(self, page_number: int) -> Optional[List[int]]:
+        """Copy a page of `mapped_cells` into the table, owned by this buffer. None if they don't cover it."""
+        page = self.__read_mapped_page(page_number)
+        if page is not None:
+            self.__pages[page_number] = page
+            self.__owned_pages.add(page_number)
+        return page
 
     def __len__(self):
-        return max(self.__buffer.keys())
+        """One past the highest address that has been written to."""
+        return self.__length
+
+    def get_length(self) -> int:
+        """Same as `len` but also works past `sys.maxsize`, which addresses can go beyond."""
+        return self.__length
+
+    def to_list(self) -> List[int]:
+        return [self[index] for index in range(self.__length)]
+
+    def get_num_bytes(self) -> int:
+        """Number of bytes held by the pages owned by this buffer and its page table."""
+        return sys.getsizeof(self.__pages) + sum(
+            sys.getsizeof(self.__pages[page_number]) for page_number in self.__owned_pages)
+
+    def get_segments(self) -> List[Tuple[int, List[int]]]:
+        """
+        (start address, cells) for every page, in order of address and cut off at `len(self)`.
+        Mapped pages that haven't been loaded are read for the occasion but not kept.
+        """
+        page_numbers = set(self.__pages.keys())
+        if self.__mapped_cells is not None:
+            page_numbers.update(range((len(self.__mapped_cells) + self.page_mask) >> self.page_bits))
+        segments = []
+        for page_number in sorted(page_numbers):
+            page = self.__pages.get(page_number)
+            if page is None:
+                page = self.__read_mapped_page(page_number)
+                if page is None:
+                    continue
+            segments.append((page_number << self.page_bits, page[:self.__length - (page_number << self.page_bits)]))
+        return segments
+
+    def fork(self) -> "PagedBuffer":
+        forked = PagedBuffer([], self.__mapped_cells)
+        forked.__pages = self.__pages.copy()
+        forked.__length = self.__length
+        # Every page is now shared so neither buffer may write to them in place anymore:
+        self.__owned_pages = set()
+        return forked
 
     def __eq__(self, other):
         if isinstance(other, list):
-            for index, other_value in enumerate(other):
-                if index in self.__buffer:
-                    if self.__retrieve(index) != other_value:
-                        return False
-                else:
-                    return False
-            else:
-                return True
-        elif isinstance(other, Buffer):
-            return self.__buffer == other.__buffer
+            return len(other) <= self.__length and all(
+                self[index] == other_value for index, other_value in enumerate(other))
+        elif isinstance(other, (Buffer, PagedBuffer)):
+            return self.__length == len(other) and self.to_list() == other.to_list()
+        else:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"PagedBuffer(length={self.__length}, pages={sorted(self.__pages.keys())})"
+
+
+def test_paged_buffer_behaves_like_buffer():
+    paged_buffer = PagedBuffer(list(range(1000)))
+    buffer = Buffer(list(range(1000)))
+    for address, value in [(3, -3), (999, 1), (1000, 2), (5000, 3), (10 ** 12, 4)]:
+        paged_buffer[address] = value
+        buffer[address] = value
+    for address in [0, 3, 500, 999, 1000, 1001, 4999, 5000, 10 ** 12, 10 ** 12 + 1]:
+        assert paged_buffer[address] == buffer[address]
+    assert len(paged_buffer) == len(buffer)
+    assert paged_buffer == list(range(3)) + [-3]
+    with pytest.raises(IndexError):
+        paged_buffer[-1]
+    with pytest.raises(TypeError):
+        paged_buffer["a"] = 1
+
+
+def test_paged_buffer_fork_copies_on_write():
+    original = PagedBuffer(list(range(4 * PagedBuffer.page_size)))
+    forked = original.fork()
+    assert forked == original
+    forked[0] = -1
+    original[PagedBuffer.page_size] = -2
+    assert original[0] == 0
+    assert forked[0] == -1
+    assert original[PagedBuffer.page_size] == -2
+    assert forked[PagedBuffer.page_size] == PagedBuffer.page_size
+    # Each side has only copied the single page it wrote to:
+    assert forked.get_num_bytes() < PagedBuffer(list(range(2 * PagedBuffer.page_size))).get_num_bytes()
+
+
+@pytest.mark.parametrize("buffer_type", [Buffer, Int64Buffer, PagedBuffer])
+def test_buffer_get_segments(buffer_type):
+    buffer = buffer_type(list(range(300)))
+    buffer[10 ** 12 + 1] = 7
+    segments = buffer.get_segments()
+    assert segments[0][0] == 0
+    assert [value for start, cells in segments if start < 300 for value in cells][:300] == list(range(300))
+    assert segments[-1][0] + len(segments[-1][1]) == len(buffer) == 10 ** 12 + 2
+    assert segments[-1][1][-2:] == [0, 7]
+
+
+def test_buffer_fork():
+    original = Buffer([1, 2, 3])
+    forked = original.fork()
+    forked[0] = 4
+    forked[10 ** 12] = 5
+    assert original == [1, 2, 3]
+    assert original[10 ** 12] == 0
+    assert forked == [4, 2, 3]
+    assert forked[10 ** 12] == 5
+
+
+# Part of the key of every cached program. Bump it whenever the parsed form of programs changes so that entries
+# written by older versions are ignored:
+engine_version = 3
+
+# Programs are only cached when a directory is given, e.g. `~/.cache/intcode`:
+default_cache_directory = os.environ.get("INTCODE_CACHE_DIR")
+
+# A cache entry starts with its kind and the number of values, padded so that 64-bit cells after it can be mapped
+# in place:
+cache_header_format = "<c7xq"
+cache_header_size = struct.calcsize(cache_header_format)
+
+
+def read_first_line_in_chunks(path: str, chunk_size: int = 1 << 20) -> Iterator[str]:
+    """The first line of `path`, without surrounding whitespace, in pieces of at most `chunk_size` characters."""
+    with open(path) as f:
+        started = False
+        # Whitespace that is only part of the line if something other than whitespace follows it:
+        pending = ""
+        while True:
+            data = f.read(chunk_size)
+            chunk, newline, _ = data.partition("\n")
+            if not started:
+                chunk = chunk.lstrip()
+                started = len(chunk) > 0
+            text = pending + chunk
+            stripped = text.rstrip()
+            pending = text[len(stripped):]
+            if stripped:
+                yield stripped
+            if newline or not data:
+                return
+
+
+def read_values_in_chunks(path: str, chunk_size: int = 1 << 20) -> Iterator[int]:
+    """Parse the program on the first line of `path` without ever holding all of its source (or values) at once."""
+    partial = ""
+    for chunk in read_first_line_in_chunks(path, chunk_size):
+        tokens = (partial + chunk).split(',')
+        partial = tokens.pop()
+        yield from map(int, tokens)
+    yield int(partial)
+
+
+def test_read_values_in_chunks(tmp_path):
+    path = str(tmp_path / "input.txt")
+    with open(path, "w") as f:
+        f.write("  1002,4,3,4, -33 , 99   \n1,2,3")
+    for chunk_size in [1, 2, 3, 7, 100]:
+        assert list(read_values_in_chunks(path, chunk_size)) == [1002, 4, 3, 4, -33, 99]
+        assert "".join(read_first_line_in_chunks(path, chunk_size)) == "1002,4,3,4, -33 , 99"
+
+
+def map_int64_values(path: str, offset: int = 0) -> memoryview:
+    """
+    The 64-bit integers (in native byte order) that fill `path` after `offset` bytes. The file is mapped into
+    memory rather than read, so only the parts that are used take up memory and the OS can share them.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset:].cast('q')
+
+
+def convert_to_int64_image(source_path: str, image_path: str, chunk_size: int = 1 << 16):
+    """
+    Write the program in `source_path` to `image_path` as raw 64-bit integers for `ProgramImage.from_int64_file`,
+    `chunk_size` values at a time. Raise `OverflowError` if a value doesn't fit in 64 bits.
+    """
+    values = read_values_in_chunks(source_path)
+    with open(image_path, "wb") as f:
+        while True:
+            chunk = array('q', itertools.islice(values, chunk_size))
+            if len(chunk) == 0:
+                break
+            chunk.tofile(f)
+
+
+def get_source_digest(chunks: Iterable[str]) -> str:
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk.encode("ascii"))
+    return digest.hexdigest()
+
+
+def get_cache_path(source_digest: str, cache_directory: str) -> str:
+    return os.path.join(cache_directory, f"{source_digest}-v{engine_version}.bin")
+
+
+def load_cached_values(path: str) -> Optional[Union[memoryview, List[int]]]:
+    """The values in a cache entry (mapped if they're 64-bit cells) or None if there's no usable entry."""
+    try:
+        with open(path, "rb") as f:
+            kind, num_values = struct.unpack(cache_header_format, f.read(cache_header_size))
+            if kind == b"m":
+                values = marshal.loads(f.read())
+                if (isinstance(values, list) and len(values) == num_values
+                        and all(type(value) is int for value in values)):
+                    return values
+                return None
+        if kind == b"q":
+            mapped = map_int64_values(path, cache_header_size)
+            if len(mapped) == num_values:
+                return mapped
+    except (OSError, ValueError, EOFError, TypeError, struct.error):
+        pass
+    return None
+
+
+def write_cached_values(path: str, values: List[int]):
+    """Raw 64-bit integers if every value fits, otherwise marshal. Failing to write the cache isn't an error."""
+    try:
+        data = struct.pack(cache_header_format, b"q", len(values)) + array('q', values).tobytes()
+    except OverflowError:
+        data = struct.pack(cache_header_format, b"m", len(values)) + marshal.dumps(values)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except OSError:
+        pass
+
+
+class ProgramImage:
+    """
+    A program that has been parsed once and can then start any number of machines.
+    Machines spawned from the image share its cells and only copy the pages they write to.
+    """
+
+    def __init__(self, values: Union[Iterable[int], memoryview]):
+        """
+        `values` are consumed as they're cut into pages, so they can be streamed (see `read_values_in_chunks`).
+        A `memoryview` of 64-bit cells (see `map_int64_values`) isn't copied at all: every machine copies the
+        pages it uses out of it.
+        """
+        # Never written to, only forked:
+        if isinstance(values, memoryview):
+            self.__base = PagedBuffer((), values)
+        else:
+            self.__base = PagedBuffer(values)
+        # Only made the first time a machine needs a flat copy of the program:
+        self.__values: Optional[Tuple[int, ...]] = None
+
+    @classmethod
+    def from_source_code(cls, source_code: str) -> "ProgramImage":
+        return cls(int(x) for x in source_code.split(','))
+
+    @classmethod
+    def from_file(cls, path: str, cache_directory: Optional[str] = default_cache_directory) -> "ProgramImage":
+        """
+        The program on the first line of `path`, parsed in chunks. If `cache_directory` is given (by default
+        $INTCODE_CACHE_DIR, if it is set), the parsed values are cached there, keyed by a hash of the source and
+        `engine_version`.
+        Entries of 64-bit values are mapped into memory instead of being read.
+        """
+        if cache_directory is None:
+            return cls(read_values_in_chunks(path))
+        cache_path = get_cache_path(get_source_digest(read_first_line_in_chunks(path)), cache_directory)
+        values = load_cached_values(cache_path)
+        if values is None:
+            values = list(read_values_in_chunks(path))
+            write_cached_values(cache_path, values)
+        return cls(values)
+
+    @classmethod
+    def from_int64_file(cls, path: str) -> "ProgramImage":
+        """The program in a file written by `convert_to_int64_image`, mapped into memory."""
+        return cls(map_int64_values(path))
+
+    def __len__(self):
+        return len(self.__base)
+
+    def __get_values(self) -> Tuple[int, ...]:
+        if self.__values is None:
+            self.__values = tuple(value for _, cells in self.__base.get_segments() for value in cells)
+        return self.__values
+
+    def to_list(self) -> List[int]:
+        return list(self.__get_values())
+
+    def create_buffer(self, buffer_type=PagedBuffer, patches: Optional[Dict[int, int]] = None):
+        """
+        A fresh memory holding the program: an overlay on the image (`PagedBuffer`) or a full copy (`Buffer`, or
+        even `list`). `patches` (address -> value) are written on top. An overlay only copies the pages they touch.
+        """
+        if buffer_type is PagedBuffer:
+            buffer = self.__base.fork()
+        else:
+            buffer = buffer_type(list(self.__get_values()))
+        apply_patches(buffer, patches)
+        return buffer
+
+    def spawn(self, decode=decode_instruction, patches: Optional[Dict[int, int]] = None) -> "Machine":
+        return Machine(self, decode, patches=patches)
+
+
+def apply_patches(buffer, patches: Optional[Dict[int, int]]):
+    if patches is not None:
+        for address, value in patches.items():
+            buffer[address] = value
+
+
+def test_program_image_spawns_independent_machines():
+    image = ProgramImage.from_source_code("3,100,1,100,101,101,4,101,1105,1,0")
+    first = image.spawn()
+    second = image.spawn()
+    assert first.run([1, 2]) == [1, 3]
+    assert second.run([5]) == [5]
+    assert image.spawn().run([7]) == [7]
+    assert image.create_buffer() == image.to_list()
+    assert image.create_buffer(Buffer) == image.to_list()
+    assert len(image) == 11
+
+
+def test_program_image_from_file(tmp_path, monkeypatch):
+    program_path = str(tmp_path / "input.txt")
+    with open(program_path, "w") as f:
+        f.write(large_program + "\n")
+    cache_directory = str(tmp_path / "cache")
+    image = ProgramImage.from_file(program_path, cache_directory)
+    assert image.to_list() == ProgramImage.from_source_code(large_program).to_list()
+    cache_path = get_cache_path(get_source_digest([large_program]), cache_directory)
+    assert os.path.getsize(cache_path) == cache_header_size + 8 * len(image)
+    # The second time around the values come from the cache:
+    write_cached_values(cache_path, [104, 7, 99])
+    assert ProgramImage.from_file(program_path, cache_directory).spawn().run() == [7]
+    assert ProgramImage.from_file(program_path, None).spawn().run([8]) == [1000]
+    # A new engine version doesn't use the old entry:
+    monkeypatch.setattr(sys.modules[__name__], "engine_version", engine_version + 1)
+    assert ProgramImage.from_file(program_path, cache_directory).spawn().run([8]) == [1000]
+    assert len(os.listdir(cache_directory)) == 2
+
+
+def test_program_image_from_file_with_big_values(tmp_path):
+    program_path = str(tmp_path / "input.txt")
+    with open(program_path, "w") as f:
+        f.write(f"104,{2 ** 70},99")
+    cache_directory = str(tmp_path / "cache")
+    for _ in range(2):
+        assert ProgramImage.from_file(program_path, cache_directory).spawn().run() == [2 ** 70]
+    # A broken entry is parsed again:
+    cache_path = get_cache_path(get_source_digest([f"104,{2 ** 70},99"]), cache_directory)
+    broken_entries = [
+        b"m",
+        struct.pack(cache_header_format, b"m", 3) + b"\0",
+        struct.pack(cache_header_format, b"q", 0) + b"\0" * 3,
+        # Values that aren't a list of ints, or not as many as the header says:
+        struct.pack(cache_header_format, b"m", 3) + marshal.dumps("104,7,99"),
+        struct.pack(cache_header_format, b"m", 3) + marshal.dumps([104, "7", 99]),
+        struct.pack(cache_header_format, b"m", 4) + marshal.dumps([104, 7, 99]),
+        struct.pack(cache_header_format, b"q", 4) + array('q', [104, 7, 99]).tobytes(),
+    ]
+    for data in broken_entries:
+        with open(cache_path, "wb") as f:
+            f.write(data)
+        assert ProgramImage.from_file(program_path, cache_directory).spawn().run() == [2 ** 70]
+
+
+def test_program_image_from_int64_file(tmp_path):
+    source_path = str(tmp_path / "input.txt")
+    values = [int(x) for x in large_program.split(',')] + [0] * 1000 + [7]
+    with open(source_path, "w") as f:
+        f.write(",".join(str(x) for x in values))
+    image_path = str(tmp_path / "input.bin")
+    convert_to_int64_image(source_path, image_path, chunk_size=10)
+    image = ProgramImage.from_int64_file(image_path)
+    assert len(image) == len(values)
+    assert image.to_list() == values
+    assert image.create_buffer(Buffer) == values
+    assert image.spawn().run([8]) == [1000]
+    machine = image.spawn(patches={len(values) - 1: 8})
+    assert machine.memory[len(values) - 1] == 8
+    assert machine.memory[len(values)] == 0
+    # Only the pages that the run touched have been copied out of the file:
+    assert machine.memory.get_num_bytes() < PagedBuffer(values[:3 * PagedBuffer.page_size]).get_num_bytes()
+    assert image.spawn().memory == values
+    with open(source_path, "w") as f:
+        f.write(f"104,{2 ** 63},99")
+    with pytest.raises(OverflowError):
+        convert_to_int64_image(source_path, image_path)
+
+
+def test_paged_buffer_with_mapped_cells():
+    mapped_cells = memoryview(array('q', range(3 * PagedBuffer.page_size)))
+    buffer = PagedBuffer([], mapped_cells)
+    assert len(buffer) == 3 * PagedBuffer.page_size
+    assert buffer.get_num_bytes() == PagedBuffer([]).get_num_bytes()
+    forked = buffer.fork()
+    buffer[1] = -1
+    assert buffer[1] == -1 and buffer[2] == 2
+    assert forked[1] == 1
+    assert forked[3 * PagedBuffer.page_size] == 0
+    forked[5 * PagedBuffer.page_size] = 5
+    assert forked == list(range(3 * PagedBuffer.page_size)) + [0] * 2 * PagedBuffer.page_size + [5]
+    assert [start for start, _ in forked.get_segments()] == [0, 256, 512, 1280]
+    assert mapped_cells.tolist() == list(range(3 * PagedBuffer.page_size))
+
+
+def test_program_image_patches():
+    image = ProgramImage.from_source_code("1,0,0,0,99")
+    assert image.spawn(patches={1: 4, 2: 4}).run() == []
+    machine = image.spawn(patches={1: 4, 2: 4})
+    machine.run()
+    assert machine.memory == [198, 4, 4, 0, 99]
+    # The image isn't changed:
+    assert image.to_list() == [1, 0, 0, 0, 99]
+    assert image.create_buffer(list, {0: 2}) == [2, 0, 0, 0, 99]
+    assert image.create_buffer(Buffer, {1000: 7})[1000] == 7
+    source_machine = Machine("1,0,0,0,99", patches={1: 4, 2: 4})
+    source_machine.run()
+    assert source_machine.memory == machine.memory.to_list()
 
 
 def read_value_from_buffer(buffer: Buffer, operand: int, mode: Mode, relative_base: int) -> int:
@@ -171,100 +963,896 @@ def shift_if_in_relative_mode(value: int, relative_base: int, mode: Mode) -> int
     return value + relative_base if mode == Mode.RELATIVE else value
 
 
-def compile_source_code(source_code: str):
-    buffer = Buffer([int(x) for x in source_code.split(',')])
-    index = 0
-    should_continue = True
-    relative_base = 0
-    while(should_continue):
-        op_code, num_operands, modes = parse_instruction(buffer[index])
-        if op_code == Op_Code.ADD:
-            operand_1 = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            operand_2 = read_value_from_buffer(
-                buffer, buffer[index + 2], modes[1], relative_base)
-            operand_3 = shift_if_in_relative_mode(
-                buffer[index + 3], relative_base, modes[2])
-            result = operand_1 + operand_2
-            buffer[operand_3] = result
-            index += num_operands + 1
-        elif op_code == Op_Code.MULTIPLY:
-            operand_1 = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            operand_2 = read_value_from_buffer(
-                buffer, buffer[index + 2], modes[1], relative_base)
-            operand_3 = shift_if_in_relative_mode(
-                buffer[index + 3], relative_base, modes[2])
-            result = operand_1 * operand_2
-            buffer[operand_3] = result
-            index += num_operands + 1
-        elif op_code == Op_Code.INPUT:
-            operand = shift_if_in_relative_mode(
-                buffer[index + 1], relative_base, modes[0])
-            input_from_user = yield ProgramMessage(type=MessageType.GET_INPUT, arg="Enter a number: ")
-            result = int(input_from_user)
-            buffer[operand] = result
-            index += num_operands + 1
-        elif op_code == Op_Code.OUTPUT:
-            operand = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            index += num_operands + 1
-            yield ProgramMessage(type=MessageType.PRINT_OUTPUT, arg=operand)
-        elif op_code == Op_Code.JUMP_IF_TRUE:
-            operand_1 = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            operand_2 = read_value_from_buffer(
-                buffer, buffer[index + 2], modes[1], relative_base)
-            if operand_1 != 0:
-                index = operand_2
-            else:
-                index += num_operands + 1
-        elif op_code == Op_Code.JUMP_IF_FALSE:
-            operand_1 = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            operand_2 = read_value_from_buffer(
-                buffer, buffer[index + 2], modes[1], relative_base)
-            if operand_1 == 0:
-                index = operand_2
-            else:
-                index += num_operands + 1
-        elif op_code == Op_Code.LESS_THAN:
-            operand_1 = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            operand_2 = read_value_from_buffer(
-                buffer, buffer[index + 2], modes[1], relative_base)
-            operand_3 = shift_if_in_relative_mode(
-                buffer[index + 3], relative_base, modes[2])
-            if operand_1 < operand_2:
-                buffer[operand_3] = 1
-            else:
-                buffer[operand_3] = 0
-            index += num_operands + 1
-        elif op_code == Op_Code.EQUALS:
-            operand_1 = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            operand_2 = read_value_from_buffer(
-                buffer, buffer[index + 2], modes[1], relative_base)
-            operand_3 = shift_if_in_relative_mode(
-                buffer[index + 3], relative_base, modes[2])
-            if operand_1 == operand_2:
-                buffer[operand_3] = 1
+input_prompt = "Enter a number: "
+
+
+@unique
+class MachineStatus(Enum):
+    RUNNING = auto()
+    WAITING_FOR_INPUT = auto()
+    TERMINATED = auto()
+
+
+class Profile:
+    """
+    Execution statistics collected by a machine whose `profile` attribute is set to an instance of this class.
+    Memory reads include fetching the instruction and its operands.
+    """
+
+    def __init__(self):
+        self.op_code_counts: typing.Counter[Op_Code] = Counter()
+        self.address_counts: typing.Counter[int] = Counter()
+        self.num_instructions = 0
+        self.num_memory_reads = 0
+        self.num_memory_writes = 0
+        self.elapsed_seconds = 0.0
+
+    def record(self, index: int, instruction: Instruction):
+        op_code, num_operands, modes = instruction
+        self.op_code_counts[op_code] += 1
+        self.address_counts[index] += 1
+        self.num_instructions += 1
+        num_writes = 1 if op_code in op_codes_that_write else 0
+        # The instruction word, its operands, then whatever the operands that aren't written to point at:
+        self.num_memory_reads += 1 + num_operands + sum(
+            1 for mode in modes[:num_operands - num_writes] if mode != Mode.IMMEDIATE)
+        self.num_memory_writes += num_writes
+
+    def get_instructions_per_second(self) -> float:
+        return self.num_instructions / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+    def get_hottest_addresses(self, num_addresses: int) -> List[Tuple[int, int]]:
+        """The `num_addresses` most executed instruction addresses and how often each ran, hottest first."""
+        return self.address_counts.most_common(num_addresses)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "num_instructions": self.num_instructions,
+            "elapsed_seconds": self.elapsed_seconds,
+            "instructions_per_second": self.get_instructions_per_second(),
+            "num_memory_reads": self.num_memory_reads,
+            "num_memory_writes": self.num_memory_writes,
+            "op_code_counts": {op_code.name: count for op_code, count in self.op_code_counts.most_common()},
+            "address_counts": self.address_counts.most_common(),
+        })
+
+
+op_codes_that_write = {Op_Code.ADD, Op_Code.MULTIPLY, Op_Code.INPUT, Op_Code.LESS_THAN, Op_Code.EQUALS}
+
+
+# Set a machine's `limits` to one of these to stop a run that takes too long or grows its memory too much.
+# `None` means no limit. Instructions and seconds add up over every `run` of the machine:
+Limits = namedtuple("Limits", ["max_instructions", "max_memory_cells", "max_seconds"], defaults=[None, None, None])
+
+# Limits are checked after every block of this many instructions rather than after every instruction:
+limit_check_interval = 10_000
+
+
+@unique
+class StopReason(Enum):
+    INPUT_REQUESTED = auto()
+    TERMINATED = auto()
+    NUM_OUTPUTS = auto()
+    BREAKPOINT = auto()
+    CELL_CHANGED = auto()
+
+
+# What `Machine.run_until` waits for, besides the program asking for input that it doesn't have or terminating.
+# `num_outputs`: that many outputs have been produced. `breakpoints`: the instruction pointer has got to one of these
+# addresses (it stops before running that instruction). `watched_addresses`: an instruction has just changed the
+# value of one of these cells:
+StopWhen = namedtuple("StopWhen", ["num_outputs", "breakpoints", "watched_addresses"], defaults=[None, (), ()])
+
+
+class LimitExceeded(RuntimeError):
+    """
+    Raised by `Machine.run` when the machine goes over one of its `limits`. The machine is left exactly where it
+    stopped (still `RUNNING`), so it can be inspected or resumed by raising its limits and calling `run` again.
+    """
+
+    def __init__(self, limit: str, machine: "Machine", outputs: List[int]):
+        super().__init__(
+            f"Machine went over {limit}={getattr(machine.limits, limit)} at instruction pointer {machine.index}")
+        self.limit = limit
+        self.machine = machine
+        # The outputs of the interrupted run, which `run` would otherwise have returned:
+        self.outputs = outputs
+        self.num_instructions = machine.num_instructions_executed
+
+
+# `operands` are the values that the instruction read and, for the operand that it writes to, the address:
+TraceEntry = namedtuple("TraceEntry", ["index", "op_code", "operands", "relative_base"])
+
+
+def read_trace_entry(machine: "Machine") -> TraceEntry:
+    """The instruction that `machine` is about to execute."""
+    index, relative_base = machine.index, machine.relative_base
+    try:
+        op_code, num_operands, modes = machine.decode(machine.read_memory(index))
+    except (KeyError, ValueError, IndexError):
+        return TraceEntry(index, None, (), relative_base)
+    num_writes = 1 if op_code in op_codes_that_write else 0
+    operands: List[Optional[int]] = []
+    for position in range(num_operands):
+        address = shift_if_in_relative_mode(machine.read_memory(index + 1 + position), relative_base, modes[position])
+        if position >= num_operands - num_writes or modes[position] == Mode.IMMEDIATE:
+            operands.append(address)
+        else:
+            try:
+                operands.append(machine.read_memory(address))
+            except IndexError:
+                operands.append(None)
+    return TraceEntry(index, op_code, tuple(operands), relative_base)
+
+
+class Trace:
+    """
+    Set a machine's `trace` to one of these to get the last `num_entries` instructions it executed, which are
+    written to `file` whenever `run` raises.
+    Recording every instruction would slow execution down a lot, so instead the machine snapshots itself (with
+    `fork`) every `snapshot_interval` instructions and the entries are rebuilt by re-running from the older of the
+    last two snapshots when they're needed. That has some limits:
+    - A trace belongs to one machine. Forks don't get it.
+    - Each snapshot of a machine with a plain `Buffer` copies the whole memory. Use a `PagedBuffer` (e.g. start
+      the machine from a `ProgramImage`) to trace a machine with a large memory.
+    - Inputs queued up between runs are replayed. Other changes between runs (`write_memory`, moving the
+      instruction pointer or the relative base, taking pending inputs away) can't be, so the trace starts over from
+      there and the instructions before them are lost. Writes to `memory` that bypass `write_memory` aren't noticed
+      at all and make the entries before them wrong.
+    """
+
+    def __init__(self, num_entries: int = 50, file: TextIO = sys.stderr):
+        self.num_entries = num_entries
+        self.file = file
+        self.snapshot_interval = max(num_entries, limit_check_interval)
+        # [snapshot, number of instructions executed since it was taken], oldest first:
+        self.snapshots: Deque[list] = deque(maxlen=2)
+        # Where the machine was at the end of the last run and the inputs that were still pending:
+        self.last_position: Optional[Tuple[int, int]] = None
+        self.pending_inputs: List[int] = []
+        # Filled in when the trace is dumped:
+        self.entries: List[TraceEntry] = []
+
+    def reset(self):
+        """Forget the snapshots, so that the trace starts over from the next instruction."""
+        self.snapshots.clear()
+
+    def catch_up(self, machine: "Machine"):
+        """Hand the inputs that were queued up between runs to the snapshots too, or start over."""
+        inputs = list(machine.inputs)
+        num_pending = len(self.pending_inputs)
+        if (machine.index, machine.relative_base) != self.last_position or inputs[:num_pending] != self.pending_inputs:
+            self.reset()
+            return
+        for snapshot, _ in self.snapshots:
+            snapshot.inputs.extend(inputs[num_pending:])
+
+    def remember(self, machine: "Machine"):
+        """Called at the end of a run, so that `catch_up` can tell what changed before the next one."""
+        self.last_position = (machine.index, machine.relative_base)
+        self.pending_inputs = list(machine.inputs)
+
+    def get_block_size(self, machine: "Machine") -> int:
+        """Take a snapshot if one is due. Return how many instructions can run before the next one is."""
+        if len(self.snapshots) == 0 or self.snapshots[-1][1] >= self.snapshot_interval:
+            self.snapshots.append([machine.fork(), 0])
+        return self.snapshot_interval - self.snapshots[-1][1]
+
+    def count(self, num_instructions: int):
+        for snapshot in self.snapshots:
+            snapshot[1] += num_instructions
+
+    def get_entries(self, failed: bool = False) -> List[TraceEntry]:
+        """
+        The last `num_entries` instructions, oldest first. `failed` means that the machine raised somewhere after
+        the instructions that were counted, in which case the last entry is the instruction that raised.
+        """
+        if len(self.snapshots) == 0:
+            return []
+        snapshot, num_instructions = self.snapshots[0]
+        machine = snapshot.fork()
+        entries: Deque[TraceEntry] = deque(maxlen=self.num_entries)
+        outputs: List[int] = []
+        for _ in range(num_instructions + (self.snapshot_interval if failed else 0)):
+            entry = read_trace_entry(machine)
+            try:
+                num_executed = machine.execute(outputs, None, 1)
+            except Exception:
+                entries.append(entry)
+                break
+            if num_executed == 0:
+                break
+            entries.append(entry)
+        return list(entries)
+
+    def dump(self, failed: bool):
+        self.entries = self.get_entries(failed)
+        print(self.format(), file=self.file)
+
+    def format(self) -> str:
+        lines = [f"Last {len(self.entries)} instructions executed, oldest first:"]
+        for index, op_code, operands, relative_base in self.entries:
+            name = "?" if op_code is None else op_code.name
+            operand_list = ", ".join(str(operand) for operand in operands)
+            lines.append(f"{index:>10}  {name:<20}  {operand_list:<40}  relative base {relative_base}")
+        return "\n".join(lines)
+
+
+class Machine:
+    """
+    A program together with its execution state.
+    `run` feeds it a batch of inputs and executes until it needs more input than it has or terminates.
+    Set `profile` to a `Profile` to collect execution statistics (which makes execution a lot slower).
+    Set `limits` to `Limits` to make `run` raise `LimitExceeded` when the program goes over them.
+    Set `trace` to a `Trace` to see the last instructions executed when `run` raises.
+    """
+    # False for engines whose `execute` ignores `breakpoints` and `watched_addresses`, so `run_until` steps them:
+    checks_stop_conditions = True
+
+    def __init__(self, program: Union[str, ProgramImage], decode=decode_instruction, buffer_type=None,
+                 patches: Optional[Dict[int, int]] = None):
+        """
+        `program` is either source code or a `ProgramImage`.
+        `buffer_type` is either `Buffer` or `PagedBuffer` (which makes `fork` much cheaper for large programs).
+        It defaults to `Buffer` for source code and to `PagedBuffer` (an overlay on the shared image) for an image.
+        `patches` (address -> value) are written to memory before anything runs, e.g. a puzzle's noun and verb.
+        """
+        if isinstance(program, ProgramImage):
+            self.memory = program.create_buffer(buffer_type or PagedBuffer, patches)
+        else:
+            self.memory = (buffer_type or Buffer)([int(x) for x in program.split(',')])
+            apply_patches(self.memory, patches)
+        self.index = 0
+        self.relative_base = 0
+        self.inputs: Deque[int] = deque()
+        self.status = MachineStatus.RUNNING
+        self.decode = decode
+        self.profile: Optional[Profile] = None
+        self.limits: Optional[Limits] = None
+        self.trace: Optional[Trace] = None
+        # Only counted while `limits` or `trace` is set:
+        self.num_instructions_executed = 0
+        self.seconds_executed = 0.0
+        self.breakpoints: FrozenSet[int] = frozenset()
+        self.watched_addresses: FrozenSet[int] = frozenset()
+        # Why the last `run_until` stopped:
+        self.stop_reason: Optional[StopReason] = None
+
+    def run(self, inputs: Iterable[int] = (), max_outputs: Optional[int] = None) -> List[int]:
+        """
+        Queue up `inputs` and execute until the program asks for input when there's none left, terminates or
+        (if `max_outputs` is given) has produced that many outputs. Return the outputs produced along the way.
+        """
+        self.inputs.extend(inputs)
+        outputs: List[int] = []
+        self.stop_reason = None
+        if self.status != MachineStatus.TERMINATED:
+            self.status = MachineStatus.RUNNING
+            self.execute_with_settings(outputs, max_outputs)
+        return outputs
+
+    def run_until(self, stop_when: StopWhen, inputs: Iterable[int] = ()) -> List[int]:
+        """
+        Same as `run` but also stop as soon as one of the conditions in `stop_when` holds, which the engine checks
+        as it executes. Return the outputs produced along the way and set `stop_reason` to why the run stopped.
+        Running again carries on from there, so a breakpoint that has been hit doesn't stop the next run right away.
+        """
+        if not (stop_when.breakpoints or stop_when.watched_addresses):
+            outputs = self.run(inputs, stop_when.num_outputs)
+        else:
+            self.breakpoints = frozenset(stop_when.breakpoints)
+            self.watched_addresses = frozenset(stop_when.watched_addresses)
+            try:
+                if self.checks_stop_conditions:
+                    outputs = self.run(inputs, stop_when.num_outputs)
+                else:
+                    outputs = self.step_until(stop_when, inputs)
+            finally:
+                self.breakpoints = frozenset()
+                self.watched_addresses = frozenset()
+        if self.stop_reason is None:
+            if self.status == MachineStatus.TERMINATED:
+                self.stop_reason = StopReason.TERMINATED
+            elif self.status == MachineStatus.WAITING_FOR_INPUT:
+                self.stop_reason = StopReason.INPUT_REQUESTED
             else:
-                buffer[operand_3] = 0
-            index += num_operands + 1
-        elif op_code == Op_Code.ADJUST_RELATIVE_BASE:
-            operand = read_value_from_buffer(
-                buffer, buffer[index + 1], modes[0], relative_base)
-            relative_base += operand
-            index += num_operands + 1
-        elif op_code == Op_Code.TERMINATE:
-            should_continue = False
-            index += num_operands + 1
-            yield ProgramMessage(type=MessageType.TERMINATE, arg=buffer)
-
-
-def run_with_input_output(source_code, get_user_input, print_output):
-    program = compile_source_code(source_code)
+                self.stop_reason = StopReason.NUM_OUTPUTS
+        return outputs
+
+    def step_until(self, stop_when: StopWhen, inputs: Iterable[int]) -> List[int]:
+        """`run_until` one instruction at a time, checking the conditions in between (without `limits`)."""
+        self.inputs.extend(inputs)
+        outputs: List[int] = []
+        self.stop_reason = None
+        watched_values = {address: self.read_memory(address) for address in self.watched_addresses}
+        if self.status != MachineStatus.TERMINATED:
+            self.status = MachineStatus.RUNNING
+        while self.status == MachineStatus.RUNNING and len(outputs) != stop_when.num_outputs:
+            self.execute(outputs, stop_when.num_outputs, 1)
+            if self.status != MachineStatus.RUNNING:
+                break
+            if any(self.read_memory(address) != value for address, value in watched_values.items()):
+                self.stop_reason = StopReason.CELL_CHANGED
+                break
+            if self.index in self.breakpoints:
+                self.stop_reason = StopReason.BREAKPOINT
+                break
+        return outputs
+
+    def read_memory(self, address: int) -> int:
+        return self.memory[address]
+
+    def write_memory(self, address: int, value: int):
+        self.memory[address] = value
+        if self.trace is not None:
+            self.trace.reset()
+
+    def execute_with_settings(self, outputs: List[int], max_outputs: Optional[int],
+                              max_instructions: int = sys.maxsize) -> int:
+        """
+        Same as `execute` but honouring whichever of `limits`, `trace` and `profile` are set, in any combination.
+        Return the number of instructions executed.
+        """
+        if self.limits is not None or self.trace is not None:
+            return self.execute_in_blocks(outputs, max_outputs, max_instructions)
+        elif self.profile is not None:
+            return self.execute_profiled(outputs, max_outputs, self.profile, max_instructions)
+        else:
+            return self.execute(outputs, max_outputs, max_instructions)
+
+    def execute_profiled(self, outputs: List[int], max_outputs: Optional[int], profile: Profile,
+                         max_instructions: int = sys.maxsize) -> int:
+        """Same as `execute` but one instruction at a time so that each one can be recorded."""
+        start = time.perf_counter()
+        num_executed = 0
+        try:
+            while self.status == MachineStatus.RUNNING and num_executed < max_instructions:
+                index = self.index
+                instruction = self.decode(self.read_memory(index))
+                num_outputs = len(outputs)
+                self.execute(outputs, max_outputs, 1)
+                if self.status == MachineStatus.WAITING_FOR_INPUT:
+                    # The input instruction is retried once there's input:
+                    break
+                num_executed += 1
+                profile.record(index, instruction)
+                if (len(outputs) == max_outputs and len(outputs) > num_outputs) or self.stop_reason is not None:
+                    break
+        finally:
+            profile.elapsed_seconds += time.perf_counter() - start
+        return num_executed
+
+    def execute_in_blocks(self, outputs: List[int], max_outputs: Optional[int],
+                          max_instructions: int = sys.maxsize) -> int:
+        """
+        Same as `execute` but in blocks of at most `limit_check_interval` instructions, checking `limits` and
+        snapshotting for `trace` in between (and recording every instruction if `profile` is set too). The
+        instruction budget is exact. Memory and time can overshoot by what one block does.
+        """
+        max_instructions_in_total, max_memory_cells, max_seconds = self.limits or Limits()
+        trace = self.trace
+        profile = self.profile
+        if trace is not None:
+            trace.catch_up(self)
+        start = time.perf_counter()
+        num_executed = 0
+        try:
+            while self.status == MachineStatus.RUNNING and num_executed < max_instructions:
+                block_size = min(limit_check_interval, max_instructions - num_executed)
+                if max_instructions_in_total is not None:
+                    if self.num_instructions_executed >= max_instructions_in_total:
+                        raise LimitExceeded("max_instructions", self, outputs)
+                    block_size = min(block_size, max_instructions_in_total - self.num_instructions_executed)
+                if trace is not None:
+                    block_size = min(block_size, trace.get_block_size(self))
+                if profile is not None:
+                    num_instructions = self.execute_profiled(outputs, max_outputs, profile, block_size)
+                else:
+                    num_instructions = self.execute(outputs, max_outputs, block_size)
+                num_executed += num_instructions
+                self.num_instructions_executed += num_instructions
+                if trace is not None:
+                    trace.count(num_instructions)
+                if max_memory_cells is not None and self.get_num_memory_cells() > max_memory_cells:
+                    raise LimitExceeded("max_memory_cells", self, outputs)
+                if len(outputs) == max_outputs or self.status != MachineStatus.RUNNING or self.stop_reason is not None:
+                    break
+                if max_seconds is not None and (
+                        self.seconds_executed + time.perf_counter() - start > max_seconds):
+                    raise LimitExceeded("max_seconds", self, outputs)
+        except LimitExceeded:
+            if trace is not None:
+                trace.dump(failed=False)
+            raise
+        except Exception:
+            if trace is not None:
+                trace.dump(failed=True)
+            raise
+        finally:
+            self.seconds_executed += time.perf_counter() - start
+            if trace is not None:
+                trace.remember(self)
+        return num_executed
+
+    def get_num_memory_cells(self) -> int:
+        """The size of the memory: one past the highest address that has been written to."""
+        return self.memory.get_length()
+
+    def fork(self) -> "Machine":
+        """
+        Independent copy of this machine: memory, instruction pointer, relative base, pending inputs and status.
+        Keep a fork around as a snapshot and fork it again whenever you want to go back to that point.
+        The fork keeps `limits` but has no `profile` or `trace`, which belong to this machine.
+        """
+        forked = copy.copy(self)
+        forked.memory = self.memory.fork()
+        forked.inputs = deque(self.inputs)
+        forked.profile = None
+        forked.trace = None
+        return forked
+
+    def execute(self, outputs: List[int], max_outputs: Optional[int], max_instructions: int = sys.maxsize):
+        """
+        Execute until the program blocks on input, terminates, produces `max_outputs` outputs,
+        `max_instructions` instructions have run or one of the conditions of `run_until` holds (in which cases
+        `status` stays `RUNNING`). Return the number of instructions executed.
+        """
+        buffer = self.memory
+        index = self.index
+        relative_base = self.relative_base
+        inputs = self.inputs
+        decode = self.decode
+        # Set by `run_until`, empty otherwise:
+        breakpoints = self.breakpoints
+        watched_addresses = self.watched_addresses
+        cell_changed = False
+        try:
+            for step in range(max_instructions):
+                op_code, num_operands, modes = decode(buffer[index])
+                if op_code == Op_Code.ADD:
+                    operand_1 = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(
+                        buffer, buffer[index + 2], modes[1], relative_base)
+                    operand_3 = shift_if_in_relative_mode(
+                        buffer[index + 3], relative_base, modes[2])
+                    result = operand_1 + operand_2
+                    if operand_3 in watched_addresses:
+                        cell_changed = buffer[operand_3] != result
+                    buffer[operand_3] = result
+                    index += num_operands + 1
+                elif op_code == Op_Code.MULTIPLY:
+                    operand_1 = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(
+                        buffer, buffer[index + 2], modes[1], relative_base)
+                    operand_3 = shift_if_in_relative_mode(
+                        buffer[index + 3], relative_base, modes[2])
+                    result = operand_1 * operand_2
+                    if operand_3 in watched_addresses:
+                        cell_changed = buffer[operand_3] != result
+                    buffer[operand_3] = result
+                    index += num_operands + 1
+                elif op_code == Op_Code.INPUT:
+                    if len(inputs) == 0:
+                        self.status = MachineStatus.WAITING_FOR_INPUT
+                        return step
+                    operand = shift_if_in_relative_mode(
+                        buffer[index + 1], relative_base, modes[0])
+                    result = inputs.popleft()
+                    if operand in watched_addresses:
+                        cell_changed = buffer[operand] != result
+                    buffer[operand] = result
+                    index += num_operands + 1
+                elif op_code == Op_Code.OUTPUT:
+                    operand = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    index += num_operands + 1
+                    outputs.append(operand)
+                    if len(outputs) == max_outputs:
+                        return step + 1
+                elif op_code == Op_Code.JUMP_IF_TRUE:
+                    operand_1 = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(
+                        buffer, buffer[index + 2], modes[1], relative_base)
+                    if operand_1 != 0:
+                        index = operand_2
+                    else:
+                        index += num_operands + 1
+                elif op_code == Op_Code.JUMP_IF_FALSE:
+                    operand_1 = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(
+                        buffer, buffer[index + 2], modes[1], relative_base)
+                    if operand_1 == 0:
+                        index = operand_2
+                    else:
+                        index += num_operands + 1
+                elif op_code == Op_Code.LESS_THAN:
+                    operand_1 = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(
+                        buffer, buffer[index + 2], modes[1], relative_base)
+                    operand_3 = shift_if_in_relative_mode(
+                        buffer[index + 3], relative_base, modes[2])
+                    result = 1 if operand_1 < operand_2 else 0
+                    if operand_3 in watched_addresses:
+                        cell_changed = buffer[operand_3] != result
+                    buffer[operand_3] = result
+                    index += num_operands + 1
+                elif op_code == Op_Code.EQUALS:
+                    operand_1 = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(
+                        buffer, buffer[index + 2], modes[1], relative_base)
+                    operand_3 = shift_if_in_relative_mode(
+                        buffer[index + 3], relative_base, modes[2])
+                    result = 1 if operand_1 == operand_2 else 0
+                    if operand_3 in watched_addresses:
+                        cell_changed = buffer[operand_3] != result
+                    buffer[operand_3] = result
+                    index += num_operands + 1
+                elif op_code == Op_Code.ADJUST_RELATIVE_BASE:
+                    operand = read_value_from_buffer(
+                        buffer, buffer[index + 1], modes[0], relative_base)
+                    relative_base += operand
+                    index += num_operands + 1
+                elif op_code == Op_Code.TERMINATE:
+                    self.status = MachineStatus.TERMINATED
+                    return step + 1
+                if cell_changed:
+                    self.stop_reason = StopReason.CELL_CHANGED
+                    return step + 1
+                if index in breakpoints:
+                    self.stop_reason = StopReason.BREAKPOINT
+                    return step + 1
+            return max_instructions
+        finally:
+            self.index = index
+            self.relative_base = relative_base
+
+
+def test_machine_runs_until_blocked():
+    machine = Machine(large_program)
+    assert machine.run() == []
+    assert machine.status == MachineStatus.WAITING_FOR_INPUT
+    assert machine.run([8]) == [1000]
+    assert machine.status == MachineStatus.TERMINATED
+    assert machine.run([8]) == []
+
+
+def test_machine_max_outputs():
+    machine = Machine("104,1,104,2,104,3,99")
+    assert machine.run(max_outputs=2) == [1, 2]
+    assert machine.status == MachineStatus.RUNNING
+    assert machine.run() == [3]
+    assert machine.status == MachineStatus.TERMINATED
+
+
+@pytest.mark.parametrize("buffer_type", [Buffer, PagedBuffer])
+def test_machine_fork(buffer_type):
+    # Outputs the sum of all inputs so far whenever it reads one:
+    machine = Machine("3,100,1,100,101,101,4,101,1105,1,0", buffer_type=buffer_type)
+    assert machine.run([1, 2]) == [1, 3]
+    snapshot = machine.fork()
+    assert machine.run([10]) == [13]
+    forked = snapshot.fork()
+    assert forked.run([20]) == [23]
+    assert snapshot.fork().run([30]) == [33]
+    assert machine.run([1]) == [14]
+    assert forked.status == MachineStatus.WAITING_FOR_INPUT
+
+
+def test_machine_max_instructions():
+    machine = Machine("1101,1,1,10,1101,2,2,11,99")
+    outputs: List[int] = []
+    assert machine.execute(outputs, None, 1) == 1
+    assert machine.status == MachineStatus.RUNNING
+    assert (machine.memory[10], machine.memory[11], machine.index) == (2, 0, 4)
+    assert machine.execute(outputs, None, 5) == 2
+    assert machine.status == MachineStatus.TERMINATED
+    assert machine.memory[11] == 4
+
+
+# Reads a number into cell 100 and outputs it doubled until the number is 0:
+doubling_program = "3,100,1002,100,2,101,4,101,1005,100,0,99"
+# Read a number, add one to it and output it. Repeat until the number output is at least 1000:
+increment_program = "3,20,1001,20,1,20,4,20,1007,20,1000,21,1005,21,0,99,0,0,0,0,0,0"
+
+
+def run_until_scenario(machine: "Machine") -> List[Tuple[List[int], Optional[StopReason], int]]:
+    """Run `doubling_program` on `machine` with every kind of stop condition. (outputs, stop reason, index) per run."""
+    runs = [
+        (StopWhen(num_outputs=2), [1, 2, 3]),
+        # The output of 6 comes first:
+        (StopWhen(breakpoints=[6]), []),
+        (StopWhen(breakpoints=[6]), []),
+        # Reading 3 again doesn't change cell 100, reading 0 does:
+        (StopWhen(watched_addresses=[100]), [4, 4, 0]),
+        (StopWhen(watched_addresses=[100]), []),
+        (StopWhen(), []),
+        (StopWhen(num_outputs=1, breakpoints=[0]), []),
+    ]
+    results = []
+    for stop_when, inputs in runs:
+        outputs = machine.run_until(stop_when, inputs)
+        results.append((outputs, machine.stop_reason, machine.index))
+    return results
+
+
+expected_run_until_scenario = [
+    ([2, 4], StopReason.NUM_OUTPUTS, 8),
+    ([], StopReason.BREAKPOINT, 6),
+    ([6], StopReason.INPUT_REQUESTED, 0),
+    ([], StopReason.CELL_CHANGED, 2),
+    ([8, 8], StopReason.CELL_CHANGED, 2),
+    ([0], StopReason.TERMINATED, 11),
+    ([], StopReason.TERMINATED, 11),
+]
+
+
+@pytest.mark.parametrize("setting", [None, "limits", "trace", "profile"])
+def test_machine_run_until(setting):
+    machine = Machine(doubling_program)
+    if setting == "limits":
+        machine.limits = Limits(max_instructions=1000)
+    elif setting == "trace":
+        machine.trace = Trace(file=io.StringIO())
+    elif setting == "profile":
+        machine.profile = Profile()
+    assert run_until_scenario(machine) == expected_run_until_scenario
+    # Plain runs don't stop at the last breakpoints:
+    machine = Machine(doubling_program)
+    machine.run_until(StopWhen(breakpoints=[6]), [5])
+    assert machine.run([0]) == [10, 0]
+
+
+def test_machine_step_until():
+    class SteppedMachine(Machine):
+        checks_stop_conditions = False
+
+    assert run_until_scenario(SteppedMachine(doubling_program)) == expected_run_until_scenario
+
+
+# Counts cell 100 down from 30000, then outputs 1 and terminates:
+countdown_program = "1101,0,30000,100,1001,100,-1,100,1005,100,4,104,1,99"
+
+
+def test_machine_instruction_limit():
+    machine = Machine(countdown_program)
+    machine.limits = Limits(max_instructions=25_000)
+    with pytest.raises(LimitExceeded) as exc_info:
+        machine.run()
+    error = exc_info.value
+    assert (error.limit, error.machine, error.outputs, error.num_instructions) == (
+        "max_instructions", machine, [], 25_000)
+    assert machine.status == MachineStatus.RUNNING
+    # The 25000th instruction was the 12500th decrement:
+    assert (machine.index, machine.read_memory(100)) == (8, 30000 - 12500)
+    machine.limits = machine.limits._replace(max_instructions=None)
+    assert machine.run() == [1]
+    assert machine.num_instructions_executed == 1 + 2 * 30000 + 2
+
+
+def test_machine_instruction_limit_is_cumulative():
+    # Reads a number and outputs it, forever:
+    machine = Machine("3,7,4,7,1105,1,0,0")
+    machine.limits = Limits(max_instructions=7)
+    assert machine.run([1, 2]) == [1, 2]
+    assert machine.num_instructions_executed == 6
+    with pytest.raises(LimitExceeded) as exc_info:
+        machine.run([3])
+    assert exc_info.value.outputs == []
+    assert machine.read_memory(7) == 3
+
+
+def test_machine_memory_limit():
+    # Writes to ever higher addresses:
+    machine = Machine("1101,0,0,1000,109,1,21101,0,7,1000,1105,1,4")
+    machine.limits = Limits(max_memory_cells=100_000)
+    with pytest.raises(LimitExceeded) as exc_info:
+        machine.run()
+    assert exc_info.value.limit == "max_memory_cells"
+    assert 100_000 < len(machine.memory) <= 100_000 + limit_check_interval
+    # Past `sys.maxsize`, where `len` doesn't work:
+    machine = Machine(f"1101,1,1,{2 ** 70},99")
+    machine.limits = Limits(max_memory_cells=100_000)
+    with pytest.raises(LimitExceeded):
+        machine.run()
+    assert machine.get_num_memory_cells() == 2 ** 70 + 1
+
+
+def test_machine_time_limit():
+    # Loops forever:
+    machine = Machine("1105,1,0")
+    machine.limits = Limits(max_seconds=0.05)
+    with pytest.raises(LimitExceeded) as exc_info:
+        machine.run()
+    assert exc_info.value.limit == "max_seconds"
+    assert machine.seconds_executed > 0.05
+    assert machine.num_instructions_executed > 0
+
+
+@pytest.mark.parametrize("source_code,inputs,max_outputs", [
+    ("3,0,4,0,99", [8], None), ("104,1,104,2,104,3,99", [], 2), (countdown_program, [], None)])
+def test_machine_limits_that_are_not_hit(source_code, inputs, max_outputs):
+    machine = Machine(source_code)
+    machine.limits = Limits(max_instructions=100_000, max_memory_cells=1000, max_seconds=60)
+    expected = Machine(source_code)
+    assert machine.run(inputs, max_outputs) == expected.run(inputs, max_outputs)
+    assert (machine.status, machine.index, machine.memory) == (expected.status, expected.index, expected.memory)
+
+
+def test_machine_limits_with_profile():
+    # Loops forever:
+    machine = Machine("1105,1,0")
+    machine.limits = Limits(max_instructions=1000)
+    machine.profile = Profile()
+    with pytest.raises(LimitExceeded):
+        machine.run()
+    assert machine.num_instructions_executed == machine.profile.num_instructions == 1000
+    assert machine.profile.op_code_counts == {Op_Code.JUMP_IF_TRUE: 1000}
+
+
+def test_machine_trace_is_dumped_when_run_raises():
+    # Counts down from 30000, then runs into an invalid op code:
+    machine = Machine("1101,0,30000,100,1001,100,-1,100,1005,100,4,42")
+    file = io.StringIO()
+    machine.trace = Trace(num_entries=4, file=file)
+    with pytest.raises(KeyError):
+        machine.run()
+    assert machine.trace.entries == [
+        (8, Op_Code.JUMP_IF_TRUE, (1, 4), 0),
+        (4, Op_Code.ADD, (1, -1, 100), 0),
+        (8, Op_Code.JUMP_IF_TRUE, (0, 4), 0),
+        (11, None, (), 0),
+    ]
+    assert file.getvalue() == machine.trace.format() + "\n"
+    assert "JUMP_IF_TRUE" in file.getvalue()
+
+
+def test_machine_trace_across_runs():
+    # Outputs its inputs until one of them is 0, then runs into an invalid op code:
+    machine = Machine("3,100,4,100,1005,100,0,42")
+    machine.trace = Trace(num_entries=5, file=io.StringIO())
+    assert machine.run([1]) == [1]
+    assert machine.run([2]) == [2]
+    with pytest.raises(KeyError):
+        machine.run([0])
+    # The inputs of every run are replayed:
+    assert machine.trace.entries == [
+        (4, Op_Code.JUMP_IF_TRUE, (2, 0), 0),
+        (0, Op_Code.INPUT, (100,), 0),
+        (2, Op_Code.OUTPUT, (0,), 0),
+        (4, Op_Code.JUMP_IF_TRUE, (0, 0), 0),
+        (7, None, (), 0),
+    ]
+
+
+def test_machine_trace_is_dumped_when_a_limit_is_exceeded():
+    machine = Machine(countdown_program)
+    machine.limits = Limits(max_instructions=25_000)
+    machine.trace = Trace(num_entries=3, file=io.StringIO())
+    with pytest.raises(LimitExceeded):
+        machine.run()
+    assert machine.trace.entries == [
+        (4, Op_Code.ADD, (17502, -1, 100), 0),
+        (8, Op_Code.JUMP_IF_TRUE, (17501, 4), 0),
+        (4, Op_Code.ADD, (17501, -1, 100), 0),
+    ]
+    # Tracing doesn't change what the machine does:
+    machine.limits = None
+    assert machine.run() == [1]
+    assert machine.trace.get_entries()[-1] == (13, Op_Code.TERMINATE, (), 0)
+
+
+def test_machine_trace_with_profile():
+    machine = Machine("1101,0,30000,100,1001,100,-1,100,1005,100,4,42")
+    machine.profile = Profile()
+    machine.trace = Trace(num_entries=2, file=io.StringIO())
+    with pytest.raises(KeyError):
+        machine.run()
+    assert machine.trace.entries == [(8, Op_Code.JUMP_IF_TRUE, (0, 4), 0), (11, None, (), 0)]
+    assert machine.profile.num_instructions == 1 + 2 * 30000
+
+
+def test_machine_trace_starts_over_after_changes_between_runs():
+    # Outputs its inputs until one of them is 0, then terminates:
+    machine = Machine("3,100,4,100,1005,100,0,99")
+    machine.trace = Trace(num_entries=4, file=io.StringIO())
+    assert machine.run([1]) == [1]
+    # Turn the TERMINATE into an invalid op code:
+    machine.write_memory(7, 42)
+    with pytest.raises(KeyError):
+        machine.run([0])
+    expected_entries = [
+        (0, Op_Code.INPUT, (100,), 0), (2, Op_Code.OUTPUT, (0,), 0), (4, Op_Code.JUMP_IF_TRUE, (0, 0), 0),
+        (7, None, (), 0)]
+    assert machine.trace.entries == expected_entries
+    # Take away an input that was left over from the last run:
+    machine = Machine("3,100,4,100,1005,100,0,42")
+    machine.trace = Trace(num_entries=4, file=io.StringIO())
+    assert machine.run([1, 2], max_outputs=1) == [1]
+    machine.inputs.clear()
+    with pytest.raises(KeyError):
+        machine.run([0])
+    assert machine.trace.entries == expected_entries
+
+
+def test_machine_fork_has_no_profile_or_trace():
+    machine = Machine(countdown_program)
+    machine.profile = Profile()
+    machine.trace = Trace(file=io.StringIO())
+    machine.limits = Limits(max_instructions=1000)
+    forked = machine.fork()
+    assert (forked.profile, forked.trace, forked.limits) == (None, None, machine.limits)
+    with pytest.raises(LimitExceeded):
+        forked.run()
+    assert machine.profile.num_instructions == 0
+    assert len(machine.trace.snapshots) == 0
+
+
+def test_machine_profile():
+    machine = Machine(large_program)
+    machine.profile = Profile()
+    assert machine.run() == []
+    assert machine.profile.num_instructions == 0
+    assert machine.run([7]) == [999]
+    profile = machine.profile
+    assert profile.op_code_counts == {
+        Op_Code.INPUT: 1, Op_Code.EQUALS: 1, Op_Code.JUMP_IF_TRUE: 2, Op_Code.LESS_THAN: 1, Op_Code.JUMP_IF_FALSE: 1,
+        Op_Code.OUTPUT: 1, Op_Code.TERMINATE: 1,
+    }
+    assert profile.num_instructions == 8
+    # 3,21: 2 reads. 1008,21,8,20: 5. 1005,20,22: 4. 107,8,21,20: 5. 1006,20,31: 4. 104,999: 2. 1105,1,46: 3. 99: 1.
+    assert profile.num_memory_reads == 26
+    assert profile.num_memory_writes == 3
+    exported = json.loads(profile.to_json())
+    assert exported["num_instructions"] == 8
+    assert exported["op_code_counts"]["JUMP_IF_TRUE"] == 2
+
+
+def test_machine_profile_hottest_addresses():
+    # Counts cell 20 down from 3:
+    machine = Machine("1101,0,3,20,1001,20,-1,20,1005,20,4,99")
+    machine.profile = Profile()
+    machine.run()
+    assert machine.status == MachineStatus.TERMINATED
+    assert machine.profile.get_hottest_addresses(2) == [(4, 3), (8, 3)]
+    assert machine.profile.num_instructions == 8
+    assert json.loads(machine.profile.to_json())["address_counts"][:2] == [[4, 3], [8, 3]]
+
+
+def run_machine_as_program(machine):
+    """Drive `machine` one message at a time using the `ProgramMessage` protocol of `compile_source_code`."""
+    while True:
+        outputs = machine.run(max_outputs=1)
+        if len(outputs) > 0:
+            yield ProgramMessage(type=MessageType.PRINT_OUTPUT, arg=outputs[0])
+        elif machine.status == MachineStatus.WAITING_FOR_INPUT:
+            input_from_user = yield ProgramMessage(type=MessageType.GET_INPUT, arg=input_prompt)
+            machine.inputs.append(int(input_from_user))
+        elif machine.status == MachineStatus.TERMINATED:
+            yield ProgramMessage(type=MessageType.TERMINATE, arg=machine.memory)
+            return
+
+
+def compile_source_code(source_code: Union[str, ProgramImage], decode=decode_instruction):
+    """
+    `source_code` can also be a `ProgramImage`.
+    `decode` turns an instruction word into an `Instruction`. Pass `parse_instruction` to bypass the decode table.
+    """
+    return run_machine_as_program(Machine(source_code, decode))
+
+
+def run_with_input_output(source_code, get_user_input, print_output, decode=decode_instruction,
+                          engine=compile_source_code):
+    """
+    `source_code` can also be a `ProgramImage`.
+    `engine` is any function that, like `compile_source_code`, turns source code and a decoder into a program.
+    """
+    program = engine(source_code, decode)
     should_continue = True
     final_output = None
     try:
@@ -285,27 +1873,77 @@ def run_with_input_output(source_code, get_user_input, print_output):
     return final_output
 
 
-@pytest.mark.parametrize(
-    "source_code,expected",
-    [
-        # Tests from day 2:
-        ('1,9,10,3,2,3,11,0,99,30,40,50', [
-         3500, 9, 10, 70, 2, 3, 11, 0, 99, 30, 40, 50]),
-        ('1,0,0,0,99', [2, 0, 0, 0, 99]),
-        ('2,3,0,3,99', [2, 3, 0, 6, 99]),
-        ('2,4,4,5,99,0', [
-            2, 4, 4, 5, 99, 9801]),
-        ('1,1,1,4,99,5,6,0,99', [
-            30, 1, 1, 4, 2, 5, 6, 0, 99]),
-        # Tests from day 5 part 1:
-        ('1002,4,3,4,33', [1002, 4, 3, 4, 99]),
-        ('1101,100,-1,4,0', [1101, 100, -1, 4, 99]),
-    ]
-)
+def run_with_native_io(machine: Machine, get_input: Callable[[], int], put_output: Callable[[int], None]) -> Machine:
+    """
+    Run `machine` until it terminates, passing ints straight through: `get_input()` is called whenever the program
+    needs an input and `put_output` is called with every output. There are no prompts and no string conversions.
+    """
+    while True:
+        for output in machine.run():
+            put_output(output)
+        if machine.status == MachineStatus.TERMINATED:
+            return machine
+        machine.inputs.append(get_input())
+
+
+def read_int_from_console(get_user_input=input) -> Callable[[], int]:
+    """Console adapter for `run_with_native_io`: prompt for a number and parse what the user types."""
+    return lambda: int(get_user_input(input_prompt))
+
+
+def run_on_console(source_code: Union[str, ProgramImage], get_user_input=input, print_output=print) -> Buffer:
+    """Run an interactive program on the console. Return the final memory."""
+    machine = run_with_native_io(Machine(source_code), read_int_from_console(get_user_input), print_output)
+    return machine.memory
+
+
+def test_run_with_native_io():
+    inputs = iter([3, 4])
+    outputs: List[int] = []
+    # Reads two numbers and outputs their sum:
+    machine = run_with_native_io(Machine("3,0,3,1,1,0,1,0,4,0,99"), lambda: next(inputs), outputs.append)
+    assert outputs == [7]
+    assert machine.status == MachineStatus.TERMINATED
+
+
+def test_run_on_console():
+    get_user_input = Mock(return_value="8")
+    print_output = Mock()
+    memory = run_on_console(large_program, get_user_input, print_output)
+    get_user_input.assert_called_once_with(input_prompt)
+    print_output.assert_called_once_with(1000)
+    assert memory[21] == 8
+
+
+simple_programs = [
+    # Tests from day 2:
+    ('1,9,10,3,2,3,11,0,99,30,40,50', [
+     3500, 9, 10, 70, 2, 3, 11, 0, 99, 30, 40, 50]),
+    ('1,0,0,0,99', [2, 0, 0, 0, 99]),
+    ('2,3,0,3,99', [2, 3, 0, 6, 99]),
+    ('2,4,4,5,99,0', [
+        2, 4, 4, 5, 99, 9801]),
+    ('1,1,1,4,99,5,6,0,99', [
+        30, 1, 1, 4, 2, 5, 6, 0, 99]),
+    # Tests from day 5 part 1:
+    ('1002,4,3,4,33', [1002, 4, 3, 4, 99]),
+    ('1101,100,-1,4,0', [1101, 100, -1, 4, 99]),
+]
+
+
+@pytest.mark.parametrize("source_code,expected", simple_programs)
 def test_simple_program(source_code, expected):
     assert run_with_input_output(source_code, input, print) == expected
 
 
+@pytest.mark.parametrize("source_code,expected", simple_programs)
+def test_simple_program_from_image(source_code, expected):
+    image = ProgramImage.from_source_code(source_code)
+    assert run_with_input_output(image, input, print) == expected
+    # The image itself is never modified:
+    assert image.to_list() == [int(x) for x in source_code.split(",")]
+
+
 equal_op_code_position_mode_program = '3,9,8,9,10,9,4,9,99,-1,8'
 less_than_op_code_position_mode_program = '3,9,7,9,10,9,4,9,99,-1,8'
 equal_op_code_immediate_mode_program = '3,3,1108,-1,8,3,4,3,99'
@@ -315,27 +1953,27 @@ jump_op_code_immediate_mode_program = '3,3,1105,-1,9,1101,0,0,12,4,12,99,1'
 large_program = '3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99'
 
 
-@pytest.mark.parametrize(
-    "user_input_value,source_code,expected_output",
-    [
-        # From day 7:
-        ("8", equal_op_code_position_mode_program, 1),
-        ("13", equal_op_code_position_mode_program, 0),
-        ("5", less_than_op_code_position_mode_program, 1),
-        ("13", less_than_op_code_position_mode_program, 0),
-        ("8", equal_op_code_immediate_mode_program, 1),
-        ("13", equal_op_code_immediate_mode_program, 0),
-        ("5", less_than_op_code_immediate_mode_program, 1),
-        ("13", less_than_op_code_immediate_mode_program, 0),
-        ("0", jump_op_code_position_mode_program, 0),
-        ("100", jump_op_code_position_mode_program, 1),
-        ("0", jump_op_code_immediate_mode_program, 0),
-        ("100", jump_op_code_immediate_mode_program, 1),
-        ("7", large_program, 999),
-        ("8", large_program, 1000),
-        ("9", large_program, 1001),
-    ]
-)
+input_output_programs = [
+    # From day 7:
+    ("8", equal_op_code_position_mode_program, 1),
+    ("13", equal_op_code_position_mode_program, 0),
+    ("5", less_than_op_code_position_mode_program, 1),
+    ("13", less_than_op_code_position_mode_program, 0),
+    ("8", equal_op_code_immediate_mode_program, 1),
+    ("13", equal_op_code_immediate_mode_program, 0),
+    ("5", less_than_op_code_immediate_mode_program, 1),
+    ("13", less_than_op_code_immediate_mode_program, 0),
+    ("0", jump_op_code_position_mode_program, 0),
+    ("100", jump_op_code_position_mode_program, 1),
+    ("0", jump_op_code_immediate_mode_program, 0),
+    ("100", jump_op_code_immediate_mode_program, 1),
+    ("7", large_program, 999),
+    ("8", large_program, 1000),
+    ("9", large_program, 1001),
+]
+
+
+@pytest.mark.parametrize("user_input_value,source_code,expected_output", input_output_programs)
 def test_programs_with_input_output(user_input_value, source_code, expected_output):
     get_user_input = Mock(return_value=user_input_value)
     print_output = Mock()
@@ -344,9 +1982,7 @@ def test_programs_with_input_output(user_input_value, source_code, expected_outp
 
 
 def execute_day_05_input(get_user_input=input, print_output=print):
-    with open('day_05_input.txt') as f:
-        source_code = f.readline()
-        run_with_input_output(source_code, get_user_input, print_output)
+    run_on_console(ProgramImage.from_file('day_05_input.txt'), get_user_input, print_output)
 
 
 # Note: These tests are commented out because the input and expected output are
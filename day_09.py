@@ -1,5 +1,12 @@
-from day_05 import run_with_input_output
+from day_05 import run_with_input_output, run_on_console, Machine, Buffer, Int64Buffer, PagedBuffer, ProgramImage
 from unittest.mock import Mock, call
+import pytest
+
+quine_program = "109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99"
+large_multiplication_program = "1102,34915192,34915192,7,4,7,99,0"
+large_output_program = "104,1125899906842624,99"
+# Squares 34915192 twice, which doesn't fit in 64 bits anymore:
+overflowing_program = "1102,34915192,34915192,11,2,11,11,11,4,11,99,0"
 
 
 def test_program_with_relative_base_1():
@@ -39,10 +46,32 @@ def test_program_with_relative_base_3():
     print_output.assert_called_once_with(1125899906842624)
 
 
+@pytest.mark.parametrize("buffer_type", [Buffer, Int64Buffer, PagedBuffer])
+@pytest.mark.parametrize("source_code,expected_outputs", [
+    (quine_program, [int(x) for x in quine_program.split(",")]),
+    (large_multiplication_program, [1219070632396864]),
+    (large_output_program, [1125899906842624]),
+    (overflowing_program, [34915192 ** 4]),
+])
+def test_buffer_types(buffer_type, source_code, expected_outputs):
+    machine = Machine(source_code, buffer_type=buffer_type)
+    assert machine.run() == expected_outputs
+    reference = Machine(source_code)
+    reference.run()
+    assert machine.memory == reference.memory
+
+
+def test_int64_buffer_is_promoted():
+    machine = Machine(large_multiplication_program, buffer_type=Int64Buffer)
+    machine.run()
+    assert machine.memory.is_compact()
+    machine = Machine(overflowing_program, buffer_type=Int64Buffer)
+    machine.run()
+    assert not machine.memory.is_compact()
+
+
 def execute_input_program(get_user_input=input, print_output=print):
-    with open("day_09_input.txt") as f:
-        source_code = f.readline()
-        run_with_input_output(source_code, get_user_input, print_output)
+    run_on_console(ProgramImage.from_file("day_09_input.txt"), get_user_input, print_output)
 
 
 # Note: These tests are commented out because the input and expected output are
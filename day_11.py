@@ -1,8 +1,10 @@
-from day_05 import compile_source_code, MessageType
+from day_05 import Machine, ProgramImage, StopReason, StopWhen
+from intcode_assembler import assemble
 from collections import namedtuple
-from typing import Tuple, List
+from typing import Tuple, List, Union
 from enum import Enum, unique, auto
 import itertools
+import pytest
 
 Coord = namedtuple("Coord", ["x", "y"])
 Panel = namedtuple("Panel", ["is_painted", "color"])
@@ -88,53 +90,93 @@ def move_in_direction(point: Coord, direction: Direction) -> Coord:
         return Coord(x=point.x - 1, y=point.y)
 
 
-def run_program(source_code: str, initial_panel_color: int):
-    board = Board(initial_panel_color)
-    program = compile_source_code(source_code)
+# The robot reads the color of its panel, then outputs the color to paint and the direction to turn:
+paint_and_turn = StopWhen(num_outputs=2)
+
 
-    should_continue = True
-    message = next(program)
-    consecutive_output_message_count = 0
+def run_program(source_code: Union[str, ProgramImage], initial_panel_color: int):
+    board = Board(initial_panel_color)
+    machine = Machine(source_code)
     position = Coord(x=0, y=0)
     direction = Direction.UP
 
-    while should_continue:
-        if message.type == MessageType.GET_INPUT:
-            message = program.send(board[position])
-            consecutive_output_message_count = 0
-        elif message.type == MessageType.PRINT_OUTPUT:
-            if consecutive_output_message_count == 0:
-                # This must be the color instruction:
-                board[position] = message.arg
-            elif consecutive_output_message_count == 1:
-                # This must be the movement instruction:
-                next_direction = left_turn[direction] if message.arg == 0 else right_turn[direction]
-                next_position = move_in_direction(position, next_direction)
-                position = next_position
-                direction = next_direction
-            else:
-                raise RuntimeError(
-                    f"There should not be more than 2 consecutive output calls. Receive {consecutive_output_message_count} calls.")
-            consecutive_output_message_count += 1
-            message = next(program)
-        elif message.type == MessageType.TERMINATE:
-            should_continue = False
+    while True:
+        outputs = machine.run_until(paint_and_turn, [board[position]])
+        if len(outputs) == 0 and machine.stop_reason == StopReason.TERMINATED:
+            break
+        # Left over input means that the outputs came before the robot read its panel:
+        if machine.stop_reason != StopReason.NUM_OUTPUTS or len(machine.inputs) > 0:
+            raise RuntimeError(
+                f"There should be exactly 2 outputs for each input. Received {len(outputs)} outputs.")
+        color, turn = outputs
+        board[position] = color
+        next_direction = left_turn[direction] if turn == 0 else right_turn[direction]
+        position = move_in_direction(position, next_direction)
+        direction = next_direction
     return board
 
 
+# Paints and turns according to the example in the puzzle, reading each panel's color first:
+example_robot_program = ",".join(str(x) for x in [
+    3, 100, 104, 1, 104, 0,  # paint white, turn left
+    3, 100, 104, 0, 104, 0,  # paint black, turn left
+    3, 100, 104, 1, 104, 0,
+    3, 100, 104, 1, 104, 0,
+    3, 100, 104, 0, 104, 1,  # back at the origin, which is white now
+    3, 100, 104, 1, 104, 0,
+    3, 100, 104, 1, 104, 0,
+    99,
+])
+
+
+def test_run_program():
+    board = run_program(example_robot_program, 0)
+    assert board.get_num_panels_painted_at_least_once() == 6
+    with pytest.raises(RuntimeError):
+        run_program("3,100,104,1,104,0,104,1,99", 0)
+
+
+def make_langtons_ant_program(num_steps: int) -> str:
+    """A robot that walks `num_steps` steps like Langton's ant: black panels turn white and right, white ones black."""
+    return assemble(f"""
+        loop:   in color
+                eq color, #0, paint     ; also the direction to turn: 1 is right
+                out paint
+                out paint
+                add steps, #-1, steps
+                jt steps, #loop
+                halt
+        color:  .word 0
+        paint:  .word 0
+        steps:  .word {num_steps}
+    """)
+
+
+def test_langtons_ant():
+    num_steps = 500
+    white_panels = set()
+    painted_panels = set()
+    position = Coord(x=0, y=0)
+    direction = Direction.UP
+    for _ in range(num_steps):
+        is_black = position not in white_panels
+        white_panels.symmetric_difference_update({position})
+        painted_panels.add(position)
+        direction = right_turn[direction] if is_black else left_turn[direction]
+        position = move_in_direction(position, direction)
+    board = run_program(make_langtons_ant_program(num_steps), 0)
+    assert board.get_num_panels_painted_at_least_once() == len(painted_panels)
+
+
 def part_one():
-    with open("day_11_input.txt") as f:
-        source_code = f.readline()
-        board = run_program(source_code, 0)
-        return board.get_num_panels_painted_at_least_once()
+    board = run_program(ProgramImage.from_file("day_11_input.txt"), 0)
+    return board.get_num_panels_painted_at_least_once()
 
 def part_two():
-    with open("day_11_input.txt") as f:
-        source_code = f.readline()
-        board = run_program(source_code, 1)
-        buffer = board.get_printable_representation()
-        for line in buffer:
-            print(line)
+    board = run_program(ProgramImage.from_file("day_11_input.txt"), 1)
+    buffer = board.get_printable_representation()
+    for line in buffer:
+        print(line)
 
 # Note: These tests are commented out because the input and expected output are
 # different for each Advent of Code participant. The tests as written below
@@ -1,9 +1,12 @@
 from enum import Enum, unique, auto
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional, Union
 from collections import namedtuple
-from day_05 import compile_source_code, MessageType
-import re
+from day_05 import Machine, MachineStatus, ProgramImage, input_prompt
+from intcode_replay import RecordingMachine, save_session_log, load_session_log, replay_session
+import functools
+import sys
 import readchar
+import pytest
 
 Coord = namedtuple("Coord", ["x", "y"])
 Tile = namedtuple("Tile", ["id"])
@@ -102,54 +105,108 @@ keyboard_to_joystick_position = {
 }
 
 
-def run_program(source_code: str, get_user_input, num_quarters=None):
-    modified_source_code = re.sub(
-        "^(\d+)", str(int(num_quarters)), source_code) if num_quarters is not None else source_code
-    screen = Screen()
-    program = compile_source_code(modified_source_code)
+def get_quarter_patches(num_quarters=None) -> Optional[Dict[int, int]]:
+    """Memory address 0 holds the number of quarters inserted."""
+    return {0: int(num_quarters)} if num_quarters is not None else None
+
 
-    should_continue = True
-    message = next(program)
-    output_message_count = 0
-    x = 0
-    y = 0
+def run_program(source_code: Union[str, ProgramImage], get_user_input, num_quarters=None,
+                record_path: Optional[str] = None):
+    """If `record_path` is given, the session is saved there (even if it's interrupted) for `replay_program`."""
+    patches = get_quarter_patches(num_quarters)
+    screen = Screen()
+    machine_type = RecordingMachine if record_path is not None else Machine
+    machine = machine_type(source_code, patches=patches)
     score = 0
 
-    while should_continue:
-        if message.type == MessageType.GET_INPUT:
-            print(screen, "\n")
-            user_input = keyboard_to_joystick_position[get_user_input(
-                message.arg)]
-            message = program.send(user_input)
-        if message.type == MessageType.PRINT_OUTPUT:
-            if output_message_count % 3 == 0:
-                x = message.arg
-            elif output_message_count % 3 == 1:
-                y = message.arg
-            elif output_message_count % 3 == 2:
+    try:
+        outputs = machine.run()
+        while True:
+            # Every tile on the screen is drawn with 3 consecutive outputs: x, y and tile ID (or score):
+            if len(outputs) % 3 != 0:
+                raise RuntimeError(
+                    f"Outputs should come in groups of 3. Received {len(outputs)} outputs.")
+            for x, y, value in zip(outputs[0::3], outputs[1::3], outputs[2::3]):
                 if x == -1 and y == 0:
-                    score = message.arg
+                    score = value
                     print(f"Score: {score}")
                 else:
-                    tile_id = int_to_tile_id[message.arg]
+                    tile_id = int_to_tile_id[value]
                     screen[Coord(x=x, y=y)] = tile_id
-            output_message_count += 1
-            message = next(program)
-        elif message.type == MessageType.TERMINATE:
-            if score == 0:
-                print("GAME OVER")
-            should_continue = False
-        else:
-            raise RuntimeError(
-                f"Unknown or unexpected message type {message.type}")
+            if machine.status == MachineStatus.TERMINATED:
+                if score == 0:
+                    print("GAME OVER")
+                break
+            elif machine.status == MachineStatus.WAITING_FOR_INPUT:
+                print(screen, "\n")
+                user_input = keyboard_to_joystick_position[get_user_input(input_prompt)]
+                outputs = machine.run([user_input])
+            else:
+                raise RuntimeError(
+                    f"Unknown or unexpected machine status {machine.status}")
+    finally:
+        if record_path is not None and isinstance(machine, RecordingMachine):
+            save_session_log(machine.log, record_path)
     return screen
 
 
+def replay_program(source_code: Union[str, ProgramImage], record_path: str, num_quarters=None) -> List[int]:
+    """Replay a session recorded by `run_program` as fast as possible, without drawing anything."""
+    machine_type = functools.partial(Machine, patches=get_quarter_patches(num_quarters))
+    return replay_session(source_code, load_session_log(record_path), machine_type)
+
+
+def get_final_score(outputs: List[int]) -> int:
+    return [value for x, y, value in zip(outputs[0::3], outputs[1::3], outputs[2::3]) if (x, y) == (-1, 0)][-1]
+
+
+def test_run_program():
+    # Draws a wall, a block and a ball then sets the score:
+    source_code = "104,0,104,0,104,1,104,1,104,0,104,2,104,2,104,0,104,4,104,-1,104,0,104,7,99"
+    screen = run_program(source_code, input)
+    assert screen.get_num_block_tiles() == 1
+    assert screen[Coord(x=2, y=0)] == TileId.BALL
+
+
+def test_quarters_are_patched_in(capsys):
+    # Adds (or with 2 quarters, multiplies) 3 and 4 and sets the score to the result:
+    source_code = "1,13,14,15,104,-1,104,0,4,15,99,0,0,3,4,0"
+    run_program(source_code, input)
+    assert "Score: 7" in capsys.readouterr().out
+    run_program(source_code, input, num_quarters=2)
+    assert "Score: 12" in capsys.readouterr().out
+
+
+def make_joystick_program(num_moves: int) -> str:
+    """A tiny game: draws a block, then adds each joystick position to the score `num_moves` times."""
+    return ",".join(str(x) for x in [
+        104, 1, 104, 1, 104, 2,  # 0: block at (1, 1)
+        104, -1, 104, 0, 4, 32,  # 6: score
+        3, 33,  # 12: read the joystick
+        1, 32, 33, 32,  # 14: score += joystick
+        1001, 34, -1, 34,  # 18: moves -= 1
+        1005, 34, 6,  # 22: if moves != 0, jump to 6
+        104, -1, 104, 0, 4, 32,  # 25: score
+        99,  # 31
+        0, 0, num_moves,  # 32: score, joystick, moves
+    ])
+
+
+def test_record_and_replay(tmp_path):
+    keys = iter("ddad")
+    path = str(tmp_path / "game")
+    run_program(make_joystick_program(4), lambda _: next(keys), record_path=path)
+    assert load_session_log(path).inputs == [1, 1, -1, 1]
+    outputs = replay_program(make_joystick_program(4), path)
+    assert get_final_score(outputs) == 2
+    # The number of quarters is part of the program:
+    with pytest.raises(ValueError):
+        replay_program(make_joystick_program(4), path, num_quarters=2)
+
+
 def part_one():
-    with open("day_13_input.txt") as f:
-        source_code = f.readline()
-        screen, _ = run_program(source_code, input)
-        return screen.get_num_block_tiles()
+    screen = run_program(ProgramImage.from_file("day_13_input.txt"), input)
+    return screen.get_num_block_tiles()
 
 
 # Note: These tests are commented out because the input and expected output are
@@ -163,18 +220,18 @@ def read_single_char_from_stdin(_):
     return readchar.readchar()
 
 
-def part_two():
-    with open("day_13_input.txt") as f:
-        source_code = f.readline()
-        print("""
+def part_two(record_path: Optional[str] = None):
+    image = ProgramImage.from_file("day_13_input.txt")
+    print("""
 Instruction:
 Press "a" o "j" to move the paddle left.
 Press "d" or "l" to move the paddle right.
 Press "s", "k" or "Enter" to keep it in the same position.
 """)
-        screen = run_program(source_code, read_single_char_from_stdin, 2)
-        return screen.get_num_block_tiles()
+    screen = run_program(image, read_single_char_from_stdin, 2, record_path)
+    return screen.get_num_block_tiles()
 
 
 if __name__ == "__main__":
-    part_two()
+    # Pass a path to record the game there:
+    part_two(sys.argv[1] if len(sys.argv) > 1 else None)
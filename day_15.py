@@ -1,7 +1,9 @@
 from enum import IntEnum, unique, auto
-from day_05 import compile_source_code, run_with_input_output, MessageType
+from day_05 import Machine, Buffer, PagedBuffer, ProgramImage
 from collections import deque
 from collections import namedtuple
+from typing import List
+import pytest
 
 # `path` is a series of `Direction`s to get to that point from (0, 0)
 Coord = namedtuple("Coord", ["x", "y", "path"])
@@ -15,10 +17,10 @@ class Direction(IntEnum):
 
 
 input_command_for_direction = {
-    Direction.NORTH: "1",
-    Direction.SOUTH: "2",
-    Direction.WEST: "3",
-    Direction.EAST: "4",
+    Direction.NORTH: 1,
+    Direction.SOUTH: 2,
+    Direction.WEST: 3,
+    Direction.EAST: 4,
 }
 
 displacements_for_direction = {
@@ -29,21 +31,53 @@ displacements_for_direction = {
 }
 
 
-def get_response_to_movement_command(program, direction: Direction) -> int:
-    next(program)
-    response = program.send(input_command_for_direction[direction])
-    if response.type == MessageType.PRINT_OUTPUT:
-        return response.arg
+def get_response_to_movement_command(machine: Machine, direction: Direction) -> int:
+    outputs = machine.run([input_command_for_direction[direction]])
+    if len(outputs) == 1:
+        return outputs[0]
     else:
-        raise ValueError("Should be an PRINT_OUTPUT message. Received ", response.type)
+        raise ValueError("Should be exactly one output. Received ", outputs)
 
 
-def traverse_breadth_first(program: str, should_terminate_at_oxygen_tank: bool) -> int:
+def traverse_breadth_first(program: Machine, should_terminate_at_oxygen_tank: bool):
     """
     If `should_terminate_at_oxygen_tank` is True, we stop the search when the oxygen tank is found
-    and return the count and path to reach the tank. That will solve part one.
+    and return the count, the path to reach the tank and a robot sitting at the tank. That will solve part one.
     If `should_terminate_at_oxygen_tank` is False, we will keep iterating until all accessible coords
     have been visited and return the count. This will solve part two.
+    Every coord in the queue comes with its own fork of the robot that is already standing there
+    so we never have to walk back to the origin. `program` itself is left where it is.
+    """
+    count = 0
+    queue = deque([(Coord(x=0, y=0, path=[]), program)])
+    visited = set([(0, 0)])
+    while len(queue) > 0:
+        count += 1
+        queue_length = len(queue)
+        for _ in range(queue_length):
+            ((x, y, path), robot) = queue.popleft()
+            for direction in Direction:
+                displacement = displacements_for_direction[direction]
+                new_x = x + displacement[0]
+                new_y = y + displacement[1]
+                if (new_x, new_y) not in visited:
+                    visited.add((new_x, new_y))
+                    moved_robot = robot.fork()
+                    response = get_response_to_movement_command(moved_robot, direction)
+                    if response == 2 and should_terminate_at_oxygen_tank:
+                        return (count, path + [direction], moved_robot)
+                    elif response == 0:
+                        pass
+                    else:
+                        queue.append((Coord(x=new_x, y=new_y, path=path + [direction]), moved_robot))
+    return (count - 1, None, None)
+
+
+def traverse_breadth_first_by_replaying(program: Machine, should_terminate_at_oxygen_tank: bool):
+    """
+    Same search as `traverse_breadth_first` (minus the returned robot) with a single robot that walks from
+    the origin to every coord in the queue and back again. After a search that terminates at the tank,
+    `program` is left at the tank.
     """
     count = 0
     queue = deque([Coord(x=0, y=0, path=[])])
@@ -100,28 +134,93 @@ def traverse_breadth_first(program: str, should_terminate_at_oxygen_tank: bool)
 
 
 def part_one():
-    with open("day_15_input.txt") as f:
-        source_code = f.readline()
-        program = compile_source_code(source_code)
-        num_steps, path = traverse_breadth_first(
-            program, should_terminate_at_oxygen_tank=True
-        )
-        path_values = [x.value for x in path]
-        print(path_values)
-        return num_steps
+    # Machines spawned from an image already use an overlay (`PagedBuffer`):
+    program = ProgramImage.from_file("day_15_input.txt").spawn()
+    num_steps, path, _ = traverse_breadth_first(
+        program, should_terminate_at_oxygen_tank=True
+    )
+    path_values = [x.value for x in path]
+    print(path_values)
+    return num_steps
 
 
 def part_two():
-    with open("day_15_input.txt") as f:
-        source_code = f.readline()
-        program_1 = compile_source_code(source_code)
-        # Note that after this run, the repair robot is at the oxygen tank:
-        traverse_breadth_first(program_1, should_terminate_at_oxygen_tank=True)
-        # Now we can do BFS from that oxygen tank location:
-        oxygen_spread_time, _ = traverse_breadth_first(
-            program_1, should_terminate_at_oxygen_tank=False
-        )
-        return oxygen_spread_time
+    program = ProgramImage.from_file("day_15_input.txt").spawn()
+    _, _, robot_at_oxygen_tank = traverse_breadth_first(program, should_terminate_at_oxygen_tank=True)
+    # Now we can do BFS from that oxygen tank location:
+    oxygen_spread_time, _, _ = traverse_breadth_first(
+        robot_at_oxygen_tank, should_terminate_at_oxygen_tank=False
+    )
+    return oxygen_spread_time
+
+
+def make_repair_droid_program(maze: List[str]) -> str:
+    """
+    Build an Intcode program that behaves like the repair droid in the puzzle inside `maze`, where "#" (or " ")
+    is a wall, "." is open, "O" is the oxygen system and "D" is where the droid starts.
+    """
+    width = max(len(line) for line in maze)
+    cells = [
+        {"#": 0, " ": 0, ".": 1, "D": 1, "O": 2}[char]
+        for line in maze for char in line.ljust(width)
+    ]
+    start = "".join(line.ljust(width) for line in maze).index("D")
+    code_length = 44
+    position, command, target, negated, status, deltas = range(code_length, code_length + 6)
+    grid = deltas + 5
+    code = [
+        3, command,  # 0: read the movement command
+        9, command,  # 2: point the relative base at the displacement for that command
+        2001, position, deltas, target,  # 4: target = position + displacement
+        1002, command, -1, negated,  # 8: point the relative base back at 0
+        9, negated,  # 12
+        9, target,  # 14: point the relative base at the target cell
+        1201, grid, 0, status,  # 16: status = content of the target cell
+        1002, target, -1, negated,  # 20: point the relative base back at 0
+        9, negated,  # 24
+        4, status,  # 26: report the status
+        1006, status, 0,  # 28: hit a wall, so stay put
+        1001, target, 0, position,  # 31: move to the target cell
+        1105, 1, 0,  # 35
+        99, 99, 99, 99, 99, 99,  # 38: padding
+    ]
+    assert len(code) == code_length
+    data = [start, 0, 0, 0, 0] + [0, -width, width, -1, 1] + cells
+    return ",".join(str(x) for x in code + data)
+
+
+example_maze = [
+    "#######",
+    "#D..#.#",
+    "#.#.#.#",
+    "#.#...#",
+    "#.###O#",
+    "#######",
+]
+
+
+def test_make_repair_droid_program():
+    machine = Machine(make_repair_droid_program(example_maze))
+    north, south, west, east = 1, 2, 3, 4
+    assert machine.run([north, west, east, east, south, south, north, east, east]) == [0, 0, 1, 1, 1, 1, 1, 0, 0]
+
+
+@pytest.mark.parametrize("buffer_type", [Buffer, PagedBuffer])
+def test_traverse_breadth_first(buffer_type):
+    program = Machine(make_repair_droid_program(example_maze), buffer_type=buffer_type)
+    num_steps, path, robot_at_oxygen_tank = traverse_breadth_first(program, should_terminate_at_oxygen_tank=True)
+    assert num_steps == 7
+    assert len(path) == 7
+    oxygen_spread_time, _, _ = traverse_breadth_first(robot_at_oxygen_tank, should_terminate_at_oxygen_tank=False)
+    assert oxygen_spread_time == 10
+
+
+def test_traverse_breadth_first_by_replaying():
+    program = Machine(make_repair_droid_program(example_maze))
+    num_steps, path = traverse_breadth_first_by_replaying(program, should_terminate_at_oxygen_tank=True)
+    assert num_steps == 7
+    oxygen_spread_time, _ = traverse_breadth_first_by_replaying(program, should_terminate_at_oxygen_tank=False)
+    assert oxygen_spread_time == 10
 
 
 # Note: These tests are commented out because the input and expected output are
@@ -0,0 +1,209 @@
+"""
+A small assembler for Intcode, so that larger programs (e.g. the benchmark programs in `intcode_corpus`) can be
+written with mnemonics and labels instead of hand-counted addresses. `assemble` returns source code for
+`compile_source_code`, `Machine` and the other engines.
+
+One statement per line, `;` starts a comment:
+
+    loop:   add counter, #-1, counter   ; operands are `address`, `#immediate` or `[rb+offset]`
+            jt counter, #loop
+            out [rb-1]
+            halt
+    counter: .word 10                   ; data: `.word value, ...` or `.zero num_cells`
+
+Wherever a number goes, a label (its address) or `$` (the address of the current statement) can go too, plus or
+minus a number. The relative base doubles as a stack pointer for `push`, `pop`, `call` and `ret`: the stack grows
+upwards from wherever the program points the relative base (e.g. `arb #stack`) and the relative base always points
+at the first free cell. `jmp target` is an unconditional jump.
+"""
+import re
+from typing import Dict, List, Tuple
+import pytest
+from day_05 import Machine, MachineStatus, int_to_op_code_and_num_operands, op_codes_that_write
+
+mnemonics: Dict[str, int] = {
+    "add": 1,
+    "mul": 2,
+    "in": 3,
+    "out": 4,
+    "jt": 5,
+    "jf": 6,
+    "lt": 7,
+    "eq": 8,
+    "arb": 9,
+    "halt": 99,
+}
+
+label_pattern = re.compile(r"([A-Za-z_]\w*)\s*:(.*)$")
+expression_pattern = re.compile(r"(?:([A-Za-z_]\w*|\$)\s*(?:([+-])\s*(\d+))?|(-?\d+))$")
+relative_pattern = re.compile(r"\[\s*rb\s*(?:([+-])\s*(.+?))?\s*\]$")
+
+
+def expand_macro(mnemonic: str, operands: List[str]) -> List[Tuple[str, List[str]]]:
+    """The statements that a macro stands for, or the statement itself if it isn't a macro."""
+    if mnemonic == "jmp":
+        return [("jt", ["#1", *operands])]
+    elif mnemonic == "push":
+        return [("add", [*operands, "#0", "[rb+0]"]), ("arb", ["#1"])]
+    elif mnemonic == "pop":
+        return [("arb", ["#-1"]), ("add", ["[rb+0]", "#0", *operands])]
+    elif mnemonic == "call":
+        # Push the address right after the jump (4 + 2 + 3 cells further on), then jump:
+        return [("add", ["#$+9", "#0", "[rb+0]"]), ("arb", ["#1"]), ("jt", ["#1", *(f"#{x}" for x in operands)])]
+    elif mnemonic == "ret":
+        return [("arb", ["#-1"]), ("jt", ["#1", "[rb+0]", *operands])]
+    else:
+        return [(mnemonic, operands)]
+
+
+macro_num_operands = {"jmp": 1, "push": 1, "pop": 1, "call": 1, "ret": 0}
+
+
+def get_size(mnemonic: str, operands: List[str]) -> int:
+    if mnemonic == ".word":
+        return len(operands)
+    elif mnemonic == ".zero":
+        if len(operands) != 1 or not operands[0].isdigit():
+            raise ValueError(".zero takes a number of cells")
+        return int(operands[0])
+    elif mnemonic in mnemonics:
+        num_operands = int_to_op_code_and_num_operands[mnemonics[mnemonic]][1]
+        if len(operands) != num_operands:
+            raise ValueError(f"{mnemonic} takes {num_operands} operands, not {len(operands)}")
+        return 1 + num_operands
+    else:
+        raise ValueError(f"Unknown mnemonic {mnemonic}")
+
+
+def evaluate(expression: str, labels: Dict[str, int], address: int) -> int:
+    match = expression_pattern.match(expression.strip())
+    if match is None:
+        raise ValueError(f"Can't make sense of {expression}")
+    name, sign, offset, number = match.groups()
+    if number is not None:
+        return int(number)
+    if name == "$":
+        value = address
+    elif name in labels:
+        value = labels[name]
+    else:
+        raise ValueError(f"Unknown label {name}")
+    if offset is not None:
+        value += int(offset) if sign == "+" else -int(offset)
+    return value
+
+
+def encode_operand(operand: str, labels: Dict[str, int], address: int) -> Tuple[int, int]:
+    """(mode, value) of an operand."""
+    if operand.startswith("#"):
+        return 1, evaluate(operand[1:], labels, address)
+    match = relative_pattern.match(operand)
+    if match is not None:
+        sign, expression = match.groups()
+        offset = 0 if expression is None else evaluate(expression, labels, address)
+        return 2, -offset if sign == "-" else offset
+    return 0, evaluate(operand, labels, address)
+
+
+def assemble(source: str) -> str:
+    """Turn assembly (see the module's docstring) into Intcode source code. Raise `ValueError` on mistakes."""
+    # First pass: where everything goes.
+    labels: Dict[str, int] = {}
+    statements: List[Tuple[int, int, str, List[str]]] = []
+    address = 0
+    for line_number, line in enumerate(source.splitlines(), 1):
+        try:
+            line = line.split(";")[0].strip()
+            match = label_pattern.match(line)
+            while match is not None:
+                label, line = match.group(1), match.group(2).strip()
+                if label in labels or label == "rb":
+                    raise ValueError(f"Label {label} can't be defined here")
+                labels[label] = address
+                match = label_pattern.match(line)
+            if not line:
+                continue
+            mnemonic, _, rest = line.partition(" ")
+            operands = [x.strip() for x in rest.split(",")] if rest.strip() else []
+            if mnemonic in macro_num_operands and len(operands) != macro_num_operands[mnemonic]:
+                raise ValueError(f"{mnemonic} takes {macro_num_operands[mnemonic]} operands, not {len(operands)}")
+            for expanded_mnemonic, expanded_operands in expand_macro(mnemonic, operands):
+                statements.append((line_number, address, expanded_mnemonic, expanded_operands))
+                address += get_size(expanded_mnemonic, expanded_operands)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}") from None
+    # Second pass: the values.
+    values: List[int] = []
+    for line_number, address, mnemonic, operands in statements:
+        try:
+            if mnemonic == ".word":
+                values.extend(evaluate(x, labels, address) for x in operands)
+            elif mnemonic == ".zero":
+                values.extend([0] * int(operands[0]))
+            else:
+                op_code = mnemonics[mnemonic]
+                encoded = [encode_operand(x, labels, address) for x in operands]
+                if int_to_op_code_and_num_operands[op_code][0] in op_codes_that_write and encoded[-1][0] == 1:
+                    raise ValueError(f"{mnemonic} can't write to an immediate operand")
+                values.append(op_code + sum(mode * 10 ** (2 + i) for i, (mode, _) in enumerate(encoded)))
+                values.extend(value for _, value in encoded)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}") from None
+    return ",".join(str(x) for x in values)
+
+
+def test_assemble():
+    assert assemble("""
+        ; day_05's example that compares its input with 8:
+                in x
+                eq x, #8, x
+                out x
+                halt
+        x:      .word 0
+    """) == "3,9,1008,9,8,9,4,9,99,0"
+    assert assemble("""
+        start:  add [rb+3], #-4, [rb-1]
+                jt $, #start+1
+        end:    .word end, $, 5
+                .zero 2
+    """) == "21201,3,-4,-1,1005,4,1,7,7,5,0,0"
+
+
+def test_assemble_stack_helpers():
+    source_code = assemble("""
+                arb #stack
+                push #5
+                call double
+                pop x
+                out x
+                jmp #end
+        double: mul [rb-2], #2, [rb-2]  ; the argument is below the return address
+                ret
+        end:    halt
+        x:      .word 0
+        stack:
+    """)
+    assert Machine(source_code).run() == [10]
+
+
+@pytest.mark.parametrize("source,message", [
+    ("nop", "Unknown mnemonic"),
+    ("add 1, 2", "takes 3 operands"),
+    ("in #5", "immediate"),
+    ("out x", "Unknown label"),
+    ("x: halt\nx: halt", "Line 2"),
+    ("rb: halt", "can't be defined"),
+    ("push", "takes 1 operands"),
+    ("out [rb*2]", "make sense"),
+    (".zero a", ".zero"),
+])
+def test_assemble_errors(source, message):
+    with pytest.raises(ValueError, match=message):
+        assemble(source)
+
+
+def test_assembled_programs_run_to_completion():
+    machine = Machine(assemble("in [rb+0]\narb #-1\nhalt"))
+    machine.run([3])
+    assert machine.status == MachineStatus.TERMINATED
+    assert machine.relative_base == -1
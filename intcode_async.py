@@ -0,0 +1,125 @@
+"""
+Run Intcode machines as asyncio coroutines that read their inputs from and write their outputs to
+`asyncio.Queue` channels, so that machines can be wired into pipelines or rings (like the amplifiers in day_07).
+
+Passing a value along costs one queue operation no matter how many machines there are.
+"""
+import asyncio
+from typing import Callable, List, Sequence, Union
+import pytest
+from day_05 import Machine, MachineStatus, ProgramImage, increment_program
+
+# Put into a machine's output channel when it terminates so that a machine waiting on that channel doesn't wait forever:
+end_of_output = None
+
+
+async def run_machine(machine: Machine, inputs: asyncio.Queue, outputs: asyncio.Queue):
+    """Run `machine` until it terminates, taking inputs from `inputs` whenever it blocks."""
+    pending_inputs: List[int] = []
+    upstream_terminated = False
+    while True:
+        for value in machine.run(pending_inputs):
+            outputs.put_nowait(value)
+        if machine.status == MachineStatus.TERMINATED:
+            outputs.put_nowait(end_of_output)
+            return
+        if upstream_terminated:
+            raise RuntimeError("Machine is waiting for input from a machine that has terminated")
+        # Wait for one input, then hand over everything else that is already there in one go:
+        pending_inputs = []
+        value = await inputs.get()
+        while True:
+            if value is end_of_output:
+                upstream_terminated = True
+                break
+            pending_inputs.append(value)
+            if inputs.empty():
+                break
+            value = inputs.get_nowait()
+
+
+def make_channel(initial_values: Sequence[int] = ()) -> asyncio.Queue:
+    channel: asyncio.Queue = asyncio.Queue()
+    for value in initial_values:
+        channel.put_nowait(value)
+    return channel
+
+
+def drain(channel: asyncio.Queue) -> List[int]:
+    """Everything left in `channel`, minus the end of output markers."""
+    values = []
+    while not channel.empty():
+        value = channel.get_nowait()
+        if value is not end_of_output:
+            values.append(value)
+    return values
+
+
+async def run_connected(machines: List[Machine], channels: List[asyncio.Queue]):
+    """Run `machines[i]` with inputs from `channels[i]` and outputs to `channels[(i + 1) % len(channels)]`."""
+    await asyncio.gather(*(
+        run_machine(machine, channels[i], channels[(i + 1) % len(channels)])
+        for i, machine in enumerate(machines)
+    ))
+
+
+async def run_pipeline(machines: List[Machine], initial_inputs: List[List[int]]) -> List[int]:
+    """
+    Feed the outputs of each machine into the next one. `initial_inputs[i]` is queued up for `machines[i]` before
+    anything runs. Return the outputs of the last machine.
+    """
+    channels = [make_channel(values) for values in initial_inputs] + [make_channel()]
+    await run_connected(machines, channels)
+    return drain(channels[-1])
+
+
+async def run_ring(machines: List[Machine], initial_inputs: List[List[int]]) -> List[int]:
+    """
+    Same as `run_pipeline` but the outputs of the last machine are fed back into the first one. Return the outputs
+    of the last machine that the first one didn't read before terminating.
+    """
+    channels = [make_channel(values) for values in initial_inputs]
+    await run_connected(machines, channels)
+    return drain(channels[0])
+
+
+def run_machines_in_ring(
+    program: Union[str, ProgramImage], initial_inputs: List[List[int]],
+    machine_type: Callable[[Union[str, ProgramImage]], Machine] = Machine
+) -> List[int]:
+    """
+    Start one machine per entry in `initial_inputs` and run them in a ring with asyncio. For a ring that doesn't
+    share the event loop with anything else, `intcode_scheduler.run_machines_in_ring_with_scheduler` is faster.
+    """
+    machines = [machine_type(program) for _ in initial_inputs]
+    return asyncio.run(run_ring(machines, initial_inputs))
+
+
+def test_run_pipeline():
+    machines = [Machine("3,0,1002,0,2,0,4,0,99") for _ in range(3)]
+    assert asyncio.run(run_pipeline(machines, [[5], [], []])) == [40]
+
+
+def test_run_ring_with_many_machines():
+    num_machines = 300
+    machines = [Machine(increment_program) for _ in range(num_machines)]
+    initial_inputs: List[List[int]] = [[] for _ in range(num_machines)]
+    initial_inputs[0] = [0]
+    asyncio.run(run_ring(machines, initial_inputs))
+    assert all(machine.status == MachineStatus.TERMINATED for machine in machines)
+    # Machine 99 outputs 1000 on the fourth time around. After that, every machine outputs one more number:
+    assert machines[99].read_memory(20) == 1000
+    assert machines[98].read_memory(20) == 1000 + num_machines - 1
+
+
+def test_run_machines_in_ring_from_image():
+    # The first machine outputs 1000 and terminates, so nobody reads the 1002 that the third one outputs:
+    image = ProgramImage.from_source_code(increment_program)
+    assert run_machines_in_ring(image, [[999], [], []]) == [1002]
+
+
+def test_waiting_on_a_terminated_machine():
+    # The second machine asks for two inputs but the first one only outputs one:
+    machines = [Machine("3,0,4,0,99"), Machine("3,0,3,0,99")]
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_pipeline(machines, [[1], []]))
@@ -0,0 +1,73 @@
+"""
+Run many independent jobs against the same Intcode program on a `ProcessPoolExecutor`.
+
+Each worker process receives the parsed program once, when it starts, and spawns a fresh machine from it for every
+job. Jobs are sent to the workers in chunks to keep the number of round trips down.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence, Union
+from day_05 import ProgramImage, large_program
+
+# The program of the worker process, set once by `initialize_worker`:
+worker_image: Optional[ProgramImage] = None
+
+
+def initialize_worker(values: List[int]):
+    global worker_image
+    worker_image = ProgramImage(values)
+
+
+def run_chunk(job_function: Callable[[ProgramImage, Any], Any], jobs: List[Any]) -> List[Any]:
+    image = worker_image
+    if image is None:
+        raise RuntimeError("run_chunk can only run in a worker started with initialize_worker")
+    return [job_function(image, job) for job in jobs]
+
+
+def run_inputs(image: ProgramImage, inputs: List[int]) -> List[int]:
+    """The default job: run a fresh machine with `inputs` and return its outputs."""
+    return image.spawn().run(inputs)
+
+
+def get_default_chunk_size(num_jobs: int, max_workers: int) -> int:
+    # A few chunks per worker so that a worker that gets slow jobs doesn't hold everyone up:
+    return max(1, math.ceil(num_jobs / (4 * max_workers)))
+
+
+def run_batch(
+    program: Union[str, ProgramImage],
+    jobs: Sequence[Any],
+    job_function: Callable[[ProgramImage, Any], Any] = run_inputs,
+    max_workers: int = 1,
+    chunk_size: Optional[int] = None,
+) -> List[Any]:
+    """
+    Return `[job_function(image, job) for job in jobs]`, in the same order as `jobs`, computed on `max_workers`
+    processes. `job_function` has to be a module-level function so that it can be sent to the workers.
+    """
+    image = program if isinstance(program, ProgramImage) else ProgramImage.from_source_code(program)
+    jobs = list(jobs)
+    if chunk_size is None:
+        chunk_size = get_default_chunk_size(len(jobs), max_workers)
+    elif chunk_size < 1:
+        raise ValueError(f"Chunk size should be at least 1. Received {chunk_size}")
+    chunks = [jobs[start:start + chunk_size] for start in range(0, len(jobs), chunk_size)]
+    with ProcessPoolExecutor(max_workers, initializer=initialize_worker, initargs=(image.to_list(),)) as executor:
+        results = executor.map(run_chunk, [job_function] * len(chunks), chunks)
+        return [result for chunk_results in results for result in chunk_results]
+
+
+def test_run_batch():
+    jobs = [[x] for x in range(4, 13)]
+    expected = [[999]] * 4 + [[1000]] + [[1001]] * 4
+    assert run_batch(large_program, jobs, max_workers=2) == expected
+    assert run_batch(large_program, jobs, max_workers=2, chunk_size=4) == expected
+    assert run_batch(ProgramImage.from_source_code(large_program), jobs, chunk_size=100) == expected
+    assert run_batch(large_program, []) == []
+
+
+def test_get_default_chunk_size():
+    assert get_default_chunk_size(120, 1) == 30
+    assert get_default_chunk_size(120, 8) == 4
+    assert get_default_chunk_size(3, 8) == 1
@@ -0,0 +1,607 @@
+"""
+Throughput benchmarks for the Intcode engines (`day_05` and the modules built on top of it).
+Run them with `python intcode_benchmarks.py`.
+"""
+import contextlib
+import io
+import os
+import re
+import tempfile
+import time
+import random
+import subprocess
+import sys
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+from day_05 import (run_with_input_output, run_with_native_io, decode_instruction, parse_instruction,
+                    compile_source_code, Machine, Buffer, Int64Buffer, PagedBuffer, ProgramImage, Profile, Limits,
+                    Trace, convert_to_int64_image, MessageType, StopWhen, increment_program)
+from intcode_compiler import CompiledMachine, compile_source_code_to_closures
+from intcode_async import run_machines_in_ring
+from intcode_batch import run_batch
+from intcode_fusion import FusedMachine, make_compare_loop_program
+from intcode_checkpoint import save_checkpoint, load_checkpoint
+from intcode_replay import load_session_log, replay_session
+from intcode_engines import engines
+from intcode_corpus import make_corpus
+import intcode_scheduler
+import day_02
+import day_11
+import day_13
+import day_15
+
+
+def make_countdown_program(num_iterations: int) -> str:
+    """
+    A loop-heavy program that counts a cell down from `num_iterations` to zero while adding 3 to an accumulator,
+    then outputs the accumulator. Each iteration executes 3 instructions.
+    """
+    return ",".join(str(x) for x in [
+        1101, 0, num_iterations, 100,  # 0: counter = num_iterations
+        1001, 100, -1, 100,  # 4: counter -= 1
+        1001, 101, 3, 101,  # 8: accumulator += 3
+        1005, 100, 4,  # 12: if counter != 0, jump to 4
+        4, 101,  # 15: output accumulator
+        99,  # 17
+    ])
+
+
+def test_make_countdown_program():
+    outputs: List[int] = []
+    run_with_input_output(make_countdown_program(10), input, outputs.append)
+    assert outputs == [30]
+
+
+def make_output_stream_program(num_outputs: int) -> str:
+    """An output-heavy program that outputs `num_outputs`, `num_outputs - 1`, ..., 1."""
+    return ",".join(str(x) for x in [
+        1101, 0, num_outputs, 100,  # 0: counter = num_outputs
+        4, 100,  # 4: output counter
+        1001, 100, -1, 100,  # 6: counter -= 1
+        1005, 100, 4,  # 10: if counter != 0, jump to 4
+        99,  # 13
+    ])
+
+
+def test_make_output_stream_program():
+    assert Machine(make_output_stream_program(3)).run() == [3, 2, 1]
+
+
+def count_instructions(run: Callable[[Callable], object]) -> int:
+    """Count how many instructions `run` executes by wrapping the decoder it is given."""
+    count = 0
+
+    def counting_decode(input_value):
+        nonlocal count
+        count += 1
+        return decode_instruction(input_value)
+
+    run(counting_decode)
+    return count
+
+
+def time_best_of(run: Callable[[], object], repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark_decode(num_iterations: int = 100_000):
+    source_code = make_countdown_program(num_iterations)
+    num_instructions = count_instructions(
+        lambda decode: run_with_input_output(source_code, input, lambda _: None, decode))
+    for name, decode in [("parse_instruction", parse_instruction), ("decode_instruction", decode_instruction)]:
+        elapsed = time_best_of(lambda: run_with_input_output(source_code, input, lambda _: None, decode))
+        print(f"{name:>20}: {num_instructions / elapsed:>12,.0f} instructions/s")
+
+
+def benchmark_engines(num_iterations: int = 300_000):
+    source_code = make_countdown_program(num_iterations)
+    num_instructions = count_instructions(
+        lambda decode: run_with_input_output(source_code, input, lambda _: None, decode))
+    baseline = None
+    for name, engine in [("compile_source_code", compile_source_code),
+                         ("compile_source_code_to_closures", compile_source_code_to_closures)]:
+        elapsed = time_best_of(lambda: run_with_input_output(source_code, input, lambda _: None, engine=engine))
+        baseline = baseline or elapsed
+        print(f"{name:>32}: {num_instructions / elapsed:>12,.0f} instructions/s ({baseline / elapsed:.1f}x)")
+
+
+def benchmark_batch_io(num_outputs: int = 100_000):
+    source_code = make_output_stream_program(num_outputs)
+    one_message_at_a_time = time_best_of(lambda: run_with_input_output(source_code, input, lambda _: None))
+    batched = time_best_of(lambda: Machine(source_code).run())
+    print(f"{'one message at a time':>32}: {num_outputs / one_message_at_a_time:>12,.0f} outputs/s")
+    print(f"{'Machine.run':>32}: {num_outputs / batched:>12,.0f} outputs/s")
+
+
+def make_maze(num_rows: int, num_columns: int, seed: int = 15) -> List[str]:
+    """A random maze (without loops) with the droid in the top left corner and the oxygen system in the bottom right."""
+    rng = random.Random(seed)
+    grid = [["#"] * (2 * num_columns + 1) for _ in range(2 * num_rows + 1)]
+    stack = [(0, 0)]
+    visited = {(0, 0)}
+    grid[1][1] = "."
+    while len(stack) > 0:
+        row, column = stack[-1]
+        neighbors = [(row + d_row, column + d_column) for d_row, d_column in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+                     if 0 <= row + d_row < num_rows and 0 <= column + d_column < num_columns
+                     and (row + d_row, column + d_column) not in visited]
+        if len(neighbors) == 0:
+            stack.pop()
+            continue
+        next_row, next_column = rng.choice(neighbors)
+        grid[row + next_row + 1][column + next_column + 1] = "."
+        grid[2 * next_row + 1][2 * next_column + 1] = "."
+        visited.add((next_row, next_column))
+        stack.append((next_row, next_column))
+    grid[1][1] = "D"
+    grid[2 * num_rows - 1][2 * num_columns - 1] = "O"
+    return ["".join(row) for row in grid]
+
+
+def benchmark_day_15(num_rows: int = 12, num_columns: int = 12):
+    source_code = day_15.make_repair_droid_program(make_maze(num_rows, num_columns))
+    runs = [
+        ("replaying paths", lambda: day_15.traverse_breadth_first_by_replaying(Machine(source_code), False)),
+        ("forking Buffer", lambda: day_15.traverse_breadth_first(Machine(source_code), False)),
+        ("forking PagedBuffer", lambda: day_15.traverse_breadth_first(
+            Machine(source_code, buffer_type=PagedBuffer), False)),
+    ]
+    # Forking a plain `Buffer` copies the whole program, a `PagedBuffer` only copies the pages that get written:
+    padded_source_code = source_code + ",0" * 100_000
+    runs += [
+        ("forking Buffer (+100k cells)", lambda: day_15.traverse_breadth_first(Machine(padded_source_code), False)),
+        ("forking PagedBuffer (+100k cells)", lambda: day_15.traverse_breadth_first(
+            Machine(padded_source_code, buffer_type=PagedBuffer), False)),
+    ]
+    baseline = None
+    for name, run in runs:
+        elapsed = time_best_of(run)
+        baseline = baseline or elapsed
+        print(f"{name:>34}: {elapsed * 1000:>10,.1f} ms ({baseline / elapsed:.1f}x)")
+
+
+def benchmark_program_image(num_machines: int = 600, num_cells: int = 2_000):
+    """Start many short-lived machines (like the amplifiers in day_07) from a program of `num_cells` cells."""
+    source_code = make_countdown_program(10) + ",0" * num_cells
+    image = ProgramImage.from_source_code(source_code)
+    runs = [
+        ("parsing source code", lambda: [Machine(source_code).run() for _ in range(num_machines)]),
+        ("spawning from ProgramImage", lambda: [image.spawn().run() for _ in range(num_machines)]),
+    ]
+    for name, run in runs:
+        elapsed = time_best_of(run)
+        print(f"{name:>32}: {num_machines / elapsed:>12,.0f} machines/s")
+
+
+def benchmark_profiling(num_iterations: int = 100_000):
+    """Profiling is opt-in: with `profile` left as None, `Machine.run` should be exactly as fast as before."""
+    source_code = make_countdown_program(num_iterations)
+    profiled_machine = Machine(source_code)
+    profiled_machine.profile = Profile()
+    profiled_machine.run()
+    num_instructions = profiled_machine.profile.num_instructions
+
+    def run_profiled():
+        machine = Machine(source_code)
+        machine.profile = Profile()
+        machine.run()
+
+    for name, run in [("profiling off", lambda: Machine(source_code).run()), ("profiling on", run_profiled)]:
+        elapsed = time_best_of(run, repeat=5)
+        print(f"{name:>32}: {num_instructions / elapsed:>12,.0f} instructions/s")
+
+
+def benchmark_day_02(num_instructions: int = 40):
+    program = day_02.make_gravity_assist_program(num_instructions)
+    # The last combination tried, so that both searches go through all 10,000 of them:
+    with_noun_and_verb = program.copy()
+    with_noun_and_verb[1:3] = [99, 99]
+    target = day_02.execute_program(with_noun_and_verb)[0]
+    runs = [
+        ("brute force", lambda: day_02.find_noun_and_verb_by_brute_force(program, target)),
+        ("lockstep", lambda: day_02.find_noun_and_verb(program, target)),
+        ("symbolic", lambda: day_02.find_noun_and_verb_symbolically(program, target)),
+    ]
+    baseline = None
+    for name, run in runs:
+        elapsed = time_best_of(run)
+        baseline = baseline or elapsed
+        print(f"{name:>34}: {elapsed * 1000:>10,.1f} ms ({baseline / elapsed:.1f}x)")
+
+
+def benchmark_ring(machine_counts: List[int] = [5, 50, 500, 5000]):
+    """
+    Pass a number around rings of different sizes until it reaches 1000, with asyncio and with `intcode_scheduler`.
+    The cost per message should stay flat.
+    """
+    for num_machines in machine_counts:
+        initial_inputs: List[List[int]] = [[] for _ in range(num_machines)]
+        initial_inputs[0] = [0]
+        # Every machine forwards one more number once the number has reached 1000:
+        num_messages = 1000 + num_machines - 1
+        runs = [("asyncio", run_machines_in_ring), ("scheduler", intcode_scheduler.run_machines_in_ring_with_scheduler)]
+        for name, run_in_ring in runs:
+            elapsed = time_best_of(lambda: run_in_ring(increment_program, initial_inputs))
+            print(f"{f'{num_machines} machines, {name}':>32}: {num_messages / elapsed:>12,.0f} messages/s")
+
+
+def benchmark_batch(num_jobs: int = 64, num_iterations: int = 5_000, worker_counts: List[int] = [1, 2, 4, 8]):
+    """Independent jobs that each count down from a different number, spread across processes."""
+    # Same as `make_countdown_program` but counts down from the input:
+    source_code = ",".join(str(x) for x in [
+        3, 100, 1001, 100, -1, 100, 1001, 101, 3, 101, 1005, 100, 2, 4, 101, 99])
+    jobs = [[num_iterations + i] for i in range(num_jobs)]
+    serial = time_best_of(lambda: [Machine(source_code).run(inputs) for inputs in jobs], repeat=1)
+    print(f"{'serial':>32}: {num_jobs / serial:>12,.1f} jobs/s")
+    for max_workers in worker_counts:
+        elapsed = time_best_of(lambda: run_batch(source_code, jobs, max_workers=max_workers), repeat=1)
+        print(f"{f'{max_workers} workers':>32}: {num_jobs / elapsed:>12,.1f} jobs/s ({serial / elapsed:.1f}x)")
+
+
+def benchmark_fusion(num_iterations: int = 100_000):
+    for name, make_program in [("countdown", make_countdown_program), ("compare loop", make_compare_loop_program)]:
+        source_code = make_program(num_iterations)
+        num_instructions = count_instructions(lambda decode: Machine(source_code, decode).run())
+        fused_machine = FusedMachine(source_code)
+        fused_machine.run()
+        report = fused_machine.get_fusion_report()
+        print(f"{name}: {report.num_fused_instructions} instructions fused into {report.num_superinstructions} "
+              f"superinstructions, {report.num_instructions_run_fused:,} of {num_instructions:,} instructions "
+              f"ran fused ({report.num_instructions_run_fused - report.num_superinstruction_runs:,} dispatches saved)")
+        baseline = None
+        for machine_type in [Machine, FusedMachine]:
+            elapsed = time_best_of(lambda: machine_type(source_code).run())
+            baseline = baseline or elapsed
+            print(f"{machine_type.__name__:>32}: {num_instructions / elapsed:>12,.0f} instructions/s "
+                  f"({baseline / elapsed:.1f}x)")
+
+
+def benchmark_int64_buffer(num_cells: int = 1_000_000, num_iterations: int = 100_000):
+    """Memory held by a machine with a big image (of values that aren't cached small ints) and execution speed."""
+    source_code = make_countdown_program(num_iterations) + "".join(f",{1000 + i}" for i in range(num_cells))
+    num_instructions = 3 * num_iterations + 3
+    for buffer_type in [Buffer, Int64Buffer]:
+        tracemalloc.start()
+        machine = Machine(source_code, buffer_type=buffer_type)
+        num_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del machine
+        elapsed = time_best_of(lambda: Machine(source_code, buffer_type=buffer_type).run())
+        print(f"{buffer_type.__name__:>32}: {num_bytes / 2 ** 20:>8,.1f} MiB, "
+              f"{num_instructions / elapsed:>12,.0f} instructions/s (including parsing)")
+
+
+def benchmark_checkpoint(num_iterations: int = 300_000, num_cells: int = 100_000):
+    """Restoring a machine that has done all of its work from a checkpoint vs running it again from the start."""
+    source_code = make_countdown_program(num_iterations) + ",0" * num_cells
+    machine = Machine(source_code)
+    machine.execute([], None, 3 * num_iterations)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkpoint")
+        saving = time_best_of(lambda: save_checkpoint(machine, path))
+        loading = time_best_of(lambda: load_checkpoint(path))
+        num_bytes = os.path.getsize(path)
+    re_executing = time_best_of(lambda: Machine(source_code).execute([], None, 3 * num_iterations), repeat=1)
+    print(f"{'checkpoint size':>32}: {num_bytes:>10,} bytes for {len(machine.memory):,} cells")
+    for name, elapsed in [("save", saving), ("load", loading), ("re-execute", re_executing)]:
+        print(f"{name:>32}: {elapsed * 1000:>10,.1f} ms")
+
+
+def benchmark_native_io(num_inputs: int = 100_000):
+    """Cost per input of an echo loop: through prompt strings and `int()`, through ints and in one batch."""
+    source_code = ",".join(str(x) for x in [
+        1101, 0, num_inputs, 101,  # 0: counter = num_inputs
+        3, 100,  # 4: read a number
+        4, 100,  # 6: output it
+        1001, 101, -1, 101,  # 8: counter -= 1
+        1005, 101, 4,  # 12: if counter != 0, jump to 4
+        99,  # 15
+    ])
+    runs = [
+        ("prompt and int()", lambda: run_with_input_output(source_code, lambda _: "7", lambda _: None)),
+        ("run_with_native_io", lambda: run_with_native_io(Machine(source_code), lambda: 7, lambda _: None)),
+        ("Machine.run (one batch)", lambda: Machine(source_code).run([7] * num_inputs)),
+    ]
+    for name, run in runs:
+        elapsed = time_best_of(run)
+        print(f"{name:>32}: {elapsed / num_inputs * 1e6:>8.2f} µs per input")
+
+
+def benchmark_limits(num_iterations: int = 300_000, repeat: int = 7):
+    """
+    Overhead of checking instruction, memory and time limits (none of which are hit) on a countdown loop, for the
+    interpreter and the compiled engine. Runs with and without limits take turns so that both see the same load.
+    """
+    source_code = make_countdown_program(num_iterations)
+    num_instructions = 3 * num_iterations + 3
+    limits = Limits(max_instructions=10 * num_instructions, max_memory_cells=10_000, max_seconds=600)
+    for machine_type in [Machine, CompiledMachine]:
+        timings: Dict[Optional[Limits], List[float]] = {None: [], limits: []}
+        for _ in range(repeat):
+            for machine_limits, run_timings in timings.items():
+                machine = machine_type(source_code)
+                machine.limits = machine_limits
+                start = time.perf_counter()
+                machine.run()
+                run_timings.append(time.perf_counter() - start)
+        baseline = min(timings[None])
+        for name, elapsed in [("no limits", baseline), ("all three limits", min(timings[limits]))]:
+            print(f"{machine_type.__name__ + ', ' + name:>32}: {num_instructions / elapsed:>12,.0f} instructions/s "
+                  f"({(elapsed / baseline - 1) * 100:+.1f}%)")
+
+
+def benchmark_trace(num_iterations: int = 300_000, num_cells: int = 4_000):
+    """Overhead of keeping a `Trace` on a countdown loop whose memory (which every snapshot copies) is padded."""
+    source_code = make_countdown_program(num_iterations) + ",0" * num_cells
+    num_instructions = 3 * num_iterations + 3
+
+    def run_traced():
+        machine = Machine(source_code)
+        machine.trace = Trace(num_entries=100)
+        machine.run()
+
+    baseline = time_best_of(lambda: Machine(source_code).run(), repeat=7)
+    for name, elapsed in [("no trace", baseline), ("trace of 100 entries", time_best_of(run_traced, repeat=7))]:
+        print(f"{name:>32}: {num_instructions / elapsed:>12,.0f} instructions/s "
+              f"({(elapsed / baseline - 1) * 100:+.1f}%)")
+
+
+def benchmark_replay(num_moves: int = 2_000):
+    """A day_13 game driven from the keyboard (keys scripted, screen thrown away) against replaying its log."""
+    source_code = day_13.make_joystick_program(num_moves)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "game")
+
+        def play():
+            with contextlib.redirect_stdout(io.StringIO()):
+                day_13.run_program(source_code, lambda _: "d", record_path=path)
+
+        played = time_best_of(play)
+        log = load_session_log(path)
+        print(f"{'log size':>32}: {os.path.getsize(path):>8} bytes for {len(log.inputs) + len(log.outputs)} values")
+    replayed = time_best_of(lambda: replay_session(source_code, log))
+    for name, elapsed in [("interactive (recording)", played), ("replay", replayed)]:
+        print(f"{name:>32}: {num_moves / elapsed:>12,.0f} moves/s")
+
+
+def benchmark_patches(num_instructions: int = 40, num_cells: int = 2_500, num_machines: int = 2_000):
+    """The day_02 sweep with list copies against undoing the writes, and the cost of starting a patched machine."""
+    program = day_02.make_gravity_assist_program(num_instructions)
+    target = day_02.execute_with_noun_and_verb(program, 99, 99)
+
+    def sweep_with_list_copies(program):
+        for noun in range(100):
+            for verb in range(100):
+                input_to_try = program.copy()
+                input_to_try[1] = noun
+                input_to_try[2] = verb
+                if day_02.execute_program(input_to_try)[0] == target:
+                    return 100 * noun + verb
+
+    # The same sweep on the program as it is and padded to `num_cells`, where a copy costs more than the run:
+    for sweep_name, program_to_sweep in [
+        ("day_02 sweep", program),
+        ("padded day_02 sweep", program + [0] * (num_cells - len(program))),
+    ]:
+        runs = [
+            (f"{sweep_name}, list copies", lambda: sweep_with_list_copies(program_to_sweep)),
+            (f"{sweep_name}, undone writes",
+             lambda: day_02.find_noun_and_verb_by_brute_force(program_to_sweep, target)),
+        ]
+        for name, run in runs:
+            print(f"{name:>34}: {time_best_of(run) * 1000:>10,.1f} ms")
+    # A program the size of a day_13 input, started with a different value at address 0 each time:
+    source_code = ",".join(str(x) for x in program + [0] * (num_cells - len(program)))
+    image = ProgramImage.from_source_code(source_code)
+    runs = [
+        ("re.sub and parse", lambda: [Machine(re.sub("^(\\d+)", str(n), source_code)) for n in range(num_machines)]),
+        ("image.spawn(patches=...)", lambda: [image.spawn(patches={0: n}) for n in range(num_machines)]),
+    ]
+    for name, run in runs:
+        print(f"{name:>34}: {time_best_of(run) / num_machines * 1e6:>10,.1f} µs per machine")
+
+
+def benchmark_cache(num_cells: int = 1_000_000):
+    """Loading a large program from a file: parsing every time against the on-disk cache of parsed images."""
+    source_code = ",".join(str((i * 7919) % 100_000 - 50_000) for i in range(num_cells))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "input.txt")
+        with open(path, "w") as f:
+            f.write(source_code + "\n")
+        cache_directory = os.path.join(directory, "cache")
+
+        def load_cold():
+            for name in os.listdir(cache_directory) if os.path.isdir(cache_directory) else []:
+                os.remove(os.path.join(cache_directory, name))
+            ProgramImage.from_file(path, cache_directory)
+
+        runs = [
+            ("parse (no cache)", lambda: ProgramImage.from_file(path, None)),
+            ("cold cache (parse and write)", load_cold),
+            ("warm cache", lambda: ProgramImage.from_file(path, cache_directory)),
+        ]
+        for name, run in runs:
+            print(f"{name:>32}: {time_best_of(run) * 1000:>10,.1f} ms")
+
+
+def paint_one_message_at_a_time(source_code: str) -> day_11.Board:
+    """day_11's original driver: every input and every output is a message of `compile_source_code`."""
+    board = day_11.Board(0)
+    position = day_11.Coord(x=0, y=0)
+    direction = day_11.Direction.UP
+    program = compile_source_code(source_code)
+    message = next(program)
+    num_outputs = 0
+    while message.type != MessageType.TERMINATE:
+        if message.type == MessageType.GET_INPUT:
+            message = program.send(board[position])
+            num_outputs = 0
+        else:
+            if num_outputs == 0:
+                board[position] = message.arg
+            else:
+                direction = day_11.left_turn[direction] if message.arg == 0 else day_11.right_turn[direction]
+                position = day_11.move_in_direction(position, direction)
+            num_outputs += 1
+            message = next(program)
+    return board
+
+
+def paint_with_run(source_code: str) -> day_11.Board:
+    """day_11's driver with `Machine.run`: one batch of outputs per input."""
+    board = day_11.Board(0)
+    position = day_11.Coord(x=0, y=0)
+    direction = day_11.Direction.UP
+    machine = Machine(source_code)
+    while True:
+        outputs = machine.run([board[position]])
+        if len(outputs) == 0:
+            return board
+        board[position], turn = outputs
+        direction = day_11.left_turn[direction] if turn == 0 else day_11.right_turn[direction]
+        position = day_11.move_in_direction(position, direction)
+
+
+def play_one_message_at_a_time(source_code: str, get_user_input: Callable[[str], str]):
+    """day_13's original driver, which prints the screen whenever the game asks for the joystick."""
+    screen = day_13.Screen()
+    program = compile_source_code(source_code)
+    message = next(program)
+    values: List[int] = []
+    while message.type != MessageType.TERMINATE:
+        if message.type == MessageType.GET_INPUT:
+            print(screen, "\n")
+            message = program.send(day_13.keyboard_to_joystick_position[get_user_input(message.arg)])
+        else:
+            values.append(message.arg)
+            if len(values) == 3:
+                x, y, value = values
+                if x == -1 and y == 0:
+                    print(f"Score: {value}")
+                else:
+                    screen[day_13.Coord(x=x, y=y)] = day_13.int_to_tile_id[value]
+                values = []
+            message = next(program)
+
+
+def benchmark_drivers(num_steps: int = 20_000):
+    """
+    The day_11 and day_13 drivers on scripted programs of `num_steps` inputs each: one message at a time (as they
+    were originally) and one `Machine.run` per input. day_11 now runs until each pair of outputs with `run_until`.
+    """
+    robot_source_code = day_11.make_langtons_ant_program(num_steps)
+    game_source_code = day_13.make_joystick_program(num_steps)
+    expected = day_11.run_program(robot_source_code, 0).get_num_panels_painted_at_least_once()
+    assert paint_with_run(robot_source_code).get_num_panels_painted_at_least_once() == expected
+    assert paint_one_message_at_a_time(robot_source_code).get_num_panels_painted_at_least_once() == expected
+
+    def play(run):
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(game_source_code, lambda _: "d")
+
+    runs = [
+        ("day_11, one message at a time", lambda: paint_one_message_at_a_time(robot_source_code)),
+        ("day_11, Machine.run", lambda: paint_with_run(robot_source_code)),
+        ("day_11, Machine.run_until", lambda: day_11.run_program(robot_source_code, 0)),
+        ("day_13, one message at a time", lambda: play(play_one_message_at_a_time)),
+        ("day_13, Machine.run", lambda: play(day_13.run_program)),
+    ]
+    for name, run in runs:
+        print(f"{name:>32}: {num_steps / time_best_of(run):>12,.0f} inputs/s")
+
+
+def measure_peak_memory(statement: str) -> float:
+    """Run `statement` in a fresh interpreter with `day_05` imported and return how much it grew the peak RSS (MiB)."""
+    script = f"""
+import resource, day_05
+from day_05 import *
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+{statement}
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+"""
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return int(output) / 1024
+
+
+def benchmark_large_image(num_cells: int = 10_000_000):
+    """
+    Startup of a machine on a program of `num_cells` cells (a few instructions followed by data): parsing the whole
+    line, streaming it into pages and mapping a pre-converted int64 image. Peak RSS is measured in a fresh process.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "input.txt")
+        with open(path, "w") as f:
+            f.write("1101,2,3,7,4,7,99,0")
+            for chunk_start in range(8, num_cells, 1 << 16):
+                f.write("".join(
+                    f",{i % 1000 - 500}" for i in range(chunk_start, min(chunk_start + (1 << 16), num_cells))))
+            f.write("\n")
+        image_path = os.path.join(directory, "input.bin")
+        start = time.perf_counter()
+        convert_to_int64_image(path, image_path)
+        print(f"{'convert to int64 image':>32}: {(time.perf_counter() - start) * 1000:>10,.0f} ms")
+        runs = [
+            ("interpreter start-up only", "pass"),
+            ("readline and split", f"Machine(open({path!r}).readline()).run()"),
+            ("stream into pages", f"ProgramImage.from_file({path!r}, None).spawn().run()"),
+            ("map int64 image", f"ProgramImage.from_int64_file({image_path!r}).spawn().run()"),
+        ]
+        for name, statement in runs:
+            start = time.perf_counter()
+            peak_memory = measure_peak_memory(statement)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>32}: {elapsed * 1000:>10,.0f} ms, peak RSS +{peak_memory:,.0f} MiB")
+
+
+def benchmark_corpus(scale: float = 1.0):
+    """
+    Millions of instructions per second of every registered engine on every program of `intcode_corpus`.
+    "-" means the engine doesn't support the program, "wrong" that it produced the wrong outputs.
+    """
+    print(f"{'':>26}" + "".join(f"{name:>10}" for name in engines))
+    for program in make_corpus(scale):
+        num_instructions = count_instructions(
+            lambda decode: Machine(program.source_code, decode).run(program.inputs))
+        cells = []
+        for engine in engines.values():
+            if not program.features <= engine.features:
+                cells.append("-")
+                continue
+            outputs: List[int] = []
+
+            def run():
+                outputs[:] = engine.create_machine(program.source_code).run(program.inputs)
+
+            elapsed = time_best_of(run)
+            cells.append(f"{num_instructions / elapsed / 1e6:.2f}" if outputs == program.expected_outputs else "wrong")
+        print(f"{program.name:>26}" + "".join(f"{cell:>10}" for cell in cells))
+
+
+if __name__ == "__main__":
+    benchmark_decode()
+    benchmark_engines()
+    benchmark_batch_io()
+    benchmark_day_15()
+    benchmark_program_image()
+    benchmark_profiling()
+    benchmark_day_02()
+    benchmark_ring()
+    benchmark_batch()
+    benchmark_fusion()
+    benchmark_int64_buffer()
+    benchmark_checkpoint()
+    benchmark_native_io()
+    benchmark_limits()
+    benchmark_trace()
+    benchmark_replay()
+    benchmark_patches()
+    benchmark_cache()
+    benchmark_large_image()
+    benchmark_corpus()
+    benchmark_drivers()
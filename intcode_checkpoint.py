@@ -0,0 +1,313 @@
+"""
+Save the complete state of a `day_05.Machine` (memory and its kind, instruction pointer, relative base, pending inputs
+and whether it is waiting for input) to a compact binary file, and restore a machine from it.
+
+A checkpoint is a short header followed by a zlib-compressed payload of integer lists. A list is stored as 64-bit
+integers if every value fits and as comma-separated decimals otherwise. Only the cells that the memory actually
+stores are written, so a program that wrote to a very high address doesn't produce a huge file.
+"""
+from array import array
+import io
+import os
+import signal
+import struct
+import sys
+import zlib
+from typing import BinaryIO, List, Optional, Sequence, Tuple
+import pytest
+from day_05 import Machine, MachineStatus, Buffer, Int64Buffer, PagedBuffer, ProgramImage, Limits, LimitExceeded
+from day_09 import quine_program, overflowing_program
+from day_11 import example_robot_program
+
+magic = b"ICKP"
+version = 2
+# Magic, version, machine status and kind of memory:
+header_format = "<4sBBB"
+
+# The kinds of memory that are restored as they were saved. Any other kind (e.g. the memory of a compiled machine)
+# is restored as the machine type's default:
+buffer_types = [Buffer, Int64Buffer, PagedBuffer]
+other_buffer_type = 255
+
+int64_values = 0
+decimal_values = 1
+
+
+def write_values(file: BinaryIO, values: List[int]):
+    try:
+        kind, data = int64_values, array('q', values).tobytes()
+    except OverflowError:
+        kind, data = decimal_values, ",".join(str(x) for x in values).encode("ascii")
+    file.write(struct.pack("<BQ", kind, len(data)))
+    file.write(data)
+
+
+def read_values(file: BinaryIO) -> List[int]:
+    kind, num_bytes = struct.unpack("<BQ", file.read(struct.calcsize("<BQ")))
+    data = file.read(num_bytes)
+    if kind == int64_values:
+        values = array('q')
+        values.frombytes(data)
+        return values.tolist()
+    elif kind == decimal_values:
+        return [int(x) for x in data.decode("ascii").split(",")] if num_bytes > 0 else []
+    else:
+        raise ValueError(f"Unknown kind of values {kind}")
+
+
+def merge_segments(segments: List[Tuple[int, List[int]]]) -> List[Tuple[int, List[int]]]:
+    """Join segments that are next to each other (like the pages of a `PagedBuffer`)."""
+    merged: List[Tuple[int, List[int]]] = []
+    for start, cells in segments:
+        if len(merged) > 0 and merged[-1][0] + len(merged[-1][1]) == start:
+            merged[-1][1].extend(cells)
+        else:
+            merged.append((start, list(cells)))
+    return merged
+
+
+def write_checkpoint(machine: Machine, file: BinaryIO, outputs: Sequence[int] = ()):
+    """
+    `outputs` are stored along with the machine so that whoever resumes from the checkpoint gets the outputs that
+    were produced before it.
+    """
+    memory_type = type(machine.memory)
+    buffer_type_code = buffer_types.index(memory_type) if memory_type in buffer_types else other_buffer_type
+    file.write(struct.pack(header_format, magic, version, machine.status.value, buffer_type_code))
+    payload = io.BytesIO()
+    segments = merge_segments(machine.memory.get_segments())
+    write_values(payload, [machine.index, machine.relative_base, machine.get_num_memory_cells(), len(segments)])
+    write_values(payload, list(machine.inputs))
+    write_values(payload, list(outputs))
+    for start, cells in segments:
+        write_values(payload, [start])
+        write_values(payload, cells)
+    file.write(zlib.compress(payload.getvalue(), 1))
+
+
+def read_checkpoint(file: BinaryIO, machine_type=Machine, **machine_options) -> Tuple[Machine, List[int]]:
+    """
+    Restore a machine from a checkpoint and return it together with the outputs stored with it.
+    `machine_type` and `machine_options` decide what kind of machine is restored. `buffer_type` defaults to the kind
+    of memory that the machine had when it was saved.
+    """
+    file_magic, file_version, status_value, buffer_type_code = struct.unpack(
+        header_format, file.read(struct.calcsize(header_format)))
+    if file_magic != magic:
+        raise ValueError("Not an Intcode checkpoint")
+    if file_version != version:
+        raise ValueError(f"Checkpoint version {file_version} isn't supported (expected {version})")
+    payload = io.BytesIO(zlib.decompress(file.read()))
+    index, relative_base, length, num_segments = read_values(payload)
+    inputs = read_values(payload)
+    outputs = read_values(payload)
+    segments = [(read_values(payload)[0], read_values(payload)) for _ in range(num_segments)]
+    first_cells = segments[0][1] if len(segments) > 0 and segments[0][0] == 0 else []
+    if buffer_type_code != other_buffer_type and "buffer_type" not in machine_options:
+        machine_options["buffer_type"] = buffer_types[buffer_type_code]
+    machine = machine_type(ProgramImage(first_cells), **machine_options)
+    for start, cells in segments:
+        if start == 0:
+            continue
+        for offset, value in enumerate(cells):
+            if value != 0:
+                machine.write_memory(start + offset, value)
+    if length > len(first_cells):
+        # Zeros at the end still count towards the length of the memory:
+        machine.write_memory(length - 1, machine.read_memory(length - 1))
+    machine.index = index
+    machine.relative_base = relative_base
+    machine.inputs.extend(inputs)
+    machine.status = MachineStatus(status_value)
+    return machine, outputs
+
+
+def save_checkpoint(machine: Machine, path: str, outputs: Sequence[int] = ()):
+    """Write to a temporary file first so that an interruption never leaves a half-written checkpoint behind."""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        write_checkpoint(machine, f, outputs)
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path: str, machine_type=Machine, **machine_options) -> Tuple[Machine, List[int]]:
+    with open(path, "rb") as f:
+        return read_checkpoint(f, machine_type, **machine_options)
+
+
+def run_with_checkpoints(
+    machine: Machine,
+    path: str,
+    inputs: Sequence[int] = (),
+    checkpoint_every: int = 10_000_000,
+    checkpoint_signal: Optional[int] = None,
+    outputs: Optional[List[int]] = None,
+) -> List[int]:
+    """
+    Same as `machine.run(inputs)` (including its `limits`, `trace` and `profile`) but saves a checkpoint to `path`
+    every `checkpoint_every` instructions and whenever the process receives `checkpoint_signal` (e.g.
+    `signal.SIGUSR1`, only from the main thread).
+    Pass the outputs returned by `load_checkpoint` as `outputs` to carry on where a checkpoint left off.
+    The returned outputs include those.
+    """
+    machine.inputs.extend(inputs)
+    outputs = [] if outputs is None else outputs
+    if machine.status == MachineStatus.TERMINATED:
+        return outputs
+    machine.status = MachineStatus.RUNNING
+    # Signals are only noticed between chunks of this many instructions:
+    chunk_size = min(checkpoint_every, 10_000)
+    checkpoint_requested = False
+
+    def request_checkpoint(signal_number, frame):
+        nonlocal checkpoint_requested
+        checkpoint_requested = True
+
+    previous_handler = None
+    if checkpoint_signal is not None:
+        previous_handler = signal.signal(checkpoint_signal, request_checkpoint)
+    try:
+        num_instructions_since_checkpoint = 0
+        while machine.status == MachineStatus.RUNNING:
+            num_instructions_since_checkpoint += machine.execute_with_settings(outputs, None, chunk_size)
+            if machine.status == MachineStatus.RUNNING and (
+                    checkpoint_requested or num_instructions_since_checkpoint >= checkpoint_every):
+                save_checkpoint(machine, path, outputs)
+                checkpoint_requested = False
+                num_instructions_since_checkpoint = 0
+    finally:
+        if checkpoint_signal is not None:
+            signal.signal(checkpoint_signal, previous_handler)
+    return outputs
+
+
+def resume_from_checkpoint(path: str, inputs: Sequence[int] = (), checkpoint_every: int = 10_000_000,
+                           machine_type=Machine, **machine_options) -> Tuple[Machine, List[int]]:
+    """Load a checkpoint and keep running it (with checkpoints). Return the machine and all of its outputs."""
+    machine, outputs = load_checkpoint(path, machine_type, **machine_options)
+    return machine, run_with_checkpoints(machine, path, inputs, checkpoint_every, outputs=outputs)
+
+
+def get_state(machine: Machine):
+    return (machine.memory.to_list(), machine.index, machine.relative_base, list(machine.inputs), machine.status)
+
+
+@pytest.mark.parametrize("source_code", [quine_program, overflowing_program])
+@pytest.mark.parametrize("num_instructions", [0, 1, 5, 20])
+def test_round_trip_day_09(source_code, num_instructions, tmp_path):
+    reference = Machine(source_code)
+    expected_outputs = reference.run()
+    machine = Machine(source_code)
+    outputs: List[int] = []
+    machine.execute(outputs, None, num_instructions)
+    path = str(tmp_path / "checkpoint")
+    save_checkpoint(machine, path, outputs)
+    restored, restored_outputs = load_checkpoint(path)
+    assert get_state(restored) == get_state(machine)
+    assert restored_outputs + restored.run() == expected_outputs
+    assert get_state(restored) == get_state(reference)
+
+
+def test_round_trip_day_11(tmp_path):
+    colors = [0, 0, 0, 0, 1, 0, 0]
+    reference = Machine(example_robot_program)
+    expected_outputs = [output for color in colors for output in reference.run([color])]
+    machine = Machine(example_robot_program)
+    outputs = [output for color in colors[:3] for output in machine.run([color])]
+    # Checkpointed while waiting for the fourth color:
+    assert machine.status == MachineStatus.WAITING_FOR_INPUT
+    path = str(tmp_path / "checkpoint")
+    save_checkpoint(machine, path, outputs)
+    restored, restored_outputs = load_checkpoint(path)
+    assert restored.status == MachineStatus.WAITING_FOR_INPUT
+    assert restored_outputs + [output for color in colors[3:] for output in restored.run([color])] == expected_outputs
+    assert get_state(restored) == get_state(reference)
+
+
+@pytest.mark.parametrize("buffer_type", [Buffer, Int64Buffer, PagedBuffer])
+def test_sparse_memory(buffer_type, tmp_path):
+    # Writes its input to a very high address, then outputs it:
+    source_code = "3,1000000000000,4,1000000000000,99"
+    machine = Machine(source_code, buffer_type=buffer_type)
+    machine.run([2 ** 70])
+    path = str(tmp_path / "checkpoint")
+    save_checkpoint(machine, path)
+    assert os.path.getsize(path) < 1000
+    restored, _ = load_checkpoint(path, buffer_type=buffer_type)
+    assert len(restored.memory) == len(machine.memory) == 10 ** 12 + 1
+    assert restored.read_memory(10 ** 12) == 2 ** 70
+    assert restored.memory.get_segments()[0] == machine.memory.get_segments()[0]
+
+
+@pytest.mark.parametrize("buffer_type", [Buffer, Int64Buffer, PagedBuffer])
+def test_restores_the_kind_of_memory(buffer_type, tmp_path):
+    machine = Machine(quine_program, buffer_type=buffer_type)
+    machine.execute([], None, 10)
+    path = str(tmp_path / "checkpoint")
+    save_checkpoint(machine, path)
+    restored, _ = load_checkpoint(path)
+    assert type(restored.memory) is buffer_type
+    assert get_state(restored) == get_state(machine)
+    # Unless another kind is asked for:
+    restored, _ = load_checkpoint(path, buffer_type=PagedBuffer if buffer_type is Buffer else Buffer)
+    assert type(restored.memory) is not buffer_type
+    assert get_state(restored) == get_state(machine)
+
+
+def test_run_with_checkpoints(tmp_path):
+    # Counts down from 10000 and outputs 1, 2, 3 along the way:
+    source_code = "104,1,1101,0,10000,100,1001,100,-1,100,1005,100,6,104,2,104,3,99"
+    path = str(tmp_path / "checkpoint")
+    machine = Machine(source_code)
+    assert run_with_checkpoints(machine, path, checkpoint_every=1000) == [1, 2, 3]
+    # The last checkpoint was taken before the countdown finished:
+    restored, outputs = load_checkpoint(path)
+    assert outputs == [1]
+    assert 0 < restored.read_memory(100) <= 1000
+    resumed, outputs = resume_from_checkpoint(path)
+    assert outputs == [1, 2, 3]
+    assert get_state(resumed) == get_state(machine)
+
+
+def test_run_with_checkpoints_honours_limits(tmp_path):
+    # Loops forever:
+    machine = Machine("1105,1,0")
+    machine.limits = Limits(max_instructions=25_000)
+    with pytest.raises(LimitExceeded):
+        run_with_checkpoints(machine, str(tmp_path / "checkpoint"), checkpoint_every=1000)
+    assert machine.num_instructions_executed == 25_000
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="needs SIGUSR1")
+def test_checkpoint_on_signal(tmp_path, monkeypatch):
+    # Long enough that it won't finish before the checkpoint, short enough not to hang if there never is one:
+    source_code = "1101,0,1000000,100,1001,100,-1,100,1005,100,4,99"
+    path = str(tmp_path / "checkpoint")
+    machine = Machine(source_code)
+    # Stop the run as soon as the first checkpoint has been written:
+    original_save_checkpoint = save_checkpoint
+
+    def save_checkpoint_and_stop(*args):
+        original_save_checkpoint(*args)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(sys.modules[__name__], "save_checkpoint", save_checkpoint_and_stop)
+    # Send the signal from the first chunk, when the handler is certainly installed. `raise_signal` only returns
+    # once the handler has run:
+    original_execute = machine.execute_with_settings
+
+    def signal_and_execute(*args):
+        signal.raise_signal(signal.SIGUSR1)
+        return original_execute(*args)
+
+    monkeypatch.setattr(machine, "execute_with_settings", signal_and_execute)
+    with pytest.raises(KeyboardInterrupt):
+        run_with_checkpoints(machine, path, checkpoint_signal=signal.SIGUSR1)
+    restored, _ = load_checkpoint(path)
+    assert restored.read_memory(100) == 1000000 - 5000
+    assert get_state(restored) == get_state(machine)
+
+
+def test_invalid_checkpoint():
+    with pytest.raises(ValueError):
+        read_checkpoint(io.BytesIO(b"nope\x02\x01\x00"))
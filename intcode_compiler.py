@@ -0,0 +1,687 @@
+"""
+A second Intcode execution engine that translates the program into Python functions, one per basic block.
+
+A basic block is a run of instructions that starts wherever execution enters it and ends with a jump, just before
+an input, output or terminate instruction, or after `max_block_length` instructions. Each block becomes a Python
+function (generated with `exec`) in which the operand modes and operands are already resolved, so executing it
+doesn't decode anything. I/O and termination are left to the dispatch loop in `CompiledMachine`, which has the
+same interface as `day_05.Machine`.
+
+Every memory cell that belongs to a compiled block is flagged. A write to a flagged cell throws away the blocks
+that cover it and leaves the current block. Blocks that keep getting overwritten are interpreted one instruction at
+a time instead of being recompiled over and over.
+"""
+from typing import Callable, Dict, List, Tuple, Optional, Union, cast
+import bisect
+import heapq
+import sys
+from unittest.mock import Mock, call
+import pytest
+from day_05 import (
+    Op_Code,
+    Mode,
+    Buffer,
+    PagedBuffer,
+    LimitExceeded,
+    Limits,
+    Machine,
+    MachineStatus,
+    ProgramImage,
+    Profile,
+    decode_instruction,
+    run_machine_as_program,
+    run_with_input_output,
+    simple_programs,
+    input_output_programs,
+    large_program,
+    countdown_program,
+)
+
+max_block_length = 64
+# A compiled block takes the relative base and returns where execution continues, the new relative base and the
+# number of instructions it executed:
+CompiledBlock = Callable[[int], Tuple[int, int, int]]
+# A block that has been invalidated this many times is interpreted from then on:
+max_invalidations = 2
+
+terminal_op_codes = {Op_Code.INPUT, Op_Code.OUTPUT, Op_Code.TERMINATE}
+jump_op_codes = {Op_Code.JUMP_IF_TRUE, Op_Code.JUMP_IF_FALSE}
+arithmetic_expressions = {
+    Op_Code.ADD: "{0} + {1}",
+    Op_Code.MULTIPLY: "{0} * {1}",
+    Op_Code.LESS_THAN: "1 if {0} < {1} else 0",
+    Op_Code.EQUALS: "1 if {0} == {1} else 0",
+}
+jump_conditions = {
+    Op_Code.JUMP_IF_TRUE: "{0} != 0",
+    Op_Code.JUMP_IF_FALSE: "{0} == 0",
+}
+
+
+def mode_can_fail(mode: Mode, operand: int) -> bool:
+    """Whether reading the operand can raise (on a negative address)."""
+    return mode == Mode.RELATIVE or (mode == Mode.POSITION and operand < 0)
+
+
+class BlockCompiler:
+    """Holds the memory of one running program together with the blocks compiled from it."""
+
+    def __init__(self, initial_values: List[int], decode=decode_instruction):
+        self.decode = decode
+        # Plain list so that generated code can index it directly. It only ever grows (in place), at least doubling
+        # its capacity every time. Cells past `dense_length` are spare capacity filled with zeros:
+        self.memory: List[int] = list(initial_values)
+        # One past the highest address in `memory` that has been written to, in a list so that generated code sees
+        # it change. Writes past it go through `write`, which moves it:
+        self.dense_length = [len(self.memory)]
+        # `code_flags[address]` is 1 if the cell belongs to at least one compiled block:
+        self.code_flags = bytearray(len(self.memory))
+        # Cells that are too far past the end of `memory` to be worth allocating everything in between, and their
+        # addresses in order:
+        self.far_cells: Dict[int, int] = {}
+        self.far_addresses: List[int] = []
+        self.blocks: Dict[int, CompiledBlock] = {}
+        self.block_extents: Dict[int, Tuple[int, int]] = {}
+        # Number of instructions in each block:
+        self.block_lengths: Dict[int, int] = {}
+        self.blocks_covering_cell: Dict[int, List[int]] = {}
+        self.invalidation_counts: Dict[int, int] = {}
+        # Blocks that had to go through `rd`/`wr` for a fixed address past `dense_length`, keyed by block start.
+        # They are recompiled once `dense_length` has gone past the highest such address. The heap holds
+        # (highest address, block start), lowest first:
+        self.blocks_waiting_for_growth: Dict[int, int] = {}
+        self.growth_heap: List[Tuple[int, int]] = []
+        # Blocks that extend past the end of `memory` (those cells read as zero), keyed by block start. Their cells
+        # are flagged as code as `memory` grows over them:
+        self.blocks_past_end: Dict[int, int] = {}
+        self.__highest_address_past_end = -1
+        self.namespace = {"m": self.memory, "ln": self.dense_length, "cf": self.code_flags,
+                          "rd": self.read, "wr": self.write, "inv": self.invalidate}
+
+    @classmethod
+    def from_buffer(cls, buffer, decode=decode_instruction) -> "BlockCompiler":
+        """A compiler holding the cells of `buffer` (a `Buffer`, a `PagedBuffer` or a `CompiledMemory`)."""
+        compiler = cls([], decode)
+        memory = compiler.memory
+        for start, cells in buffer.get_segments():
+            if start - len(memory) <= Buffer.max_dense_gap:
+                memory.extend([0] * (start - len(memory)))
+                memory.extend(cells)
+            else:
+                compiler.far_cells.update(zip(range(start, start + len(cells)), cells))
+        compiler.far_addresses.extend(sorted(compiler.far_cells))
+        compiler.dense_length[0] = len(memory)
+        compiler.code_flags.extend(bytes(len(memory)))
+        return compiler
+
+    def get_length(self) -> int:
+        """One past the highest address that has been written to."""
+        return max(self.dense_length[0], self.far_addresses[-1] + 1 if len(self.far_addresses) > 0 else 0)
+
+    def read(self, address: int) -> int:
+        if address < 0:
+            raise IndexError(f"Key {address} is a negative address.")
+        if address < len(self.memory):
+            return self.memory[address]
+        return self.far_cells.get(address, 0)
+
+    def write(self, address: int, value: int) -> bool:
+        """
+        Write to any address. Return True if the write hit a compiled block (which is then invalidated) or if it
+        grew memory and blocks were discarded, so that a running block has to stop.
+        """
+        if address < 0:
+            raise IndexError(f"Key {address} is a negative address.")
+        memory = self.memory
+        if address - len(memory) > Buffer.max_dense_gap:
+            if address not in self.far_cells:
+                bisect.insort(self.far_addresses, address)
+            self.far_cells[address] = value
+            if address not in self.blocks_covering_cell:
+                return False
+            self.invalidate(address, 0, 0, 0)
+            return True
+        if address >= len(memory):
+            self.__grow(address + 1)
+        memory[address] = value
+        if address >= self.dense_length[0] and self.__extend_dense_length(address + 1):
+            # The running block may be one of the discarded blocks, and its cells don't count as code any more:
+            return True
+        if not self.code_flags[address]:
+            return False
+        self.invalidate(address, 0, 0, 0)
+        return True
+
+    def __grow(self, min_capacity: int):
+        """Make `memory` hold at least `min_capacity` cells, at least doubling it."""
+        memory = self.memory
+        capacity = len(memory)
+        new_capacity = max(min_capacity, 2 * capacity)
+        memory.extend([0] * (new_capacity - capacity))
+        self.code_flags.extend(bytes(new_capacity - capacity))
+        for start, end in list(self.blocks_past_end.items()):
+            for covered in range(capacity, min(end, new_capacity)):
+                if covered in self.blocks_covering_cell:
+                    self.code_flags[covered] = 1
+            if end <= new_capacity:
+                del self.blocks_past_end[start]
+        num_moved = bisect.bisect_left(self.far_addresses, new_capacity)
+        if num_moved > 0:
+            for far_address in self.far_addresses[:num_moved]:
+                memory[far_address] = self.far_cells.pop(far_address)
+            highest_moved = self.far_addresses[num_moved - 1]
+            del self.far_addresses[:num_moved]
+            if highest_moved >= self.dense_length[0]:
+                self.__extend_dense_length(highest_moved + 1)
+
+    def __extend_dense_length(self, new_length: int) -> bool:
+        """Move `dense_length` up to `new_length`. Return True if blocks waiting for that were discarded."""
+        self.dense_length[0] = new_length
+        growth_heap = self.growth_heap
+        discarded_any = False
+        while len(growth_heap) > 0 and growth_heap[0][0] < new_length:
+            highest_address, start = heapq.heappop(growth_heap)
+            # Blocks that have been discarded (and maybe compiled again) since they were pushed are skipped:
+            if self.blocks_waiting_for_growth.get(start) == highest_address:
+                self.__discard_block(start)
+                discarded_any = True
+        return discarded_any
+
+    def invalidate(self, address: int, next_index: int, relative_base: int,
+                   num_executed: int) -> Tuple[int, int, int]:
+        """Throw away every block that covers `address` and tell the running block what to return."""
+        for start in self.blocks_covering_cell.pop(address, []):
+            if start in self.blocks:
+                self.__discard_block(start)
+                self.invalidation_counts[start] = self.invalidation_counts.get(start, 0) + 1
+        if address < len(self.code_flags):
+            self.code_flags[address] = 0
+        return (next_index, relative_base, num_executed)
+
+    def __discard_block(self, start: int):
+        del self.blocks[start]
+        self.blocks_waiting_for_growth.pop(start, None)
+        self.blocks_past_end.pop(start, None)
+        block_start, block_end = self.block_extents.pop(start)
+        del self.block_lengths[start]
+        for covered in range(block_start, block_end):
+            starts = self.blocks_covering_cell.get(covered)
+            if starts is not None and start in starts:
+                starts.remove(start)
+                if len(starts) == 0:
+                    del self.blocks_covering_cell[covered]
+                    if covered < len(self.code_flags):
+                        self.code_flags[covered] = 0
+
+    def should_interpret(self, index: int) -> bool:
+        return self.invalidation_counts.get(index, 0) >= max_invalidations
+
+    def compile_block(self, start: int) -> CompiledBlock:
+        """Compile the block starting at `start`, which must not be an I/O or terminate instruction."""
+        lines: List[str] = []
+        index = start
+        self.__highest_address_past_end = -1
+        num_instructions = 0
+        for _ in range(max_block_length):
+            try:
+                op_code, num_operands, modes = self.decode(self.read(index))
+            except KeyError:
+                if index == start:
+                    raise
+                # Leave the invalid instruction for when execution actually reaches it:
+                break
+            if op_code in terminal_op_codes:
+                break
+            operands = [self.read(index + offset) for offset in range(1, num_operands + 1)]
+            next_index = index + num_operands + 1
+            num_instructions += 1
+            lines.extend(self.__compile_instruction(op_code, modes, operands, next_index, num_instructions))
+            index = next_index
+            if op_code in jump_op_codes:
+                break
+        lines.append(f"return ({index}, rb, {num_instructions})")
+
+        source = "def block(rb, m=m, ln=ln, cf=cf, rd=rd, wr=wr, inv=inv):\n" + "".join(
+            f"    {line}\n" for line in lines)
+        exec(source, self.namespace)
+        block = cast(CompiledBlock, self.namespace.pop("block"))
+
+        self.blocks[start] = block
+        self.block_extents[start] = (start, index)
+        self.block_lengths[start] = num_instructions
+        highest_address = self.__highest_address_past_end
+        if self.dense_length[0] <= highest_address <= len(self.memory) + Buffer.max_dense_gap:
+            self.blocks_waiting_for_growth[start] = highest_address
+            heapq.heappush(self.growth_heap, (highest_address, start))
+        if index > len(self.memory):
+            self.blocks_past_end[start] = index
+        for address in range(start, index):
+            self.blocks_covering_cell.setdefault(address, []).append(start)
+            if address < len(self.memory):
+                self.code_flags[address] = 1
+        return block
+
+    def __compile_instruction(self, op_code: Op_Code, modes, operands: List[int], next_index: int,
+                              num_executed: int) -> List[str]:
+        """`num_executed` is how many instructions of the block have run once this one has."""
+        if op_code in arithmetic_expressions:
+            value = arithmetic_expressions[op_code].format(
+                self.__compile_read(modes[0], operands[0], "a"), self.__compile_read(modes[1], operands[1], "b"))
+            return [f"v = {value}"] + self.__compile_write(modes[2], operands[2], next_index, num_executed)
+        elif op_code in jump_op_codes:
+            condition = jump_conditions[op_code].format(self.__compile_read(modes[0], operands[0], "a"))
+            target = self.__compile_read(modes[1], operands[1], "b")
+            if mode_can_fail(modes[1], operands[1]):
+                # The interpreter reads the target (and fails on a negative address) even if it doesn't jump:
+                return [f"t = {target}", f"if {condition}:", f"    return (t, rb, {num_executed})"]
+            return [f"if {condition}:", f"    return ({target}, rb, {num_executed})"]
+        elif op_code == Op_Code.ADJUST_RELATIVE_BASE:
+            return [f"rb += {self.__compile_read(modes[0], operands[0], 'a')}"]
+        else:
+            raise RuntimeError(f"Cannot compile op code {op_code}")
+
+    def __compile_read(self, mode: Mode, operand: int, name: str) -> str:
+        if mode == Mode.IMMEDIATE:
+            return f"({operand})"
+        elif mode == Mode.POSITION:
+            # Memory never shrinks so an address that is in range now will always be in range:
+            if 0 <= operand < len(self.memory):
+                return f"m[{operand}]"
+            self.__highest_address_past_end = max(self.__highest_address_past_end, operand)
+            return f"rd({operand})"
+        elif mode == Mode.RELATIVE:
+            return f"(m[{name}] if 0 <= ({name} := rb + {operand}) < len(m) else rd({name}))"
+        else:
+            raise RuntimeError('Invalid mode ' + str(mode))
+
+    def __compile_write(self, mode: Mode, operand: int, next_index: int, num_executed: int) -> List[str]:
+        if mode != Mode.RELATIVE and 0 <= operand < self.dense_length[0]:
+            return [f"m[{operand}] = v", f"if cf[{operand}]: return inv({operand}, {next_index}, rb, {num_executed})"]
+        if mode != Mode.RELATIVE:
+            self.__highest_address_past_end = max(self.__highest_address_past_end, operand)
+        address = f"rb + {operand}" if mode == Mode.RELATIVE else f"{operand}"
+        return [
+            f"t = {address}",
+            "if 0 <= t < ln[0]:",
+            "    m[t] = v",
+            f"    if cf[t]: return inv(t, {next_index}, rb, {num_executed})",
+            f"elif wr(t, v): return ({next_index}, rb, {num_executed})",
+        ]
+
+    def read_operand(self, mode: Mode, operand: int, relative_base: int) -> int:
+        if mode == Mode.POSITION:
+            return self.read(operand)
+        elif mode == Mode.RELATIVE:
+            return self.read(operand + relative_base)
+        elif mode == Mode.IMMEDIATE:
+            return operand
+        else:
+            raise RuntimeError('Invalid mode ' + str(mode))
+
+    def write_operand(self, mode: Mode, operand: int, relative_base: int, value: int):
+        self.write(operand + relative_base if mode == Mode.RELATIVE else operand, value)
+
+    def interpret_one(self, index: int, relative_base: int) -> Tuple[int, int]:
+        """Execute the single (non I/O) instruction at `index` without compiling it."""
+        op_code, num_operands, modes = self.decode(self.read(index))
+        operands = [self.read(index + offset) for offset in range(1, num_operands + 1)]
+        next_index = index + num_operands + 1
+        if op_code in arithmetic_expressions:
+            operand_1 = self.read_operand(modes[0], operands[0], relative_base)
+            operand_2 = self.read_operand(modes[1], operands[1], relative_base)
+            if op_code == Op_Code.ADD:
+                result = operand_1 + operand_2
+            elif op_code == Op_Code.MULTIPLY:
+                result = operand_1 * operand_2
+            elif op_code == Op_Code.LESS_THAN:
+                result = 1 if operand_1 < operand_2 else 0
+            else:
+                result = 1 if operand_1 == operand_2 else 0
+            self.write_operand(modes[2], operands[2], relative_base, result)
+        elif op_code in jump_op_codes:
+            operand_1 = self.read_operand(modes[0], operands[0], relative_base)
+            target = self.read_operand(modes[1], operands[1], relative_base)
+            if (operand_1 != 0) == (op_code == Op_Code.JUMP_IF_TRUE):
+                next_index = target
+        elif op_code == Op_Code.ADJUST_RELATIVE_BASE:
+            relative_base += self.read_operand(modes[0], operands[0], relative_base)
+        else:
+            raise RuntimeError(f"Cannot interpret op code {op_code}")
+        return (next_index, relative_base)
+
+
+
+class CompiledMemory:
+    """The memory of a `CompiledMachine`: reads and writes go straight to the cells of its compiler."""
+
+    def __init__(self, compiler: BlockCompiler):
+        self.compiler = compiler
+
+    def __getitem__(self, key: int) -> int:
+        return self.compiler.read(key)
+
+    def __setitem__(self, key: int, value: int):
+        self.compiler.write(key, value)
+
+    def __len__(self):
+        """One past the highest address that has been written to."""
+        return self.get_length()
+
+    def get_length(self) -> int:
+        return self.compiler.get_length()
+
+    def is_compact(self) -> bool:
+        return False
+
+    def to_list(self) -> List[int]:
+        return [self[index] for index in range(self.get_length())]
+
+    def get_segments(self) -> List[Tuple[int, List[int]]]:
+        """(start address, cells) for the contiguous cells and then every far cell on its own, in order of address."""
+        return [(0, self.compiler.memory[:self.compiler.dense_length[0]])] + [
+            (address, [value]) for address, value in sorted(self.compiler.far_cells.items())]
+
+    def fork(self) -> "CompiledMemory":
+        """Copies every cell. The fork's compiler starts without any blocks."""
+        return CompiledMemory(BlockCompiler.from_buffer(self, self.compiler.decode))
+
+    def __eq__(self, other):
+        if isinstance(other, list):
+            return len(other) <= self.get_length() and all(
+                self[index] == other_value for index, other_value in enumerate(other))
+        elif isinstance(other, (Buffer, PagedBuffer, CompiledMemory)):
+            return self.get_length() == len(other) and self.to_list() == other.to_list()
+        else:
+            return NotImplemented
+
+
+class CompiledMachine(Machine):
+    """Same interface as `day_05.Machine` but executes compiled blocks."""
+    checks_stop_conditions = False
+
+    def __init__(self, source_code: Union[str, ProgramImage], decode=decode_instruction,
+                 patches: Optional[Dict[int, int]] = None):
+        super().__init__(source_code, decode, patches=patches)
+        self.memory = CompiledMemory(BlockCompiler.from_buffer(self.memory, decode))
+
+    @property
+    def compiler(self) -> BlockCompiler:
+        return self.memory.compiler
+
+    def fork(self) -> "CompiledMachine":
+        """Copies the whole memory. The fork compiles its own blocks as it runs."""
+        return cast(CompiledMachine, super().fork())
+
+    def execute(self, outputs: List[int], max_outputs: Optional[int], max_instructions: int = sys.maxsize):
+        """
+        Like `Machine.execute`. A compiled block only runs if all of its instructions fit in what is left of
+        `max_instructions`. Otherwise its instructions are interpreted one at a time up to the limit.
+        """
+        num_executed = 0
+        compiler = self.compiler
+        blocks = compiler.blocks
+        block_lengths = compiler.block_lengths
+        read = compiler.read
+        decode = self.decode
+        inputs = self.inputs
+        index = self.index
+        relative_base = self.relative_base
+        try:
+            while True:
+                num_left = max_instructions - num_executed
+                block = blocks.get(index)
+                if block is not None and (num_left >= max_block_length or block_lengths[index] <= num_left):
+                    index, relative_base, num_instructions = block(relative_base)
+                    num_executed += num_instructions
+                    continue
+                if num_left == 0:
+                    return num_executed
+                op_code, num_operands, modes = decode(read(index))
+                if op_code == Op_Code.INPUT:
+                    if len(inputs) == 0:
+                        self.status = MachineStatus.WAITING_FOR_INPUT
+                        return num_executed
+                    compiler.write_operand(modes[0], read(index + 1), relative_base, inputs.popleft())
+                    index += num_operands + 1
+                    num_executed += 1
+                elif op_code == Op_Code.OUTPUT:
+                    outputs.append(compiler.read_operand(modes[0], read(index + 1), relative_base))
+                    index += num_operands + 1
+                    num_executed += 1
+                    if len(outputs) == max_outputs:
+                        return num_executed
+                elif op_code == Op_Code.TERMINATE:
+                    self.status = MachineStatus.TERMINATED
+                    return num_executed + 1
+                elif block is not None or compiler.should_interpret(index):
+                    index, relative_base = compiler.interpret_one(index, relative_base)
+                    num_executed += 1
+                else:
+                    compiler.compile_block(index)
+        finally:
+            self.index = index
+            self.relative_base = relative_base
+
+
+def compile_source_code_to_closures(source_code: Union[str, ProgramImage], decode=decode_instruction):
+    """Drop-in replacement for `day_05.compile_source_code` that runs compiled basic blocks."""
+    return run_machine_as_program(CompiledMachine(source_code, decode))
+
+
+def test_compiled_machine_runs_until_blocked():
+    machine = CompiledMachine(large_program)
+    assert machine.run() == []
+    assert machine.status == MachineStatus.WAITING_FOR_INPUT
+    assert machine.run([9]) == [1001]
+    assert machine.status == MachineStatus.TERMINATED
+
+
+def test_compiled_machine_profile():
+    machine = CompiledMachine("1101,0,3,20,1001,20,-1,20,1005,20,4,99")
+    machine.profile = Profile()
+    machine.run()
+    assert machine.status == MachineStatus.TERMINATED
+    assert machine.profile.get_hottest_addresses(2) == [(4, 3), (8, 3)]
+    assert machine.profile.num_instructions == 8
+    assert machine.memory[20] == 0
+
+
+def test_compiled_machine_limits():
+    machine = CompiledMachine(countdown_program)
+    machine.limits = Limits(max_instructions=25_000)
+    with pytest.raises(LimitExceeded):
+        machine.run()
+    assert (machine.index, machine.read_memory(100)) == (8, 30000 - 12500)
+    # The loop still ran as a compiled block:
+    assert len(machine.compiler.blocks) > 0
+    machine.limits = None
+    assert machine.run() == [1]
+    # Writes to ever higher addresses:
+    machine = CompiledMachine("1101,0,0,1000,109,1,21101,0,7,1000,1105,1,4")
+    machine.limits = Limits(max_memory_cells=100_000)
+    with pytest.raises(LimitExceeded):
+        machine.run()
+    assert 100_000 < machine.get_num_memory_cells() == len(machine.memory)
+
+
+@pytest.mark.parametrize("source_code", [countdown_program, large_program] + [
+    source_code for source_code, _ in simple_programs])
+def test_compiled_machine_counts_instructions(source_code):
+    machine, reference = CompiledMachine(source_code), Machine(source_code)
+    for inputs in [[], [8]]:
+        machine.inputs.extend(inputs)
+        reference.inputs.extend(inputs)
+        assert machine.execute([], None) == reference.execute([], None)
+        assert (machine.index, machine.status) == (reference.index, reference.status)
+
+
+@pytest.mark.parametrize("max_instructions", [0, 1, 2, 5, 63, 64, 65, 1000])
+def test_compiled_machine_instruction_budget(max_instructions):
+    machine, reference = CompiledMachine(countdown_program), Machine(countdown_program)
+    for _ in range(3):
+        assert machine.execute([], None, max_instructions) == reference.execute([], None, max_instructions)
+        assert (machine.index, machine.read_memory(100)) == (reference.index, reference.read_memory(100))
+
+
+def test_compiled_machine_memory():
+    machine = CompiledMachine(ProgramImage.from_source_code(countdown_program), patches={2: 5, 10 ** 12: 1})
+    # A view of the compiler's cells rather than a copy:
+    assert machine.memory is machine.memory
+    assert machine.run() == [1]
+    machine.memory[200] = 7
+    assert (machine.read_memory(200), machine.compiler.memory[200]) == (7, 7)
+    assert len(machine.memory) == machine.get_num_memory_cells() == 10 ** 12 + 1
+    assert machine.memory[10 ** 12] == 1
+    forked = machine.fork()
+    forked.memory[200] = 8
+    assert (machine.memory[200], forked.memory[200], forked.memory[10 ** 12]) == (7, 8, 1)
+
+
+def test_compiled_machine_fork():
+    machine = CompiledMachine("3,100,1,100,101,101,4,101,1105,1,0")
+    assert machine.run([1, 2]) == [1, 3]
+    forked = machine.fork()
+    assert machine.run([10]) == [13]
+    assert forked.run([20]) == [23]
+
+
+@pytest.mark.parametrize("source_code,expected", simple_programs)
+def test_simple_program(source_code, expected):
+    assert run_with_input_output(source_code, input, print, engine=compile_source_code_to_closures) == expected
+
+
+def test_growing_memory_stops_the_running_block():
+    # The block at 0 writes past the end of memory, which discards it, then overwrites its own third instruction
+    # with an invalid op code:
+    source_code = "1101,0,0,13,1101,0,0,8,1101,0,7,0,99"
+    with pytest.raises(KeyError):
+        Machine(source_code).run()
+    with pytest.raises(KeyError):
+        CompiledMachine(source_code).run()
+
+
+def test_memory_grows_geometrically():
+    compiler = BlockCompiler([0] * 10)
+    compiler.write(100_000, 5)
+    compiler.write(10, 1)
+    assert (len(compiler.memory), compiler.dense_length[0], compiler.get_length()) == (20, 11, 100_001)
+    compiler.write(40_000, 2)
+    compiler.write(70_000, 3)
+    assert compiler.far_addresses == [100_000]
+    # Doubling the capacity takes in the far cell:
+    compiler.write(90_000, 4)
+    assert len(compiler.memory) == 2 * 80_002
+    assert (compiler.far_cells, compiler.far_addresses, compiler.dense_length[0]) == ({}, [], 100_001)
+    assert [compiler.read(address) for address in [10, 40_000, 70_000, 90_000, 100_000]] == [1, 2, 3, 4, 5]
+
+
+def test_memory_that_keeps_growing():
+    # Writes 7 to ever higher addresses, counting the writes in cell 1000 until there are 100000 of them:
+    source_code = "109,1,21101,0,7,2000,1001,1000,1,1000,1008,1000,100000,1001,1006,1001,0,99"
+    machine, reference = CompiledMachine(source_code), Machine(source_code)
+    assert machine.run() == reference.run() == []
+    assert machine.memory == reference.memory
+    assert len(machine.compiler.memory) < 2 * len(machine.memory)
+
+
+@pytest.mark.parametrize("source_code", [
+    # The jump isn't taken, but its target is read from address -1 (position mode and relative mode):
+    "106,1,-1,99",
+    "109,-3,2006,8,2,99,0,0,1",
+])
+def test_jump_targets_are_read_even_if_the_jump_is_not_taken(source_code):
+    with pytest.raises(IndexError, match="negative address"):
+        Machine(source_code).run()
+    with pytest.raises(IndexError, match="negative address"):
+        CompiledMachine(source_code).run()
+    machine = CompiledMachine(source_code)
+    machine.limits = Limits(max_instructions=10)
+    with pytest.raises(IndexError, match="negative address"):
+        machine.run()
+
+
+@pytest.mark.parametrize("user_input_value,source_code,expected_output", input_output_programs)
+def test_programs_with_input_output(user_input_value, source_code, expected_output):
+    get_user_input = Mock(return_value=user_input_value)
+    print_output = Mock()
+    run_with_input_output(source_code, get_user_input, print_output, engine=compile_source_code_to_closures)
+    print_output.assert_called_once_with(expected_output)
+
+
+def test_compiled_machine_from_image():
+    image = ProgramImage.from_source_code(large_program)
+    assert CompiledMachine(image).run([7]) == [999]
+    assert CompiledMachine(image).run([8]) == [1000]
+
+
+def test_day_07_amplifiers():
+    from day_07 import (run_amplifiers_once, run_amplifiers_continuously,
+                        amplifier_examples_part_one, amplifier_examples_part_two)
+    for source_code, phases, expected in amplifier_examples_part_one:
+        assert run_amplifiers_once(source_code, phases, CompiledMachine) == expected
+    for source_code, phases, expected in amplifier_examples_part_two:
+        assert run_amplifiers_continuously(source_code, phases, CompiledMachine) == expected
+
+
+def test_day_09_relative_base():
+    from day_09 import quine_program, large_multiplication_program, large_output_program
+    outputs: List[int] = []
+    run_with_input_output(quine_program, input, outputs.append, engine=compile_source_code_to_closures)
+    assert outputs == [int(x) for x in quine_program.split(",")]
+    print_output = Mock()
+    run_with_input_output(large_multiplication_program, input, print_output,
+                          engine=compile_source_code_to_closures)
+    print_output.assert_called_once_with(1219070632396864)
+    print_output = Mock()
+    run_with_input_output(large_output_program, input, print_output, engine=compile_source_code_to_closures)
+    print_output.assert_called_once_with(1125899906842624)
+
+
+def test_self_modifying_program():
+    # The instruction at 4 is rewritten from "add 0 to cell 20" into "multiply by 1" on every pass through the
+    # loop, and the jump at 11 goes back to the start until cell 20 counts down from 3 to 0:
+    source_code = ",".join(str(x) for x in [
+        1101, 0, 2, 4,  # 0: cell 4 = 2 (turn the next instruction into a multiplication)
+        1, 20, 21, 22,  # 4: cell 22 = cell 20 + cell 21, or * after the first pass
+        1001, 20, -1, 20,  # 8: cell 20 -= 1
+        1005, 20, 0,  # 12: if cell 20 != 0, jump to 0
+        4, 22,  # 15: output cell 22
+        99, 0, 0,  # 17
+        3, 5, 0,  # 20: cells 20, 21 and 22
+    ])
+    expected: List[int] = []
+    run_with_input_output(source_code, input, expected.append)
+    actual: List[int] = []
+    run_with_input_output(source_code, input, actual.append, engine=compile_source_code_to_closures)
+    assert actual == expected == [5]
+
+
+def test_block_overwriting_itself_falls_back_to_interpreter():
+    # The loop body increments its own operand (cell 3, the address that the ADD at 0 writes to) every pass:
+    source_code = ",".join(str(x) for x in [
+        1101, 7, 0, 30,  # 0: cell <cell 3> = 7
+        1001, 3, 1, 3,  # 4: cell 3 += 1
+        1001, 40, 1, 40,  # 8: cell 40 += 1
+        1007, 40, 5, 41,  # 12: cell 41 = cell 40 < 5
+        1005, 41, 0,  # 16: if cell 41 != 0, jump to 0
+        99,  # 19
+    ])
+    expected = run_with_input_output(source_code, input, print)
+    actual = run_with_input_output(source_code, input, print, engine=compile_source_code_to_closures)
+    assert actual == expected.to_list()
+    assert actual.to_list()[30:35] == [7] * 5
+
+
+def test_reads_and_writes_past_the_end():
+    source_code = "1101,3,4,1000,1001,1000,0,100000000,4,1000,204,100000000,99"
+    # 204 with relative base 0 outputs cell 100000000
+    outputs: List[int] = []
+    final_memory = run_with_input_output(source_code, input, outputs.append, engine=compile_source_code_to_closures)
+    assert outputs == [7, 7]
+    assert final_memory[100000000] == 7
+    assert final_memory[5000] == 0
+
+
+def test_invalid_op_code_raises_same_error():
+    with pytest.raises(KeyError):
+        run_with_input_output("1101,1,1,5,42,0", input, print, engine=compile_source_code_to_closures)
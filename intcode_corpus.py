@@ -0,0 +1,201 @@
+"""
+Benchmark programs for the Intcode engines, written with `intcode_assembler` and sized by a parameter so that they
+can be made as long-running as needed. Every program knows its inputs and the outputs that it must produce, so a
+benchmark also checks that an engine gets the right answer. `make_corpus` gives one of each at a common scale.
+"""
+from collections import namedtuple
+import math
+from typing import FrozenSet, List
+import pytest
+from intcode_assembler import assemble
+from intcode_engines import Feature, engines
+
+BenchmarkProgram = namedtuple("BenchmarkProgram", ["name", "source_code", "inputs", "expected_outputs", "features"])
+
+basic_features: FrozenSet[Feature] = frozenset({Feature.IO, Feature.JUMPS_AND_COMPARISONS, Feature.PARAMETER_MODES})
+
+
+def make_prime_sieve(limit: int) -> BenchmarkProgram:
+    """Sieve of Eratosthenes on the cells past the end of the program. Outputs the number of primes below `limit`."""
+    source_code = assemble(f"""
+                arb #sieve+2            ; the relative base follows sieve[i]
+                add #2, #0, i
+        outer:  lt i, #{limit}, cond
+                jf cond, #done
+                jt [rb+0], #next        ; crossed out already
+                add count, #1, count
+                add i, i, j
+                arb i                   ; now it follows sieve[j]
+        inner:  lt j, #{limit}, cond
+                jf cond, #back
+                add #1, #0, [rb+0]
+                arb i
+                add j, i, j
+                jmp #inner
+        back:   mul j, #-1, offset
+                add offset, i, offset
+                arb offset              ; back to sieve[i]
+        next:   add i, #1, i
+                arb #1
+                jmp #outer
+        done:   out count
+                halt
+        i:      .word 0
+        j:      .word 0
+        cond:   .word 0
+        count:  .word 0
+        offset: .word 0
+        sieve:
+    """)
+    is_prime = [True] * max(limit, 2)
+    for i in range(2, limit):
+        for j in range(2 * i, limit, i) if is_prime[i] else ():
+            is_prime[j] = False
+    return BenchmarkProgram(f"prime_sieve({limit})", source_code, [], [sum(is_prime[2:limit])],
+                            basic_features | {Feature.MEMORY_GROWTH})
+
+
+def make_nested_loops(num_iterations: int) -> BenchmarkProgram:
+    """Two nested loops of `num_iterations` each that sum i * j. Pure arithmetic and branches, no memory traffic."""
+    source_code = assemble(f"""
+        outer:  add #0, #0, j
+        inner:  mul i, j, product
+                add sum, product, sum
+                add j, #1, j
+                lt j, #{num_iterations}, cond
+                jt cond, #inner
+                add i, #1, i
+                lt i, #{num_iterations}, cond
+                jt cond, #outer
+                out sum
+                halt
+        i:      .word 0
+        j:      .word 0
+        product: .word 0
+        sum:    .word 0
+        cond:   .word 0
+    """)
+    return BenchmarkProgram(f"nested_loops({num_iterations})", source_code, [],
+                            [(num_iterations * (num_iterations - 1) // 2) ** 2], basic_features)
+
+
+def make_memory_copy(num_cells: int, num_copies: int) -> BenchmarkProgram:
+    """
+    Fill a block of `num_cells` past the end of the program, then copy it (adding 1 to every cell) to the block
+    after it, `num_copies` times over. Outputs the first and last cell of the last block.
+    """
+    source_code = assemble(f"""
+                arb #block              ; the relative base follows the cell being written
+        fill:   add i, #0, [rb+0]
+                arb #1
+                add i, #1, i
+                lt i, #{num_cells}, cond
+                jt cond, #fill
+                arb #-{num_cells}
+                add #0, #0, i
+        copy:   add [rb+0], #1, [rb+{num_cells}]
+                arb #1
+                add i, #1, i
+                lt i, #{num_cells * num_copies}, cond
+                jt cond, #copy
+                out [rb+0]
+                out [rb+{num_cells - 1}]
+                halt
+        i:      .word 0
+        cond:   .word 0
+        block:
+    """)
+    return BenchmarkProgram(f"memory_copy({num_cells}, {num_copies})", source_code, [],
+                            [num_copies, num_cells - 1 + num_copies], basic_features | {Feature.MEMORY_GROWTH})
+
+
+def make_recursive_fibonacci(n: int) -> BenchmarkProgram:
+    """Naive recursive Fibonacci with `call` and `ret` on a stack kept through the relative base. Outputs fib(n)."""
+    source_code = assemble(f"""
+                arb #stack
+                push #{n}
+                call fib
+                out result
+                halt
+        fib:    lt [rb-2], #2, cond     ; the argument is below the return address
+                jf cond, #recurse
+                add [rb-2], #0, result
+                ret
+        recurse: add [rb-2], #-1, [rb+0]
+                arb #1
+                call fib
+                arb #-1
+                push result
+                add [rb-3], #-2, [rb+0]
+                arb #1
+                call fib
+                arb #-1
+                pop partial
+                add partial, result, result
+                ret
+        cond:   .word 0
+        result: .word 0
+        partial: .word 0
+        stack:
+    """)
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return BenchmarkProgram(f"recursive_fibonacci({n})", source_code, [], [a],
+                            basic_features | {Feature.MEMORY_GROWTH})
+
+
+def make_io_stream(num_values: int) -> BenchmarkProgram:
+    """Read `num_values` inputs and output the running total after each one."""
+    source_code = assemble(f"""
+        loop:   in value
+                add total, value, total
+                out total
+                add i, #1, i
+                lt i, #{num_values}, cond
+                jt cond, #loop
+                halt
+        value:  .word 0
+        total:  .word 0
+        i:      .word 0
+        cond:   .word 0
+    """)
+    inputs = [i % 201 - 100 for i in range(num_values)]
+    expected_outputs = []
+    total = 0
+    for value in inputs:
+        total += value
+        expected_outputs.append(total)
+    return BenchmarkProgram(f"io_stream({num_values})", source_code, inputs, expected_outputs, basic_features)
+
+
+def make_corpus(scale: float = 1.0) -> List[BenchmarkProgram]:
+    """
+    One program of each kind. At a `scale` of 1 each of them executes roughly half a million instructions and the
+    number of instructions grows in proportion to `scale`.
+    """
+    # Every extra level of recursion multiplies the number of calls by the golden ratio:
+    fibonacci_n = max(2, 21 + round(math.log(scale, (1 + math.sqrt(5)) / 2)))
+    return [
+        make_prime_sieve(round(25_000 * scale)),
+        make_nested_loops(round(320 * math.sqrt(scale))),
+        make_memory_copy(1000, max(1, round(100 * scale))),
+        make_recursive_fibonacci(fibonacci_n),
+        make_io_stream(round(80_000 * scale)),
+    ]
+
+
+@pytest.mark.parametrize("program", make_corpus(0.01), ids=lambda program: program.name)
+@pytest.mark.parametrize("engine_name", list(engines))
+def test_corpus_on_every_engine(program, engine_name):
+    engine = engines[engine_name]
+    if not program.features <= engine.features:
+        pytest.skip(f"{engine_name} doesn't support every feature that {program.name} uses")
+    assert engine.create_machine(program.source_code).run(program.inputs) == program.expected_outputs
+
+
+@pytest.mark.parametrize("limit,expected", [(2, 0), (3, 1), (10, 4), (100, 25)])
+def test_prime_sieve(limit, expected):
+    program = make_prime_sieve(limit)
+    assert program.expected_outputs == [expected]
+    assert engines["reference"].create_machine(program.source_code).run() == [expected]
@@ -0,0 +1,358 @@
+"""
+A registry of Intcode engines, so that a run can pick the reference interpreter or an optimized engine by name, and
+a differential fuzzer that runs random programs on every registered engine and compares what they do.
+
+Every engine is a callable that turns a program (source code or a `ProgramImage`) into an object with the
+interface of `day_05.Machine`: `run`, `status`, `memory`, `read_memory`, `write_memory` and `fork`. Some engines
+only implement part of Intcode. Their `features` say which parts, and the fuzzer only gives them programs that
+stay within those.
+"""
+from collections import namedtuple
+from enum import Enum, unique, auto
+import functools
+import random
+import sys
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+import numpy as np
+import pytest
+from day_05 import (Op_Code, Machine, MachineStatus, Buffer, Int64Buffer, PagedBuffer, ProgramImage, Limits,
+                    LimitExceeded, decode_instruction, int_to_op_code_and_num_operands, op_codes_that_write,
+                    doubling_program, run_until_scenario, expected_run_until_scenario)
+from day_02 import execute_program
+from intcode_compiler import CompiledMachine
+from intcode_fusion import FusedMachine
+from intcode_lockstep import execute_in_lockstep
+
+
+@unique
+class Feature(Enum):
+    # INPUT and OUTPUT:
+    IO = auto()
+    JUMPS_AND_COMPARISONS = auto()
+    # Immediate and relative modes and ADJUST_RELATIVE_BASE:
+    PARAMETER_MODES = auto()
+    # Reading and writing past the end of the program:
+    MEMORY_GROWTH = auto()
+    # Values that don't fit in 64 bits:
+    BIG_NUMBERS = auto()
+
+
+all_features: FrozenSet[Feature] = frozenset(Feature)
+
+Engine = namedtuple("Engine", ["name", "create_machine", "features"])
+
+engines: Dict[str, Engine] = {}
+
+reference_engine_name = "reference"
+
+
+def register_engine(name: str, create_machine: Callable[[Union[str, ProgramImage]], Machine],
+                    features: Iterable[Feature] = all_features):
+    if name in engines:
+        raise ValueError(f"An engine called {name} is already registered")
+    engines[name] = Engine(name, create_machine, frozenset(features))
+
+
+def get_engine(name: str) -> Engine:
+    try:
+        return engines[name]
+    except KeyError:
+        raise ValueError(f"Unknown engine {name}. Registered engines: {', '.join(engines)}") from None
+
+
+def create_machine(program: Union[str, ProgramImage], engine_name: str = reference_engine_name) -> Machine:
+    return get_engine(engine_name).create_machine(program)
+
+
+class Day02Machine(Machine):
+    """Runs `day_02.execute_program`, which only knows ADD, MULTIPLY and TERMINATE in position mode."""
+
+    def run(self, inputs: Iterable[int] = (), max_outputs: Optional[int] = None) -> List[int]:
+        if self.status != MachineStatus.TERMINATED:
+            self.memory = Buffer(execute_program(self.memory.to_list()))
+            self.status = MachineStatus.TERMINATED
+        return []
+
+
+class LockstepMachine(Machine):
+    """Runs a single instance on `intcode_lockstep`, which doesn't do I/O and only works with 64-bit values."""
+
+    def run(self, inputs: Iterable[int] = (), max_outputs: Optional[int] = None) -> List[int]:
+        if self.status != MachineStatus.TERMINATED:
+            self.memory = Buffer(execute_in_lockstep(np.array([self.memory.to_list()]))[0].tolist())
+            self.status = MachineStatus.TERMINATED
+        return []
+
+
+register_engine(reference_engine_name, Machine)
+register_engine("int64", functools.partial(Machine, buffer_type=Int64Buffer))
+register_engine("paged", functools.partial(Machine, buffer_type=PagedBuffer))
+register_engine("compiled", CompiledMachine)
+register_engine("fused", FusedMachine)
+register_engine("lockstep", LockstepMachine, all_features - {Feature.IO, Feature.BIG_NUMBERS})
+register_engine("day_02", Day02Machine, {Feature.BIG_NUMBERS})
+
+op_code_to_int = {op_code: value for value, (op_code, _) in int_to_op_code_and_num_operands.items()}
+
+# What a program does: its outputs, how it stopped and its final memory (without trailing zeros, since engines
+# differ in how far they grow memory that only holds zeros):
+Behavior = namedtuple("Behavior", ["outputs", "status", "memory"])
+
+# What a program does when it raises instead (e.g. an invalid op code or a negative address). Every engine has to
+# raise the same type of error:
+Failure = namedtuple("Failure", ["error_type"])
+
+Outcome = Union[Behavior, Failure]
+
+Mismatch = namedtuple("Mismatch", ["engine_name", "source_code", "inputs", "expected", "actual"])
+
+
+def make_random_program(rng: random.Random, features: FrozenSet[Feature] = all_features,
+                        num_instructions: int = 12, num_data_cells: int = 8) -> str:
+    """
+    A random program that only uses `features`. It ends with TERMINATE, but it may loop forever or fail (e.g. by
+    overwriting its own code with garbage), so run it on the reference engine first.
+    """
+    op_codes = [Op_Code.ADD, Op_Code.MULTIPLY]
+    if Feature.JUMPS_AND_COMPARISONS in features:
+        op_codes += [Op_Code.LESS_THAN, Op_Code.EQUALS, Op_Code.JUMP_IF_TRUE, Op_Code.JUMP_IF_FALSE]
+    if Feature.IO in features:
+        op_codes += [Op_Code.INPUT, Op_Code.OUTPUT]
+    if Feature.PARAMETER_MODES in features:
+        op_codes += [Op_Code.ADJUST_RELATIVE_BASE]
+    instructions = [rng.choice(op_codes) for _ in range(num_instructions)] + [Op_Code.TERMINATE]
+    starts = []
+    code_length = 0
+    for op_code in instructions:
+        starts.append(code_length)
+        code_length += 1 + int_to_op_code_and_num_operands[op_code_to_int[op_code]][1]
+    program_length = code_length + num_data_cells
+    big = Feature.BIG_NUMBERS in features
+
+    def random_value() -> int:
+        return rng.choice([rng.randint(-3, 10), rng.randint(-3, 10), rng.choice([-1, 1]) * 2 ** rng.randint(30, 40)
+                           if big else rng.randint(-1000, 1000)])
+
+    def random_address() -> int:
+        if Feature.MEMORY_GROWTH in features and rng.random() < 0.1:
+            return program_length + rng.randint(0, 20)
+        # Mostly data, sometimes code. Code that modifies itself can end up with addresses past the end:
+        if Feature.MEMORY_GROWTH in features and rng.random() < 0.1:
+            return rng.randrange(code_length)
+        return rng.randrange(code_length, program_length)
+
+    code: List[int] = []
+    # Jump targets for position mode are kept in the data cells:
+    data = [random_value() for _ in range(num_data_cells)]
+    for op_code in instructions:
+        num_operands = int_to_op_code_and_num_operands[op_code_to_int[op_code]][1]
+        num_writes = 1 if op_code in op_codes_that_write else 0
+        modes: List[int] = []
+        operands: List[int] = []
+        for position in range(num_operands):
+            is_jump_target = op_code in (Op_Code.JUMP_IF_TRUE, Op_Code.JUMP_IF_FALSE) and position == 1
+            is_write = position >= num_operands - num_writes
+            mode = 0
+            if Feature.PARAMETER_MODES in features:
+                mode = rng.choice([0, 2] if is_write else [0, 1, 1, 2])
+            if is_jump_target:
+                # Mostly the start of an instruction, sometimes a negative address or one past the code:
+                target = rng.choice(starts)
+                if rng.random() < 0.1:
+                    target = rng.choice([rng.randint(-5, -1), rng.randint(code_length, program_length + 10)])
+            if is_jump_target and mode == 1:
+                operand = target
+            elif is_jump_target:
+                cell = rng.randrange(num_data_cells)
+                data[cell] = target
+                operand = code_length + cell
+            elif mode == 1:
+                operand = random_value()
+            else:
+                operand = random_address()
+            if mode == 2:
+                # The relative base mostly stays close to zero:
+                operand += rng.randint(-3, 3)
+            modes.append(mode)
+            operands.append(operand)
+        if op_code == Op_Code.ADJUST_RELATIVE_BASE:
+            modes, operands = [1], [rng.randint(-3, 3)]
+        code.append(op_code_to_int[op_code] + sum(mode * 10 ** (2 + i) for i, mode in enumerate(modes)))
+        code.extend(operands)
+    return ",".join(str(x) for x in code + data)
+
+
+def observe(machine: Machine, inputs: List[int], outputs: Optional[List[int]] = None) -> Behavior:
+    """
+    Run one output at a time, handing over the next input whenever the machine waits for one. The outputs are
+    collected in `outputs` if it is given, so that they can be looked at when the machine raises.
+    """
+    pending_inputs = list(inputs)
+    outputs = [] if outputs is None else outputs
+    while True:
+        new_outputs = machine.run(max_outputs=1)
+        outputs.extend(new_outputs)
+        if len(new_outputs) > 0:
+            continue
+        if machine.status == MachineStatus.WAITING_FOR_INPUT and len(pending_inputs) > 0:
+            machine.inputs.append(pending_inputs.pop(0))
+        else:
+            break
+    memory = machine.memory.to_list()
+    while len(memory) > 0 and memory[-1] == 0:
+        memory.pop()
+    return Behavior(outputs, machine.status, memory)
+
+
+def observe_reference(source_code: str, inputs: List[int], features: FrozenSet[Feature] = all_features,
+                      max_instructions: int = 20_000) -> Optional[Outcome]:
+    """
+    What the reference engine does (or how it fails), or None if the program doesn't stop within
+    `max_instructions` or turns out to need more than `features` (e.g. because a calculation overflowed 64 bits).
+    """
+    # An `Int64Buffer` that had to promote itself has seen a big number:
+    machine = Machine(source_code, buffer_type=None if Feature.BIG_NUMBERS in features else Int64Buffer)
+    # Code that modifies itself can write to very high addresses, and the whole memory gets compared:
+    machine.limits = Limits(max_instructions=max_instructions, max_memory_cells=10_000)
+    outputs: List[int] = []
+    outcome: Outcome
+    try:
+        outcome = observe(machine, inputs if Feature.IO in features else [], outputs)
+    except LimitExceeded:
+        return None
+    except (KeyError, IndexError, ValueError, RuntimeError) as e:
+        # Invalid op codes and modes and negative addresses:
+        outcome = Failure(type(e))
+    if Feature.BIG_NUMBERS not in features and not machine.memory.is_compact():
+        return None
+    # Also when it waits for input or fails on an I/O instruction, which engines without I/O reject up front:
+    if Feature.IO not in features and (len(outputs) > 0 or is_at_io_instruction(machine)):
+        return None
+    return outcome
+
+
+def is_at_io_instruction(machine: Machine) -> bool:
+    try:
+        op_code = machine.decode(machine.read_memory(machine.index))[0]
+    except (KeyError, IndexError, ValueError):
+        return False
+    return op_code in (Op_Code.INPUT, Op_Code.OUTPUT)
+
+
+def compare_engines(source_code: str, inputs: List[int], engine_names: Iterable[str],
+                    features: FrozenSet[Feature] = all_features) -> List[Mismatch]:
+    """Run the program on every engine in `engine_names`. Raising counts as an outcome too."""
+    expected = observe_reference(source_code, inputs, features)
+    if expected is None:
+        return []
+    mismatches = []
+    for engine_name in engine_names:
+        actual: Outcome
+        try:
+            actual = observe(create_machine(source_code, engine_name), inputs)
+        except Exception as e:
+            actual = Failure(type(e))
+        if actual != expected:
+            mismatches.append(Mismatch(engine_name, source_code, inputs, expected, actual))
+    return mismatches
+
+
+def fuzz_engines(num_programs: int = 200, seed: int = 0,
+                 engine_names: Optional[List[str]] = None) -> Tuple[int, List[Mismatch]]:
+    """
+    Run `num_programs` random programs for every set of features of the engines in `engine_names` (all of them by
+    default) on every engine that supports the program. Return the number of programs that the reference engine
+    could run to the end or that failed on it, and the mismatches.
+    """
+    rng = random.Random(seed)
+    engine_names = list(engines) if engine_names is None else engine_names
+    num_valid_programs = 0
+    mismatches: List[Mismatch] = []
+    for features in sorted({get_engine(name).features for name in engine_names}, key=len):
+        supporting_engines = [name for name in engine_names if features <= get_engine(name).features]
+        for _ in range(num_programs):
+            source_code = make_random_program(rng, features)
+            inputs = [rng.randint(-10, 10) for _ in range(rng.randint(0, 4))]
+            if observe_reference(source_code, inputs, features) is not None:
+                num_valid_programs += 1
+                mismatches.extend(compare_engines(source_code, inputs, supporting_engines, features))
+    return num_valid_programs, mismatches
+
+
+def test_registry():
+    assert create_machine("104,7,99", "compiled").run() == [7]
+    assert isinstance(create_machine("99"), Machine)
+    with pytest.raises(ValueError):
+        get_engine("nope")
+    with pytest.raises(ValueError):
+        register_engine(reference_engine_name, Machine)
+
+
+@pytest.mark.parametrize("engine_name", [name for name, engine in engines.items() if Feature.IO in engine.features])
+def test_run_until_on_every_engine(engine_name):
+    assert run_until_scenario(create_machine(doubling_program, engine_name)) == expected_run_until_scenario
+
+
+def test_make_random_program_respects_features():
+    rng = random.Random(1)
+    for _ in range(50):
+        values = [int(x) for x in make_random_program(rng, frozenset({Feature.BIG_NUMBERS})).split(",")]
+        index = 0
+        while values[index] != 99:
+            assert values[index] in (1, 2)
+            assert all(0 <= operand < len(values) for operand in values[index + 1:index + 4])
+            index += 4
+
+
+def test_fuzz_engines():
+    num_valid_programs, mismatches = fuzz_engines(num_programs=100)
+    assert mismatches == []
+    # Most random programs are valid:
+    assert num_valid_programs > 0.5 * 100 * len({engine.features for engine in engines.values()})
+
+
+def test_fuzz_engines_finds_a_broken_engine(monkeypatch):
+    def decode_equals_as_less_than(word: int):
+        op_code, num_operands, modes = decode_instruction(word)
+        return (Op_Code.LESS_THAN if op_code == Op_Code.EQUALS else op_code, num_operands, modes)
+
+    monkeypatch.setitem(engines, "broken", Engine(
+        "broken", functools.partial(Machine, decode=decode_equals_as_less_than), all_features))
+    _, mismatches = fuzz_engines(num_programs=100, engine_names=["broken"])
+    assert len(mismatches) > 0
+    assert mismatches[0].engine_name == "broken"
+
+
+def test_failures_are_compared():
+    # Jumps to -5, which used to wrap around to the 1101 on lockstep:
+    source_code = "1105,1,-5,99,1101,2,3,0,99"
+    features = all_features - {Feature.IO, Feature.BIG_NUMBERS}
+    assert observe_reference(source_code, [], features) == Failure(IndexError)
+    assert compare_engines(source_code, [], [name for name in engines if name != "day_02"], features) == []
+    # Programs that fail on an I/O instruction aren't given to engines without I/O:
+    assert observe_reference("4,-1,99", [], features) is None
+    assert observe_reference("4,-1,99", []) == Failure(IndexError)
+
+
+def test_fuzz_engines_finds_an_engine_that_does_not_fail(monkeypatch):
+    class ForgivingMachine(Machine):
+        """Terminates instead of raising on negative addresses."""
+
+        def run(self, inputs: Iterable[int] = (), max_outputs: Optional[int] = None) -> List[int]:
+            try:
+                return super().run(inputs, max_outputs)
+            except IndexError:
+                self.status = MachineStatus.TERMINATED
+                return []
+
+    monkeypatch.setitem(engines, "forgiving", Engine("forgiving", ForgivingMachine, all_features))
+    _, mismatches = fuzz_engines(num_programs=100, engine_names=["forgiving"])
+    assert len(mismatches) > 0
+    assert all(mismatch.expected == Failure(IndexError) for mismatch in mismatches)
+
+
+if __name__ == "__main__":
+    num_valid_programs, mismatches = fuzz_engines(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
+    print(f"{num_valid_programs} programs, {len(mismatches)} mismatches")
+    for mismatch in mismatches:
+        print(mismatch)
@@ -0,0 +1,387 @@
+"""
+Superinstructions for the `day_05` interpreter: a peephole pass over the loaded program finds common instruction
+sequences and replaces each one with a single Python function that runs it without decoding anything.
+
+The sequences are:
+- a counter update: an ADD of an immediate to a cell, stored back into that cell (`1001,c,k,c` or `101,k,c,c`),
+- a counter update followed by a jump on that cell (JUMP_IF_TRUE/JUMP_IF_FALSE),
+- a LESS_THAN/EQUALS followed by a jump on the cell it just wrote (compare then branch).
+
+Every cell of a fused sequence is guarded: a write to it throws away the superinstructions that cover it, and
+execution continues with the ordinary one instruction at a time interpreter from there. Superinstructions that
+would write into the cells of a fused sequence themselves aren't fused in the first place.
+"""
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Union, cast
+import sys
+import pytest
+from day_05 import (
+    Op_Code,
+    Mode,
+    Buffer,
+    LimitExceeded,
+    Limits,
+    Machine,
+    MachineStatus,
+    PagedBuffer,
+    ProgramImage,
+    Profile,
+    decode_instruction,
+    read_value_from_buffer,
+    shift_if_in_relative_mode,
+    simple_programs,
+    large_program,
+)
+
+# `run` takes the memory, executes the fused instructions and returns the new instruction pointer.
+# `cells` are the addresses that hold the fused instructions, `write_address` is the only cell `run` writes to:
+Superinstruction = namedtuple("Superinstruction", ["kind", "num_instructions", "cells", "write_address", "run"])
+
+FusionReport = namedtuple("FusionReport", [
+    # Superinstructions in the program (right now) and how many instructions they replace:
+    "num_superinstructions",
+    "num_fused_instructions",
+    # Superinstructions that were thrown away because the program wrote to one of their cells:
+    "num_unfused",
+    # How many times a superinstruction ran, and how many instructions ran as part of one:
+    "num_superinstruction_runs",
+    "num_instructions_run_fused",
+])
+
+compare_expressions = {
+    Op_Code.LESS_THAN: "1 if {0} < {1} else 0",
+    Op_Code.EQUALS: "1 if {0} == {1} else 0",
+}
+jump_conditions = {
+    Op_Code.JUMP_IF_TRUE: "value != 0",
+    Op_Code.JUMP_IF_FALSE: "value == 0",
+}
+
+
+def try_decode(word: int, decode=decode_instruction):
+    try:
+        return decode(word)
+    except (KeyError, ValueError, IndexError):
+        return None
+
+
+def operand_expression(operand: int, mode: Mode) -> Optional[str]:
+    """Python expression for the value of an operand, or None if it can't be fused (relative mode)."""
+    if mode == Mode.IMMEDIATE:
+        return str(operand)
+    elif mode == Mode.POSITION and operand >= 0:
+        return f"buffer[{operand}]"
+    return None
+
+
+def compile_superinstruction(lines: List[str]) -> Callable:
+    namespace: Dict[str, Callable] = {}
+    exec("def run(buffer):\n" + "".join(f"    {line}\n" for line in lines), namespace)
+    return namespace["run"]
+
+
+def match_counter_update(values: List[int], start: int, decode=decode_instruction) -> Optional[int]:
+    """If there is a counter update at `start`, return the address of the counter."""
+    instruction = try_decode(values[start], decode)
+    if start + 3 >= len(values) or instruction is None or instruction[0] != Op_Code.ADD:
+        return None
+    _, _, modes = instruction
+    operand_1, operand_2, destination = values[start + 1:start + 4]
+    if modes[2] != Mode.POSITION or destination < 0:
+        return None
+    if (modes[0], modes[1], operand_1) == (Mode.POSITION, Mode.IMMEDIATE, destination):
+        return destination
+    if (modes[0], modes[1], operand_2) == (Mode.IMMEDIATE, Mode.POSITION, destination):
+        return destination
+    return None
+
+
+def match_superinstruction(values: List[int], start: int, decode=decode_instruction) -> Optional[Superinstruction]:
+    instruction = try_decode(values[start], decode)
+    if instruction is None or start + 3 >= len(values):
+        return None
+    op_code, _, modes = instruction
+    next_instruction = try_decode(values[start + 4], decode) if start + 6 < len(values) else None
+    counter = match_counter_update(values, start, decode)
+    if counter is not None:
+        increment = values[start + 2] if modes[1] == Mode.IMMEDIATE else values[start + 1]
+        update = f"value = buffer[{counter}] = buffer[{counter}] + {increment}"
+    elif op_code in compare_expressions and modes[2] == Mode.POSITION and values[start + 3] >= 0:
+        expressions = [operand_expression(values[start + i + 1], modes[i]) for i in range(2)]
+        if None in expressions:
+            return None
+        counter = values[start + 3]
+        update = f"value = buffer[{counter}] = " + compare_expressions[op_code].format(*expressions)
+    else:
+        return None
+    if next_instruction is not None and next_instruction[0] in jump_conditions:
+        jump_op_code, _, jump_modes = next_instruction
+        condition, target = values[start + 5:start + 7]
+        target_expression = operand_expression(target, jump_modes[1])
+        if (jump_modes[0], condition) == (Mode.POSITION, counter) and target_expression is not None:
+            lines = [update, f"return {target_expression} if {jump_conditions[jump_op_code]} else {start + 7}"]
+            kind = "counter_and_branch" if op_code == Op_Code.ADD else "compare_and_branch"
+            return Superinstruction(kind, 2, range(start, start + 7), counter, compile_superinstruction(lines))
+    if op_code == Op_Code.ADD:
+        lines = [update, f"return {start + 4}"]
+        return Superinstruction("counter", 1, range(start, start + 4), counter, compile_superinstruction(lines))
+    # A compare on its own isn't worth fusing:
+    return None
+
+
+def find_superinstructions(values: List[int], decode=decode_instruction) -> Dict[int, Superinstruction]:
+    """
+    Look for fusable sequences at every address (the pass can't tell code from data, but a superinstruction only
+    runs if execution gets to its first cell). Return them by the address of their first cell.
+    """
+    candidates = {}
+    for start in range(len(values)):
+        superinstruction = match_superinstruction(values, start, decode)
+        if superinstruction is not None:
+            candidates[start] = superinstruction
+    fused_cells = {cell for superinstruction in candidates.values() for cell in superinstruction.cells}
+    # Superinstructions don't check their own writes, so none of them may write into fused cells:
+    return {start: superinstruction for start, superinstruction in candidates.items()
+            if superinstruction.write_address not in fused_cells}
+
+
+class FusedMachine(Machine):
+    """
+    Same interface as `day_05.Machine` but runs the superinstructions found by `find_superinstructions`.
+    Write to memory between runs with `write_memory` (not through `memory` directly) so that the write barrier
+    sees it.
+    """
+    checks_stop_conditions = False
+
+    def __init__(self, program: Union[str, ProgramImage], decode=decode_instruction, buffer_type=None,
+                 patches: Optional[Dict[int, int]] = None):
+        super().__init__(program, decode, buffer_type, patches)
+        self.superinstructions = find_superinstructions(self.memory.to_list(), decode)
+        # Address -> first cells of the superinstructions that cover it:
+        self.guarded_cells: Dict[int, List[int]] = {}
+        for start, superinstruction in self.superinstructions.items():
+            for cell in superinstruction.cells:
+                self.guarded_cells.setdefault(cell, []).append(start)
+        self.num_unfused = 0
+        self.num_superinstruction_runs = 0
+        self.num_instructions_run_fused = 0
+
+    def get_fusion_report(self) -> FusionReport:
+        return FusionReport(
+            num_superinstructions=len(self.superinstructions),
+            num_fused_instructions=sum(s.num_instructions for s in self.superinstructions.values()),
+            num_unfused=self.num_unfused,
+            num_superinstruction_runs=self.num_superinstruction_runs,
+            num_instructions_run_fused=self.num_instructions_run_fused,
+        )
+
+    def write_memory(self, address: int, value: int):
+        super().write_memory(address, value)
+        if address in self.guarded_cells:
+            self.unfuse(address)
+
+    def unfuse(self, address: int):
+        """Throw away the superinstructions that cover `address`."""
+        for start in self.guarded_cells.pop(address):
+            superinstruction = self.superinstructions.pop(start, None)
+            if superinstruction is None:
+                continue
+            self.num_unfused += 1
+            for cell in superinstruction.cells:
+                starts = self.guarded_cells.get(cell)
+                if starts is not None:
+                    starts.remove(start)
+                    if len(starts) == 0:
+                        del self.guarded_cells[cell]
+
+    def fork(self) -> "FusedMachine":
+        forked = cast(FusedMachine, super().fork())
+        forked.superinstructions = dict(self.superinstructions)
+        forked.guarded_cells = {cell: list(starts) for cell, starts in self.guarded_cells.items()}
+        return forked
+
+    def execute(self, outputs: List[int], max_outputs: Optional[int], max_instructions: int = sys.maxsize):
+        """Same as `Machine.execute`, except that superinstructions run whenever execution gets to one."""
+        buffer = self.memory
+        index = self.index
+        relative_base = self.relative_base
+        inputs = self.inputs
+        decode = self.decode
+        superinstructions = self.superinstructions
+        guarded_cells = self.guarded_cells
+        num_instructions = 0
+        num_superinstruction_runs = 0
+        num_instructions_run_fused = 0
+        try:
+            while num_instructions < max_instructions:
+                superinstruction = superinstructions.get(index)
+                if superinstruction is not None and (
+                        num_instructions + superinstruction.num_instructions <= max_instructions):
+                    index = superinstruction.run(buffer)
+                    num_instructions += superinstruction.num_instructions
+                    num_superinstruction_runs += 1
+                    num_instructions_run_fused += superinstruction.num_instructions
+                    continue
+                num_instructions += 1
+                op_code, num_operands, modes = decode(buffer[index])
+                if op_code in (Op_Code.ADD, Op_Code.MULTIPLY, Op_Code.LESS_THAN, Op_Code.EQUALS):
+                    operand_1 = read_value_from_buffer(buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(buffer, buffer[index + 2], modes[1], relative_base)
+                    operand_3 = shift_if_in_relative_mode(buffer[index + 3], relative_base, modes[2])
+                    if op_code == Op_Code.ADD:
+                        buffer[operand_3] = operand_1 + operand_2
+                    elif op_code == Op_Code.MULTIPLY:
+                        buffer[operand_3] = operand_1 * operand_2
+                    elif op_code == Op_Code.LESS_THAN:
+                        buffer[operand_3] = 1 if operand_1 < operand_2 else 0
+                    else:
+                        buffer[operand_3] = 1 if operand_1 == operand_2 else 0
+                    if operand_3 in guarded_cells:
+                        self.unfuse(operand_3)
+                    index += num_operands + 1
+                elif op_code == Op_Code.INPUT:
+                    if len(inputs) == 0:
+                        self.status = MachineStatus.WAITING_FOR_INPUT
+                        # The input instruction didn't run:
+                        return num_instructions - 1
+                    operand = shift_if_in_relative_mode(buffer[index + 1], relative_base, modes[0])
+                    buffer[operand] = inputs.popleft()
+                    if operand in guarded_cells:
+                        self.unfuse(operand)
+                    index += num_operands + 1
+                elif op_code == Op_Code.OUTPUT:
+                    operand = read_value_from_buffer(buffer, buffer[index + 1], modes[0], relative_base)
+                    index += num_operands + 1
+                    outputs.append(operand)
+                    if len(outputs) == max_outputs:
+                        return num_instructions
+                elif op_code in (Op_Code.JUMP_IF_TRUE, Op_Code.JUMP_IF_FALSE):
+                    operand_1 = read_value_from_buffer(buffer, buffer[index + 1], modes[0], relative_base)
+                    operand_2 = read_value_from_buffer(buffer, buffer[index + 2], modes[1], relative_base)
+                    if (operand_1 != 0) == (op_code == Op_Code.JUMP_IF_TRUE):
+                        index = operand_2
+                    else:
+                        index += num_operands + 1
+                elif op_code == Op_Code.ADJUST_RELATIVE_BASE:
+                    relative_base += read_value_from_buffer(buffer, buffer[index + 1], modes[0], relative_base)
+                    index += num_operands + 1
+                elif op_code == Op_Code.TERMINATE:
+                    self.status = MachineStatus.TERMINATED
+                    return num_instructions
+            return num_instructions
+        finally:
+            self.index = index
+            self.relative_base = relative_base
+            self.num_superinstruction_runs += num_superinstruction_runs
+            self.num_instructions_run_fused += num_instructions_run_fused
+
+
+def make_compare_loop_program(num_iterations: int) -> str:
+    """Count a cell up to `num_iterations` with a counter update followed by a compare then branch."""
+    return ",".join(str(x) for x in [
+        1001, 100, 1, 100,  # 0: counter += 1
+        1007, 100, num_iterations, 101,  # 4: below = counter < num_iterations
+        1005, 101, 0,  # 8: if below, jump to 0
+        4, 100,  # 11: output counter
+        99,  # 13
+    ])
+
+
+def test_find_superinstructions():
+    superinstructions = find_superinstructions([int(x) for x in make_compare_loop_program(10).split(",")])
+    assert {start: s.kind for start, s in superinstructions.items()} == {0: "counter", 4: "compare_and_branch"}
+    # A counter update followed by a jump on the counter:
+    superinstructions = find_superinstructions([101, -1, 20, 20, 1005, 20, 0, 99])
+    assert {start: s.kind for start, s in superinstructions.items()} == {0: "counter_and_branch"}
+    # The compare writes into the jump that follows it (self-modifying code), so it isn't fused:
+    assert find_superinstructions([1107, 1, 2, 5, 1005, 20, 0, 99]) == {}
+
+
+def test_fused_machine():
+    machine = FusedMachine(make_compare_loop_program(10))
+    assert machine.run() == [10]
+    # 10 counter updates and 10 compare then branches:
+    assert machine.get_fusion_report() == (2, 3, 0, 20, 30)
+
+
+@pytest.mark.parametrize("source_code,expected", simple_programs)
+def test_simple_programs(source_code, expected):
+    machine = FusedMachine(source_code)
+    machine.run()
+    assert machine.memory == expected
+
+
+@pytest.mark.parametrize("input_value,expected", [(7, [999]), (8, [1000]), (9, [1001])])
+def test_large_program(input_value, expected):
+    assert FusedMachine(large_program).run([input_value]) == expected
+    assert FusedMachine(ProgramImage.from_source_code(large_program)).run([input_value]) == expected
+
+
+def test_write_barrier():
+    # The loop counts to 10 with superinstructions. Then the input overwrites the increment of the counter update
+    # (cell 2) with 5 and the loop runs once more:
+    source_code = ",".join(str(x) for x in [
+        1001, 100, 1, 100,  # 0: counter += 1
+        1007, 100, 10, 101,  # 4: below = counter < 10
+        1005, 101, 0,  # 8: if below, jump to 0
+        1005, 102, 23,  # 11: if done, jump to 23
+        1101, 0, 1, 102,  # 14: done = 1
+        3, 2,  # 18: read the new increment
+        1105, 1, 0,  # 20: jump to 0
+        99,  # 23
+    ])
+    machine = FusedMachine(source_code)
+    assert machine.run() == []
+    assert machine.read_memory(100) == 10
+    assert machine.get_fusion_report().num_superinstructions == 2
+    machine.run([5])
+    assert machine.get_fusion_report().num_superinstructions == 1
+    assert machine.get_fusion_report().num_unfused == 1
+    reference = Machine(source_code)
+    reference.run()
+    reference.run([5])
+    assert machine.read_memory(100) == 15
+    assert machine.memory == reference.memory.to_list()
+    assert machine.status == reference.status == MachineStatus.TERMINATED
+
+
+def test_write_memory_unfuses():
+    machine = FusedMachine(make_compare_loop_program(10))
+    machine.write_memory(6, 3)
+    assert machine.get_fusion_report().num_superinstructions == 1
+    assert machine.run() == [3]
+
+
+def test_max_instructions_and_profile():
+    machine = FusedMachine(make_compare_loop_program(10))
+    # Stops in the middle of a compare then branch:
+    machine.execute([], None, max_instructions=2)
+    assert machine.index == 8
+    assert machine.read_memory(101) == 1
+    machine = FusedMachine(make_compare_loop_program(10))
+    machine.profile = Profile()
+    assert machine.run() == [10]
+    assert machine.profile.num_instructions == 32
+
+
+def test_limits():
+    machine = FusedMachine(make_compare_loop_program(10000))
+    machine.limits = Limits(max_instructions=20000)
+    with pytest.raises(LimitExceeded):
+        machine.run()
+    # Superinstructions don't run past the budget:
+    assert machine.num_instructions_executed == 20000
+    machine.limits = Limits(max_instructions=30002)
+    assert machine.run() == [10000]
+    assert machine.status == MachineStatus.TERMINATED
+
+
+@pytest.mark.parametrize("buffer_type", [Buffer, PagedBuffer])
+def test_fork(buffer_type):
+    machine = FusedMachine("3,100,1001,100,1,100,4,100,1105,1,0", buffer_type=buffer_type)
+    assert machine.run([1]) == [2]
+    forked = machine.fork()
+    forked.write_memory(4, 10)
+    assert forked.run([1]) == [11]
+    assert machine.run([1]) == [2]
+    assert machine.get_fusion_report().num_superinstructions == 1
@@ -0,0 +1,249 @@
+"""
+Run many copies of the same Intcode program, which only differ in some of their memory cells, in lockstep.
+
+The memories of all instances are the rows of a 2-D NumPy int64 array. Instances that are at the same instruction
+pointer with the same instruction word form a group, and each step executes one instruction for a whole group with
+vectorized operations. When the instances of a group branch differently, the group is split up, and groups that
+arrive at the same instruction pointer again are merged back together.
+
+Only programs that don't do any I/O are supported.
+"""
+from typing import Dict, List
+import numpy as np
+import pytest
+from day_05 import Op_Code, Mode, Machine, MachineStatus, Profile, decode_instruction, simple_programs
+
+int64_limit = 2 ** 63
+
+# The memories of all instances together never grow past this many cells (512 MiB). A single write far past the
+# end would otherwise widen every row to reach it:
+max_memory_cells = 2 ** 26
+
+
+class LockstepMachines:
+    def __init__(self, memories: np.ndarray, decode=decode_instruction):
+        """`memories` has one row per instance. It is copied, not modified."""
+        self.memories = np.array(memories, dtype=np.int64, ndmin=2)
+        num_instances = self.memories.shape[0]
+        self.relative_bases = np.zeros(num_instances, dtype=np.int64)
+        self.decode = decode
+        # Instruction pointer -> rows of the instances that are about to execute the instruction there:
+        self.groups: Dict[int, np.ndarray] = {0: np.arange(num_instances)} if num_instances > 0 else {}
+        self.num_group_steps = 0
+
+    def __ensure_width(self, addresses: np.ndarray):
+        if addresses.size == 0:
+            return
+        if addresses.min() < 0:
+            raise IndexError(f"Key {addresses.min()} is a negative address.")
+        highest_address = int(addresses.max())
+        num_instances, width = self.memories.shape
+        if highest_address >= width:
+            max_width = max_memory_cells // max(num_instances, 1)
+            if highest_address >= max_width:
+                raise MemoryError(f"Writing to address {highest_address} would make the memories of {num_instances} "
+                                  f"instances too large. Use `day_05.Machine` for this program instead.")
+            new_width = max(highest_address + 1, min(2 * width, max_width))
+            self.memories = np.pad(self.memories, ((0, 0), (0, new_width - width)))
+
+    def __read(self, rows: np.ndarray, addresses: np.ndarray) -> np.ndarray:
+        if addresses.size > 0 and addresses.min() < 0:
+            raise IndexError(f"Key {addresses.min()} is a negative address.")
+        width = self.memories.shape[1]
+        in_range = addresses < width
+        if in_range.all():
+            return self.memories[rows, addresses]
+        # Cells past the end read as zero:
+        values = np.zeros(len(rows), dtype=np.int64)
+        values[in_range] = self.memories[rows[in_range], addresses[in_range]]
+        return values
+
+    def __read_cell(self, rows: np.ndarray, address: int) -> np.ndarray:
+        """Read the same address for all `rows`."""
+        if address < 0:
+            raise IndexError(f"Key {address} is a negative address.")
+        if address < self.memories.shape[1]:
+            return self.memories[rows, address]
+        return np.zeros(len(rows), dtype=np.int64)
+
+    def __read_operand(self, rows: np.ndarray, index: int, offset: int, mode: Mode) -> np.ndarray:
+        operand = self.__read_cell(rows, index + offset)
+        if mode == Mode.IMMEDIATE:
+            return operand
+        elif mode == Mode.POSITION:
+            return self.__read(rows, operand)
+        elif mode == Mode.RELATIVE:
+            return self.__read(rows, operand + self.relative_bases[rows])
+        else:
+            raise RuntimeError('Invalid mode ' + str(mode))
+
+    def __write_operand(self, rows: np.ndarray, index: int, offset: int, mode: Mode, values: np.ndarray):
+        addresses = self.__read_cell(rows, index + offset)
+        if mode == Mode.RELATIVE:
+            addresses = addresses + self.relative_bases[rows]
+        self.__ensure_width(addresses)
+        self.memories[rows, addresses] = values
+
+    def run(self) -> np.ndarray:
+        """Run every instance to termination and return their final memories (one row per instance)."""
+        while len(self.groups) > 0:
+            next_groups: Dict[int, List[np.ndarray]] = {}
+            for index, rows in self.groups.items():
+                for next_index, next_rows in self.__step(index, rows):
+                    next_groups.setdefault(next_index, []).append(next_rows)
+            self.groups = {
+                index: np.concatenate(rows_list) if len(rows_list) > 1 else rows_list[0]
+                for index, rows_list in next_groups.items()
+            }
+        return self.memories
+
+    def __step(self, index: int, rows: np.ndarray):
+        """Execute the instruction at `index` for `rows`. Yield (instruction pointer, rows) for each resulting group."""
+        words = self.__read_cell(rows, index)
+        if (words == words[0]).all():
+            yield from self.__step_group(index, rows, int(words[0]))
+        else:
+            # The instances disagree about what the instruction is (e.g. self-modifying code):
+            for word in np.unique(words):
+                yield from self.__step_group(index, rows[words == word], int(word))
+
+    def __step_group(self, index: int, rows: np.ndarray, word: int):
+        self.num_group_steps += 1
+        op_code, num_operands, modes = self.decode(word)
+        next_index = index + num_operands + 1
+        if op_code in (Op_Code.ADD, Op_Code.MULTIPLY, Op_Code.LESS_THAN, Op_Code.EQUALS):
+            operand_1 = self.__read_operand(rows, index, 1, modes[0])
+            operand_2 = self.__read_operand(rows, index, 2, modes[1])
+            if op_code == Op_Code.ADD:
+                result = operand_1 + operand_2
+                # Adding two numbers with the same sign should give a number with that sign:
+                if ((operand_1 ^ result) & (operand_2 ^ result) < 0).any():
+                    raise_overflow_error()
+            elif op_code == Op_Code.MULTIPLY:
+                check_for_overflow(operand_1.astype(float) * operand_2.astype(float))
+                result = operand_1 * operand_2
+            elif op_code == Op_Code.LESS_THAN:
+                result = (operand_1 < operand_2).astype(np.int64)
+            else:
+                result = (operand_1 == operand_2).astype(np.int64)
+            self.__write_operand(rows, index, 3, modes[2], result)
+            yield (next_index, rows)
+        elif op_code in (Op_Code.JUMP_IF_TRUE, Op_Code.JUMP_IF_FALSE):
+            operand_1 = self.__read_operand(rows, index, 1, modes[0])
+            operand_2 = self.__read_operand(rows, index, 2, modes[1])
+            should_jump = operand_1 != 0 if op_code == Op_Code.JUMP_IF_TRUE else operand_1 == 0
+            next_indices = np.where(should_jump, operand_2, next_index)
+            if (next_indices == next_indices[0]).all():
+                yield (int(next_indices[0]), rows)
+                return
+            for unique_next_index in np.unique(next_indices):
+                yield (int(unique_next_index), rows[next_indices == unique_next_index])
+        elif op_code == Op_Code.ADJUST_RELATIVE_BASE:
+            self.relative_bases[rows] += self.__read_operand(rows, index, 1, modes[0])
+            yield (next_index, rows)
+        elif op_code == Op_Code.TERMINATE:
+            return
+        else:
+            raise RuntimeError(f"Op code {op_code} is not supported when running in lockstep")
+
+
+def check_for_overflow(approximate_result: np.ndarray):
+    """Errs on the side of caution: results within float rounding error of the limit are rejected too."""
+    if approximate_result.size > 0 and np.abs(approximate_result).max() >= int64_limit:
+        raise_overflow_error()
+
+
+def raise_overflow_error():
+    raise OverflowError("Result doesn't fit in 64 bits. Use `day_05.Machine` for this program instead.")
+
+
+def execute_in_lockstep(memories: np.ndarray) -> np.ndarray:
+    return LockstepMachines(memories).run()
+
+
+def run_reference(memory: List[int]) -> List[int]:
+    machine = Machine(",".join(str(x) for x in memory))
+    machine.run()
+    assert machine.status == MachineStatus.TERMINATED
+    return machine.memory.to_list()
+
+
+def test_simple_programs():
+    for source_code, expected in simple_programs:
+        memory = [int(x) for x in source_code.split(",")]
+        final_memories = execute_in_lockstep(np.array([memory, memory]))
+        assert final_memories[0].tolist()[:len(expected)] == expected
+        assert final_memories[1].tolist()[:len(expected)] == expected
+
+
+def test_noun_verb_grid_matches_interpreter():
+    program = [1, 0, 0, 3, 1, 1, 2, 3, 1, 3, 4, 3, 1, 5, 0, 3, 2, 1, 10, 19, 99, 0, 0, 0]
+    memories = np.tile(np.array(program, dtype=np.int64), (25, 1))
+    for row, (noun, verb) in enumerate((noun, verb) for noun in range(5) for verb in range(5)):
+        memories[row, 1] = noun
+        memories[row, 2] = verb
+    final_memories = execute_in_lockstep(memories)
+    for row in range(len(memories)):
+        expected = run_reference(memories[row].tolist())
+        assert final_memories[row].tolist()[:len(expected)] == expected
+
+
+def test_instances_that_branch_differently():
+    # Count cell 30 down to zero while adding cell 31 to cell 32 (so cell 32 = cell 30 * cell 31), using the
+    # relative base to address cell 32. Every instance starts with a different count:
+    program = [
+        109, 2,  # 0: relative base = 2
+        1007, 30, 1, 33,  # 2: cell 33 = cell 30 < 1
+        1005, 33, 20,  # 6: done counting?
+        20201, 30, 31, 30,  # 9: cell 32 += cell 31 (cell 32 through the relative base)
+        1001, 30, -1, 30,  # 13: cell 30 -= 1
+        1105, 1, 2,  # 17
+        99,  # 20
+    ]
+    program += [0] * (30 - len(program)) + [0, 7, 0, 0]
+    memories = np.tile(np.array(program, dtype=np.int64), (6, 1))
+    memories[:, 30] = [0, 5, 1, 3, 5, 2]
+    lockstep = LockstepMachines(memories)
+    final_memories = lockstep.run()
+    assert final_memories[:, 32].tolist() == [0, 35, 7, 21, 35, 14]
+    num_instructions = 0
+    for row in range(len(memories)):
+        machine = Machine(",".join(str(x) for x in memories[row]))
+        machine.profile = Profile()
+        machine.run()
+        num_instructions += machine.profile.num_instructions
+        assert final_memories[row].tolist()[:len(machine.memory)] == machine.memory.to_list()
+    # Running separately, an instance that counts down from c executes 1 + 5 * c + 3 instructions:
+    assert num_instructions == sum(1 + 5 * count + 3 for count in [0, 5, 1, 3, 5, 2])
+    # In lockstep, instances share every step until they stop counting. Then each of the 4 groups that finish
+    # early needs one more step to terminate:
+    assert lockstep.num_group_steps == 1 + 5 * 5 + 3 + 4
+
+
+def test_writes_past_the_end_grow_memory():
+    final_memories = execute_in_lockstep(np.array([[1101, 1, 2, 10, 99], [1101, 3, 4, 7, 99]]))
+    assert final_memories[:, 10].tolist() == [3, 0]
+    assert final_memories[:, 7].tolist() == [0, 7]
+
+
+def test_negative_addresses():
+    # Jumps to -5, which would be the 1101 if negative addresses counted from the end:
+    program = [1105, 1, -5, 99, 1101, 2, 3, 0, 99]
+    with pytest.raises(IndexError, match="negative address"):
+        run_reference(program)
+    with pytest.raises(IndexError, match="negative address"):
+        execute_in_lockstep(np.array([program]))
+    with pytest.raises(IndexError, match="negative address"):
+        execute_in_lockstep(np.array([[1, -1, 0, 0, 99]]))
+    with pytest.raises(IndexError, match="negative address"):
+        execute_in_lockstep(np.array([[109, -10, 21101, 1, 1, 0, 99]]))
+
+
+def test_unsupported_programs():
+    with pytest.raises(RuntimeError):
+        execute_in_lockstep(np.array([[3, 0, 99]]))
+    with pytest.raises(OverflowError):
+        execute_in_lockstep(np.array([[1102, 2 ** 40, 2 ** 40, 0, 99]]))
+    # Growing a thousand rows to reach one address far past the end:
+    with pytest.raises(MemoryError):
+        execute_in_lockstep(np.zeros((1000, 5), dtype=np.int64) + [1101, 1, 1, 10 ** 6, 99])
@@ -0,0 +1,153 @@
+"""
+Record every input and output of an Intcode session (e.g. a game of day_13 played on the keyboard) to a compact log
+file and replay it later without anyone at the keyboard.
+
+An Intcode program can't tell whether an input was typed in just now or queued up long before, so replaying is
+simply running the program with all the recorded inputs at once. The outputs have to match the recorded ones.
+A log also stores a digest of the program it was recorded with so that it isn't replayed against another one.
+"""
+from collections import namedtuple
+import hashlib
+import io
+import struct
+import zlib
+from typing import BinaryIO, Dict, Iterable, List, Optional, Union, cast
+import pytest
+from day_05 import Machine, MachineStatus, ProgramImage, decode_instruction, large_program, run_with_native_io
+from intcode_checkpoint import read_values, write_values
+
+magic = b"ICIO"
+version = 1
+header_format = "<4sB32s"
+
+# `inputs` are the inputs that the program consumed, `outputs` everything that it output, both in order:
+SessionLog = namedtuple("SessionLog", ["program_digest", "inputs", "outputs"])
+
+
+def get_program_digest(values: List[int]) -> bytes:
+    return hashlib.sha256(",".join(str(x) for x in values).encode("ascii")).digest()
+
+
+class RecordingMachine(Machine):
+    """Same as `day_05.Machine` but every input that it consumes and every output goes into `log`."""
+
+    def __init__(self, program: Union[str, ProgramImage], decode=decode_instruction, buffer_type=None,
+                 patches: Optional[Dict[int, int]] = None):
+        super().__init__(program, decode, buffer_type, patches)
+        self.log = SessionLog(get_program_digest(self.memory.to_list()), [], [])
+
+    def run(self, inputs: Iterable[int] = (), max_outputs: Optional[int] = None) -> List[int]:
+        # Inputs can also be appended to `self.inputs` directly, so look at what the run actually consumed:
+        self.inputs.extend(inputs)
+        pending_inputs = list(self.inputs)
+        outputs = super().run((), max_outputs)
+        self.log.inputs.extend(pending_inputs[:len(pending_inputs) - len(self.inputs)])
+        self.log.outputs.extend(outputs)
+        return outputs
+
+    def fork(self) -> "RecordingMachine":
+        forked = cast(RecordingMachine, super().fork())
+        forked.log = SessionLog(self.log.program_digest, list(self.log.inputs), list(self.log.outputs))
+        return forked
+
+
+def write_session_log(log: SessionLog, file: BinaryIO):
+    file.write(struct.pack(header_format, magic, version, log.program_digest))
+    payload = io.BytesIO()
+    write_values(payload, log.inputs)
+    write_values(payload, log.outputs)
+    file.write(zlib.compress(payload.getvalue()))
+
+
+def read_session_log(file: BinaryIO) -> SessionLog:
+    file_magic, file_version, program_digest = struct.unpack(
+        header_format, file.read(struct.calcsize(header_format)))
+    if file_magic != magic:
+        raise ValueError("Not an Intcode session log")
+    if file_version != version:
+        raise ValueError(f"Session log version {file_version} isn't supported (expected {version})")
+    payload = io.BytesIO(zlib.decompress(file.read()))
+    inputs = read_values(payload)
+    return SessionLog(program_digest, inputs, read_values(payload))
+
+
+def save_session_log(log: SessionLog, path: str):
+    with open(path, "wb") as f:
+        write_session_log(log, f)
+
+
+def load_session_log(path: str) -> SessionLog:
+    with open(path, "rb") as f:
+        return read_session_log(f)
+
+
+def replay_session(program: Union[str, ProgramImage], log: SessionLog, machine_type=Machine) -> List[int]:
+    """
+    Run `program` on a fresh `machine_type` with the inputs in `log` and return its outputs.
+    Raise `ValueError` if `log` was recorded with another program and `RuntimeError` if the outputs don't match.
+    """
+    machine = machine_type(program)
+    if get_program_digest(machine.memory.to_list()) != log.program_digest:
+        raise ValueError("The session was recorded with a different program")
+    outputs = machine.run(log.inputs)
+    if outputs != log.outputs:
+        num_matching = next(
+            (i for i, (actual, expected) in enumerate(zip(outputs, log.outputs)) if actual != expected),
+            min(len(outputs), len(log.outputs)))
+        raise RuntimeError(
+            f"Replay diverged after {num_matching} matching outputs "
+            f"(got {len(outputs)} outputs, the session has {len(log.outputs)})")
+    return outputs
+
+
+# Outputs the running total of its inputs until it reads a 0:
+running_total_program = "3,100,1,100,101,101,4,101,1005,100,0,99"
+
+
+def test_record_and_replay(tmp_path):
+    inputs = iter([3, 4, -2, 0])
+    outputs: List[int] = []
+    machine = run_with_native_io(RecordingMachine(running_total_program), lambda: next(inputs), outputs.append)
+    assert machine.status == MachineStatus.TERMINATED
+    assert machine.log.inputs == [3, 4, -2, 0]
+    assert machine.log.outputs == outputs == [3, 7, 5, 5]
+    path = str(tmp_path / "session")
+    save_session_log(machine.log, path)
+    log = load_session_log(path)
+    assert log == machine.log
+    assert replay_session(running_total_program, log) == outputs
+    assert replay_session(ProgramImage.from_source_code(running_total_program), log) == outputs
+
+
+def test_recording_across_runs():
+    machine = RecordingMachine(running_total_program)
+    assert machine.run([1, 2], max_outputs=1) == [1]
+    # The 2 hasn't been consumed yet:
+    assert machine.log.inputs == [1]
+    forked = machine.fork()
+    assert machine.run([2 ** 70]) == [3, 3 + 2 ** 70]
+    assert forked.run([5]) == [3, 8]
+    assert machine.log == (forked.log.program_digest, [1, 2, 2 ** 70], [1, 3, 3 + 2 ** 70])
+    assert forked.log.inputs == [1, 2, 5]
+    # Unfinished sessions replay too, with values that don't fit in 64 bits:
+    log = read_session_log(write_and_rewind(machine.log))
+    assert replay_session(running_total_program, log) == [1, 3, 3 + 2 ** 70]
+
+
+def write_and_rewind(log: SessionLog) -> io.BytesIO:
+    file = io.BytesIO()
+    write_session_log(log, file)
+    file.seek(0)
+    return file
+
+
+def test_replay_checks_the_program_and_the_outputs():
+    machine = RecordingMachine(large_program)
+    machine.run([8])
+    with pytest.raises(ValueError):
+        replay_session(running_total_program, machine.log)
+    tampered_log = machine.log._replace(outputs=[999])
+    with pytest.raises(RuntimeError):
+        replay_session(large_program, tampered_log)
+    with pytest.raises(ValueError):
+        read_session_log(io.BytesIO(b"nope" + bytes(33)))
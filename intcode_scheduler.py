@@ -0,0 +1,240 @@
+"""
+Run any directed graph of Intcode machines (pipelines, rings like the amplifiers in day_07, fan-outs and fan-ins) in
+one thread without asyncio. Every edge is a FIFO channel from the outputs of one machine to the inputs of another.
+
+A machine runs until it blocks on input or terminates and only then does the scheduler switch to another one, so
+there are as few switches as the data flow allows. Machines that can make progress wait in a queue: picking the next
+one and waking up the ones that were given inputs is O(1) each no matter how many machines there are.
+"""
+from collections import deque
+from enum import Enum, auto, unique
+from typing import Deque, Dict, Hashable, Iterable, List, Union
+import pytest
+from day_05 import Machine, MachineStatus, ProgramImage, doubling_program, increment_program
+
+
+@unique
+class SchedulerStatus(Enum):
+    # Every machine has terminated:
+    FINISHED = auto()
+    # Every machine that hasn't terminated is waiting for input and no machine has any left to give it:
+    QUIESCENT = auto()
+
+
+class Deadlock(RuntimeError):
+    """Raised by `Scheduler.run_to_completion` when machines are left waiting for inputs that will never come."""
+
+    def __init__(self, waiting: List[Hashable]):
+        shown = ", ".join(repr(name) for name in waiting[:5]) + (", ..." if len(waiting) > 5 else "")
+        super().__init__(f"{len(waiting)} machines are waiting for input that will never come: {shown}")
+        self.waiting = waiting
+
+
+class Node:
+    def __init__(self, name: Hashable, machine: Machine):
+        self.name = name
+        self.machine = machine
+        self.destinations: List["Node"] = []
+        # Outputs of a machine that isn't connected to anything, until they are taken:
+        self.outputs: List[int] = []
+        self.is_ready = False
+
+
+class Scheduler:
+    def __init__(self):
+        self.nodes: Dict[Hashable, Node] = {}
+        self.ready: Deque[Node] = deque()
+        self.num_running = 0
+        self.num_switches = 0
+
+    def add_machine(self, name: Hashable, machine: Machine, inputs: Iterable[int] = ()):
+        """Add `machine` under `name` with `inputs` queued up for it."""
+        if name in self.nodes:
+            raise ValueError(f"There is already a machine called {name!r}")
+        node = Node(name, machine)
+        self.nodes[name] = node
+        machine.inputs.extend(inputs)
+        if machine.status != MachineStatus.TERMINATED:
+            self.num_running += 1
+            self.wake_up(node)
+
+    def connect(self, source: Hashable, destination: Hashable):
+        """
+        Feed the outputs of `source` into the inputs of `destination`. A machine with several destinations sends
+        every output to all of them and a machine with several sources reads their outputs in the order they came.
+        """
+        source_node, destination_node = self.get_node(source), self.get_node(destination)
+        if destination_node in source_node.destinations:
+            raise ValueError(f"{source!r} is already connected to {destination!r}")
+        source_node.destinations.append(destination_node)
+
+    def send(self, name: Hashable, values: Iterable[int]):
+        """Queue up `values` for the machine called `name` from outside the graph."""
+        node = self.get_node(name)
+        node.machine.inputs.extend(values)
+        self.wake_up(node)
+
+    def take_outputs(self, name: Hashable) -> List[int]:
+        """The outputs of a machine that isn't connected to anything since they were last taken."""
+        node = self.get_node(name)
+        outputs, node.outputs = node.outputs, []
+        return outputs
+
+    def get_machine(self, name: Hashable) -> Machine:
+        return self.get_node(name).machine
+
+    def get_node(self, name: Hashable) -> Node:
+        if name not in self.nodes:
+            raise ValueError(f"There is no machine called {name!r}")
+        return self.nodes[name]
+
+    def wake_up(self, node: Node):
+        if not node.is_ready and node.machine.status != MachineStatus.TERMINATED:
+            node.is_ready = True
+            self.ready.append(node)
+
+    def run(self) -> SchedulerStatus:
+        """
+        Run machines until none of them can make progress. If the result is `QUIESCENT`, more inputs can be sent
+        to the machines that are waiting and `run` called again.
+        """
+        ready = self.ready
+        while ready:
+            node = ready.popleft()
+            node.is_ready = False
+            machine = node.machine
+            outputs = machine.run()
+            self.num_switches += 1
+            if machine.status == MachineStatus.TERMINATED:
+                self.num_running -= 1
+            if not outputs:
+                continue
+            if not node.destinations:
+                node.outputs.extend(outputs)
+            for destination in node.destinations:
+                # A machine that has terminated keeps whatever is sent to it, e.g. for day_07's thruster signal:
+                destination.machine.inputs.extend(outputs)
+                if not destination.is_ready and destination.machine.status != MachineStatus.TERMINATED:
+                    destination.is_ready = True
+                    ready.append(destination)
+        return SchedulerStatus.FINISHED if self.num_running == 0 else SchedulerStatus.QUIESCENT
+
+    def get_waiting(self) -> List[Hashable]:
+        """The names of the machines that haven't terminated, in the order they were added."""
+        return [name for name, node in self.nodes.items() if node.machine.status != MachineStatus.TERMINATED]
+
+    def run_to_completion(self):
+        """Same as `run` for a graph without inputs from outside: raise `Deadlock` unless every machine terminates."""
+        if self.run() == SchedulerStatus.QUIESCENT:
+            raise Deadlock(self.get_waiting())
+
+
+def connect_in_ring(scheduler: Scheduler, names: List[Hashable]):
+    for source, destination in zip(names, names[1:] + names[:1]):
+        scheduler.connect(source, destination)
+
+
+def run_machines_in_ring_with_scheduler(
+    program: Union[str, ProgramImage], initial_inputs: List[List[int]], machine_type=Machine
+) -> List[int]:
+    """
+    Start one machine per entry in `initial_inputs` and run them in a ring with a `Scheduler`. Return the outputs of
+    the last machine that the first one didn't read before terminating. Use this one for a ring of machines on its
+    own and `intcode_async.run_machines_in_ring` when the machines have to run alongside other asyncio tasks.
+    """
+    scheduler = Scheduler()
+    for i, inputs in enumerate(initial_inputs):
+        scheduler.add_machine(i, machine_type(program), inputs)
+    connect_in_ring(scheduler, list(range(len(initial_inputs))))
+    scheduler.run_to_completion()
+    return list(scheduler.get_machine(0).inputs)
+
+
+# Same as `doubling_program` but outputs the number negated:
+negating_program = "3,100,1002,100,-1,101,4,101,1005,100,0,99"
+
+
+def test_pipeline():
+    scheduler = Scheduler()
+    for name in "abc":
+        scheduler.add_machine(name, Machine("3,0,1002,0,2,0,4,0,99"))
+    scheduler.connect("a", "b")
+    scheduler.connect("b", "c")
+    scheduler.send("a", [5])
+    assert scheduler.run() == SchedulerStatus.FINISHED
+    assert scheduler.take_outputs("c") == [40]
+    assert scheduler.take_outputs("c") == []
+    assert scheduler.num_switches == 3
+
+
+def test_ring_with_thousands_of_machines():
+    num_machines = 3000
+    scheduler = Scheduler()
+    for i in range(num_machines):
+        scheduler.add_machine(i, Machine(increment_program), [0] if i == 0 else [])
+    connect_in_ring(scheduler, list(range(num_machines)))
+    scheduler.run_to_completion()
+    # Machine 999 outputs 1000 on the first time around. After that, every machine outputs one more number:
+    assert scheduler.get_machine(999).read_memory(20) == 1000
+    assert scheduler.get_machine(998).read_memory(20) == 1000 + num_machines - 1
+    # One switch per number passed along, as the machines in front always have their input by the time they run:
+    assert scheduler.num_switches == num_machines + 999
+
+
+def test_run_machines_in_ring_with_scheduler():
+    # The first machine outputs 1000 and terminates, so nobody reads the 1002 that the third one outputs:
+    image = ProgramImage.from_source_code(increment_program)
+    assert run_machines_in_ring_with_scheduler(image, [[999], [], []]) == [1002]
+    assert run_machines_in_ring_with_scheduler(increment_program, [[0], [], []]) == [1002]
+
+
+def test_fan_out_and_fan_in():
+    # The source's outputs go to both branches, whose outputs are merged into the sink in the order they came:
+    scheduler = Scheduler()
+    scheduler.add_machine("source", Machine(doubling_program), [1, 3, 0])
+    scheduler.add_machine("left", Machine(doubling_program))
+    scheduler.add_machine("right", Machine(negating_program))
+    scheduler.add_machine("sink", Machine("3,0,4,0," * 6 + "99"))
+    for name in ["left", "right"]:
+        scheduler.connect("source", name)
+        scheduler.connect(name, "sink")
+    assert scheduler.run() == SchedulerStatus.FINISHED
+    assert scheduler.take_outputs("sink") == [4, 12, 0, -2, -6, 0]
+    with pytest.raises(ValueError):
+        scheduler.connect("source", "left")
+    with pytest.raises(ValueError):
+        scheduler.connect("source", "nowhere")
+    with pytest.raises(ValueError):
+        scheduler.add_machine("sink", Machine(doubling_program))
+
+
+def test_quiescence():
+    scheduler = Scheduler()
+    scheduler.add_machine("first", Machine(doubling_program))
+    scheduler.add_machine("second", Machine(doubling_program))
+    scheduler.connect("first", "second")
+    assert scheduler.run() == SchedulerStatus.QUIESCENT
+    assert scheduler.get_waiting() == ["first", "second"]
+    scheduler.send("first", [3, 4])
+    assert scheduler.run() == SchedulerStatus.QUIESCENT
+    assert scheduler.take_outputs("second") == [12, 16]
+    scheduler.send("first", [0])
+    assert scheduler.run() == SchedulerStatus.FINISHED
+    # Sending to a machine that has terminated doesn't wake it up:
+    scheduler.send("first", [5])
+    assert scheduler.run() == SchedulerStatus.FINISHED
+    assert scheduler.take_outputs("second") == [0]
+
+
+def test_deadlock():
+    # Both machines wait for the other one to go first:
+    scheduler = Scheduler()
+    scheduler.add_machine("a", Machine(doubling_program))
+    scheduler.add_machine("b", Machine(doubling_program))
+    connect_in_ring(scheduler, ["a", "b"])
+    with pytest.raises(Deadlock) as info:
+        scheduler.run_to_completion()
+    assert info.value.waiting == ["a", "b"]
+    # Every machine asks for two inputs before it outputs anything:
+    with pytest.raises(Deadlock):
+        run_machines_in_ring_with_scheduler("3,0,3,0,4,0,99", [[1], [2]])